@@ -6,97 +6,897 @@
 # @author Tiac
 # @since 1.0.0
 
+import os
 import re
 import json
+import zlib
+import time
+import heapq
+import base64
+import numbers
 import pymysql
-import threading
+import functools
+import itertools
+import contextlib
+import collections
+import concurrent.futures
+import contextvars
+import pymysql.cursors
 import pymysql.connections
 from pymysql import converters, FIELD_TYPE
 from pymysql.converters import escape_string
-from . import dqlparse, exceptions
+from pymysql.constants import CLIENT
+from . import exceptions
+from .pool import ConnectionPool, ReplicaSet, is_connection_lost
+from .lru import LRUCache, ResultCache
+from . import loader
+from . import validator as validate
+from .validator import Validator
 
 
-# 连接集合
+# 连接池集合
 connections = dict()
-# 全局连接
-global_conn = None
-# 缓存信息
-cache_data = dict()
-# 线程锁
-thread_lock = threading.Lock()
-# 线程锁超时时间
-locked_timeout = 10
+# 默认连接名称
+default_name = None
+# 最后一次查询的信息（每个线程/协程独立，只读，修改时整体替换）
+last_query = contextvars.ContextVar('last_query', default=dict())
+# 事务中固定使用的连接：name => conn（每个线程/协程独立，只读，修改时整体替换）
+pinned_conns = contextvars.ContextVar('pinned_conns', default=dict())
+# 事务嵌套层级：id(conn) => level（每个线程/协程独立，只读，修改时整体替换）
+transaction_levels = contextvars.ContextVar('transaction_levels', default=dict())
+# 查询构建器编译结果缓存：查询结构 => SQL 模板
+query_cache = LRUCache(1024)
+# 正在流式读取的连接：id(conn)（读取完毕前不能执行其他查询）
+streaming_conns = set()
+# 读写分离：read-your-writes 作用域（每个线程/协程独立，只读，修改时整体替换）
+# None：不在作用域中；dict：names 连接名称（None 表示全部）、after_write 是否写入后才使用主库、written 已写入的连接名称
+sticky_scope = contextvars.ContextVar('sticky_scope', default=None)
+# 可以分发到从库的查询语句
+READ_OPERATIONS = ['select', 'show', 'explain', 'desc', 'describe']
+# 锁定读（须在主库执行）
+LOCKING_READ_PATTERN = re.compile(r'\bFOR\s+(?:UPDATE|SHARE)\b|\bLOCK\s+IN\s+SHARE\s+MODE\b', re.I)
+# 查询结果缓存（builder.cache 开启）：(连接名称, 数据库, SQL, 参数) => 查询结果
+result_cache = ResultCache(1024)
+# 跨进程共享的查询结果缓存（imysql.use_shared_cache 开启，builder.cache(shared=True) 使用）
+shared_cache = None
+# 事务中写入的表：id(conn) => 表名集合，事务结束时使其查询结果缓存失效（每个线程/协程独立，只读，修改时整体替换）
+written_tables = contextvars.ContextVar('written_tables', default=dict())
+# 查询的表（FROM、JOIN 后的表名）
+READ_TABLE_PATTERN = re.compile(r'\b(?:FROM|JOIN)\s+((?:`[^`]+`|\w+)(?:\s*\.\s*(?:`[^`]+`|\w+))?)', re.I)
+# 写入的表（INTO、UPDATE、FROM、JOIN、TABLE、TRUNCATE 后的表名，只匹配 SET、VALUES、SELECT、WHERE 之前的部分）
+WRITE_TABLE_PATTERN = re.compile(r'\b(?:INTO(?:\s+TABLE)?|UPDATE(?:\s+(?:LOW_PRIORITY|IGNORE))*|FROM|JOIN|TABLE|TRUNCATE(?:\s+TABLE)?)\s+((?:`[^`]+`|\w+)(?:\s*\.\s*(?:`[^`]+`|\w+))?)', re.I)
+WRITE_HEAD_PATTERN = re.compile(r'\b(?:SET|VALUES?|SELECT|WHERE)\b', re.I)
+# 整数字符串（分片键）
+SHARD_INT_PATTERN = re.compile(r'^\s*[+-]?\d+\s*$')
+# 分片查询的单个聚合字段，例如：SUM(amount) AS total
+SHARD_AGGREGATE_PATTERN = re.compile(r'^\s*(\w+)\s*\(\s*(DISTINCT\s+)?[^()]*\)\s*(?:AS\s+\w+)?\s*$', re.I)
+
+
+def get_pool(name=None):
+    ''' 获取连接池
+
+    :param name: 连接名称，默认为当前默认连接
+    :return ConnectionPool
+    '''
+
+    name = name or default_name
+
+    # 如果连接不存在，则报错
+    if name not in connections:
+        raise exceptions.RuntimeError((400, '【%s】连接不存在，请先连接' % name))
+
+    return connections[name]
+
+
+def is_read(sql: str):
+    ''' 是否为可以分发到从库的查询（锁定读除外） '''
 
+    operation = sql.lstrip().split(' ', 1)[0].lower()
+    return operation in READ_OPERATIONS and LOCKING_READ_PATTERN.search(sql) is None
 
-# 事务处理
-class transaction:
 
-    level = 0
+def route(name=None, read=False):
+    ''' 选择连接池（读写分离）：查询分发到从库；写入、没有可用的从库、
+    read-your-writes 作用域中写入后的查询使用主库
 
-    def __init__(self, conn=None):
-        # 游标
+    :param name: 连接名称，默认为当前默认连接
+    :param read: 是否为查询
+    :return ConnectionPool
+    '''
+
+    name = name or default_name
+    pool = get_pool(name)
+
+    if pool.replicas is None:
+        return pool
+
+    scope = sticky_scope.get()
+    if scope is not None and (scope['names'] is None or name in scope['names']):
+        if read is False:
+            if name not in scope['written']:
+                sticky_scope.set(dict(scope, written=scope['written'] | {name}))
+            return pool
+        if scope['after_write'] is False or name in scope['written']:
+            return pool
+
+    if read is False:
+        return pool
+
+    return pool.replicas.choose() or pool
+
+
+def get_owner(name, conn):
+    ''' 借出连接的连接池（主库或从库） '''
+
+    pool = get_pool(name)
+    if pool.replicas is not None:
+        for replica in pool.replicas.pools:
+            if replica.owns(conn):
+                return replica
+    return pool
+
+
+def get_tables(sql: str, write=False):
+    ''' SQL 中查询或写入的表（不含数据库名，小写）
+
+    :param sql: str 或 bytes（写入语句）
+    :param write: 是否为写入语句
+    :return frozenset
+    '''
+
+    if write is True:
+        # 批量写入的语句为 bytes
+        head = sql[0:4096]
+        if type(head) is not str:
+            head = bytes(head).decode('utf-8', 'ignore')
+        sql = WRITE_HEAD_PATTERN.split(head, 1)[0]
+        pattern = WRITE_TABLE_PATTERN
+    else:
+        pattern = READ_TABLE_PATTERN
+
+    return frozenset(x.split('.')[-1].strip().strip('`').lower() for x in pattern.findall(sql))
+
+
+def invalidate(conn, sql: str):
+    ''' 写入后使相关表的查询结果缓存失效；事务中写入的表在事务结束时再次失效
+    （避免事务提交前其他线程缓存了旧数据）
+    '''
+
+    tables = get_tables(sql, write=True)
+    if len(tables) == 0:
+        return
+
+    invalidate_tables(tables)
+
+    if transaction.get_level(conn) > 0:
+        written = dict(written_tables.get())
+        written[id(conn)] = written.get(id(conn), frozenset()) | tables
+        written_tables.set(written)
+
+
+def invalidate_tables(tables):
+    ''' 使表的查询结果缓存（包括共享缓存）失效 '''
+
+    result_cache.invalidate(tables)
+    if shared_cache is not None:
+        shared_cache.invalidate(tables)
+
+
+def set_last_query(**kwargs):
+    ''' 记录最后一次查询的信息（仅当前线程/协程可见） '''
+
+    data = dict(last_query.get())
+    data.update(kwargs)
+    last_query.set(data)
+
+
+def get_pinned():
+    ''' 当前线程/协程事务中固定使用的连接：name => conn '''
+
+    return pinned_conns.get()
+
+
+def set_pinned(name: str, conn=None):
+    ''' 固定（conn 为 None 时解除固定）当前线程/协程事务中使用的连接 '''
+
+    pinned = dict(pinned_conns.get())
+    if conn is None:
+        pinned.pop(name, None)
+    else:
+        pinned[name] = conn
+    pinned_conns.set(pinned)
+
+
+@contextlib.contextmanager
+def borrow(name=None, db_name=None, read=False):
+    ''' 借出连接，用完自动归还连接池（事务中使用固定的连接）
+
+    :param name: 连接名称，默认为当前默认连接
+    :param db_name: 使用的数据库，默认为连接的默认数据库
+    :param read: 是否为查询，读写分离时事务外的查询使用从库
+    :return pymysql.connections.Connection
+    '''
+
+    name = name or default_name
+    conn = get_pinned().get(name)
+
+    if conn is not None:
+        check_streaming(conn)
+        get_pool(name).use_db(conn, db_name)
+        yield conn
+        return
+
+    pool = route(name, read)
+    conn = pool.acquire(db_name)
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+def check_streaming(conn):
+    ''' 连接正在流式读取时，不能执行其他查询 '''
+
+    if id(conn) in streaming_conns:
+        raise exceptions.RuntimeError((409, '连接正在流式读取，请先读取完毕或关闭（close）后再执行其他查询'))
+
+
+class StreamResult(object):
+    ''' 流式查询结果（服务端游标）
+
+    结果逐行从服务器读取，内存占用不随结果集增大；读取完毕或关闭后归还连接。
+    事务外独占一个连接；事务中使用固定的连接，读取完毕前不能执行其他查询
+    '''
+
+    def __init__(self, name=None, db_name=None, sql='', args=None):
+        '''
+        :param name: 连接名称，默认为当前默认连接
+        :param db_name: 使用的数据库，默认为连接的默认数据库
+        :param sql
+        :param args: sql 参数
+        '''
+
+        name = name or default_name
+        self.conn = get_pinned().get(name)
+        # 是否为事务中固定的连接
+        self.pinned = self.conn is not None
+        self.pool = get_pool(name) if self.pinned else route(name, is_read(sql))
+        self.cursor = None
+        # 是否已读取完毕
+        self.finished = False
+
+        if self.pinned:
+            check_streaming(self.conn)
+            self.pool.use_db(self.conn, db_name)
+        else:
+            self.conn = self.pool.acquire(db_name)
+
+        try:
+            self.cursor = self.conn.cursor(pymysql.cursors.SSDictCursor)
+            self.sql = self.cursor.mogrify(sql, args)
+            self.cursor.execute(self.sql)
+        except Exception:
+            if not self.pinned:
+                self.pool.release(self.conn)
+            self.conn = None
+            raise
+
+        streaming_conns.add(id(self.conn))
+
+        # 记录SQL信息
+        set_last_query(last_sql=self.sql, last_operation='select')
+
+    def fetchone(self):
+        ''' 读取一行，读取完毕返回 None '''
+
+        if self.conn is None:
+            return None
+
+        row = self.cursor.fetchone()
+        if row is None:
+            self.finished = True
+            self.close()
+        return row
+
+    def fetchmany(self, size=1000):
+        ''' 读取多行，读取完毕返回空列表
+
+        :param size: 行数
+        :return list
+        '''
+
+        if self.conn is None:
+            return []
+
+        rows = self.cursor.fetchmany(size)
+        if len(rows) < size:
+            self.finished = True
+            self.close()
+        return rows
+
+    def chunks(self, size=1000):
+        ''' 分块读取
+
+        :param size: 每块的行数
+        :return generator
+        '''
+
+        try:
+            while True:
+                rows = self.fetchmany(size)
+                if len(rows) > 0:
+                    yield rows
+                if self.conn is None:
+                    break
+        finally:
+            self.close()
+
+    def __iter__(self):
+        try:
+            while True:
+                row = self.fetchone()
+                if row is None:
+                    break
+                yield row
+        finally:
+            self.close()
+
+    def close(self):
+        ''' 关闭游标并归还连接
+
+        事务外未读取完毕时直接断开连接，避免读取剩余的结果；事务中则读取并丢弃剩余的结果
+        '''
+
+        conn = self.conn
         if conn is None:
-            self.conn = global_conn
+            return
+
+        self.conn = None
+        streaming_conns.discard(id(conn))
+
+        try:
+            if self.finished or self.pinned:
+                self.cursor.close()
+            else:
+                conn.close()
+        finally:
+            if not self.pinned:
+                self.pool.release(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionProxy(object):
+    ''' 连接代理
+
+    事务中指向当前线程/协程固定使用的连接；事务外每次调用方法时临时借用连接
+    '''
+
+    def __init__(self, name=None):
+        # 连接名称，None 表示默认连接
+        self.name = name
+
+    def __getattr__(self, attr: str):
+        conn = get_pinned().get(self.name or default_name)
+        if conn is not None:
+            return getattr(conn, attr)
+
+        if not callable(getattr(pymysql.connections.Connection, attr, None)):
+            with borrow(self.name) as conn:
+                return getattr(conn, attr)
+
+        def method(*args, **kwargs):
+            with borrow(self.name) as conn:
+                return getattr(conn, attr)(*args, **kwargs)
+
+        return method
+
+
+class CrossSortKey(object):
+    ''' 跨库查询的排序键：多字段升降序，NULL 升序时排在最前、降序时排在最后（与 MySQL 一致） '''
+
+    __slots__ = ('values', 'desc')
+
+    def __init__(self, item: dict, order: list):
+        self.values = [item.get(x[0]) for x in order]
+        self.desc = [x[1] for x in order]
+
+    def __lt__(self, other):
+        for a, b, desc in zip(self.values, other.values, self.desc):
+            if a == b:
+                continue
+            if a is None:
+                return not desc
+            if b is None:
+                return desc
+            return b < a if desc else a < b
+        return False
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+
+class ShardQuery(object):
+    ''' 分片查询：同一查询并发发送到多个连接（分片），合并各分片的结果
+
+    排序及分页下推到各分片（每个分片查询 offset + count 行），再多路归并后统一分页；
+    count、COUNT/SUM/MIN/MAX 合并各分片的部分结果；条件中有分片键时只查询对应的分片
+    '''
+
+    def __init__(self, names: list, key=None, router=None, workers=None):
+        '''
+        :param names: 分片的连接名称，例如：['shard0', 'shard1']
+        :param key: 分片键，例如：member_id
+        :param router: 路由函数，参数为分片键的值，返回连接名称或下标；默认按值取模（整数、整数字符串、整数值的 Decimal/float 按整数，其他先 crc32）
+        :param workers: 并发数，默认为分片数
+        '''
+
+        if len(names) == 0:
+            raise exceptions.RuntimeError((400, 'shards: 分片不能为空'))
+
+        for name in names:
+            # 如果连接不存在，则报错
+            get_pool(name)
+
+        self.names = list(names)
+        self.key = key
+        self.router = router
+        self.workers = workers or len(self.names)
+        # 只用于构造及编译查询，不绑定连接
+        self.query = imysql()
+
+    def table(self, table: str, alias=''):
+        ''' 设置表：每次返回新的 ShardQuery（查询条件不与其他调用共享，可在多个线程中复用同一个分片集合） '''
+
+        instance = self.__class__(self.names, self.key, self.router, self.workers)
+        instance.query._table(table, alias)
+        return instance
+
+    def select(self, fields: 'str|list|tuple'):
+        self.query.select(fields)
+        return self
+
+    def join(self, table: str, on: 'str|dict', alias='', how='left'):
+        self.query.join(table, on, alias, how)
+        return self
+
+    def where(self, condition: 'str|dict'):
+        self.query.where(condition)
+        return self
+
+    def and_where(self, condition: 'str|dict'):
+        self.query.and_where(condition)
+        return self
+
+    def or_where(self, condition: 'str|dict'):
+        self.query.or_where(condition)
+        return self
+
+    def order_by(self, by: 'str|list', ascending: 'bool|list' = True):
+        self.query.order_by(by, ascending)
+        return self
+
+    def skip(self, num: int):
+        self.query.skip(num)
+        return self
+
+    def limit(self, num: int):
+        self.query.limit(num)
+        return self
+
+    def route(self, value):
+        ''' 分片键的值所在的分片（写入时使用）
+
+        :param value: 分片键的值
+        :return imysql
+        '''
+
+        return imysql.switch(self.get_shard(value))
+
+    def get_shard(self, value):
+        ''' 分片键的值所在的连接名称 '''
+
+        if self.router is None:
+            value = self.__class__.canonical_key(value)
+            if type(value) is int:
+                index = value % len(self.names)
+            else:
+                index = zlib.crc32(str(value).encode('utf-8')) % len(self.names)
+            return self.names[index]
+
+        name = self.router(value)
+        return self.names[name] if type(name) is int else name
+
+    @classmethod
+    def canonical_key(cls, value):
+        ''' 分片键的值统一为整数（同一个值以 10086、'10086'、Decimal('10086') 传入时路由到同一分片）
+
+        :return int 或 原值
+        '''
+
+        if type(value) is bool:
+            return value
+        if type(value) is str:
+            return int(value) if SHARD_INT_PATTERN.match(value) else value
+        if isinstance(value, numbers.Number) and not isinstance(value, numbers.Integral):
+            try:
+                return int(value) if value == int(value) else value
+            except (TypeError, ValueError, OverflowError):
+                return value
+        return int(value) if isinstance(value, numbers.Integral) else value
+
+    def get_targets(self):
+        ''' 查询需要发送到的分片：条件中有分片键（= 或 IN）且没有 OR 时，只发送到对应的分片 '''
+
+        wheres = self.query.data.get('where', [])
+        if self.key is None or any(glue == 'OR' for glue, _ in wheres):
+            return self.names
+
+        for _, condition in wheres:
+            if type(condition) is not dict:
+                continue
+            for field, value in condition.items():
+                if field.split('.')[-1].strip('`') != self.key or value is None:
+                    continue
+                if type(value) is list or type(value) is tuple:
+                    operate = value[0].upper()
+                    # 不使用引号时为字段或表达式，不能路由
+                    if len(value) >= 3 and value[2] is not True:
+                        continue
+                    if operate == '=' and value[1] is not None and (type(value[1]) is str or not hasattr(value[1], '__iter__')):
+                        values = [value[1]]
+                    elif operate == 'IN' and type(value[1]) is not str and hasattr(value[1], '__iter__'):
+                        values = list(value[1])
+                    else:
+                        continue
+                else:
+                    values = [value]
+
+                names = set(self.get_shard(x) for x in values)
+                return [x for x in self.names if x in names]
+
+        return self.names
+
+    def get_order(self):
+        ''' 排序字段及方向（结果中的列名）
+
+        :return [(column, desc), ...]
+        '''
+
+        by, ascending = self.query.data.get('order_by', (None, True))
+        if not by:
+            return []
+
+        if type(by) is str:
+            if by.find(',') > -1 or by.find(' ') > -1:
+                items = [(x.strip(), None) for x in by.split(',')]
+            else:
+                items = [(by, ascending)]
+        else:
+            items = [(x, ascending[i] if type(ascending) is tuple else ascending) for i, x in enumerate(by)]
+
+        order = []
+        for item, flag in items:
+            parts = item.split()
+            if len(parts) > 1:
+                flag = parts[1].upper() != 'DESC'
+            order.append((parts[0].split('.')[-1].strip('`'), not flag))
+        return order
+
+    def gather(self, data: dict, stream=False):
+        ''' 把查询并发发送到各分片
+
+        :param data: 查询数据
+        :param stream: 是否流式读取（服务端游标）
+        :return [result 或 StreamResult, ...]
+        '''
+
+        query = imysql()
+        query.data = data
+        sql, args = query.compile()
+
+        names = self.get_targets()
+        if len(names) == 0:
+            return []
+
+        def fetch(name):
+            if stream is True:
+                return imysql.switch(name).execute(sql, args, stream=True)
+            return imysql.switch(name).execute(sql, args, fetch=True)
+
+        if len(names) == 1:
+            return [fetch(names[0])]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.workers, len(names))) as executor:
+            # 在调用方的上下文中执行（事务中固定的连接、sticky 作用域）
+            futures = [executor.submit(contextvars.copy_context().run, fetch, x) for x in names]
+            results = []
+            try:
+                for future in futures:
+                    results.append(future.result())
+            except Exception:
+                # 关闭已打开的流，避免占用连接
+                for future in futures:
+                    if stream is True and future.exception() is None:
+                        future.result().close()
+                raise
+            return results
+
+    def all(self, fetch=False, stream=False):
+        ''' 查询多行：排序及分页下推到各分片，多路归并后统一分页
+
+        :param fetch: 返回 list，默认 False：返回 generator
+        :param stream: 各分片是否流式读取（服务端游标），默认 False
+        :return list 或 generator
+        '''
+
+        data = dict(self.query.data)
+        skip, limit = data.get('skip', 0), data.get('limit', 0)
+        # 各分片查询 offset + count 行
+        if limit > 0:
+            data['skip'] = 0
+            data['limit'] = skip + limit
+        else:
+            skip = 0
+
+        order = self.get_order()
+        results = self.gather(data, stream)
+        self.query.reset_data()
+
+        rows = self.merge(results, order, skip, limit)
+        return list(rows) if fetch is True else rows
+
+    def merge(self, results: list, order: list, skip: int, limit: int):
+        ''' 合并各分片的结果：有排序时多路归并（各分片结果已排序），否则按分片顺序拼接
+
+        :return generator
+        '''
+
+        try:
+            if len(order) > 0:
+                for column, _ in order:
+                    for result in results:
+                        if type(result) is list and len(result) > 0 and column not in result[0]:
+                            raise exceptions.RuntimeError((400, f'查询字段中须包含排序字段：{column}'))
+                rows = heapq.merge(*results, key=functools.partial(CrossSortKey, order=order))
+            else:
+                rows = itertools.chain.from_iterable(results)
+
+            yield from itertools.islice(rows, skip, skip + limit if limit > 0 else None)
+        finally:
+            for result in results:
+                if isinstance(result, StreamResult):
+                    result.close()
+
+    def one(self):
+        ''' 查询一行 '''
+
+        self.query.skip(num=0)
+        self.query.limit(num=1)
+
+        rows = self.all(fetch=True)
+        return rows[0] if len(rows) > 0 else None
+
+    def scalar(self):
+        ''' 查询一个值：查询字段为 COUNT、SUM、MIN、MAX 时合并各分片的结果 '''
+
+        fields = self.query.data.get('fields', '*')
+        match = SHARD_AGGREGATE_PATTERN.match(fields) if type(fields) is str else None
+
+        if match is None:
+            one = self.one()
+            if type(one) is dict:
+                return list(one.values())[0]
+            else:
+                return ''
+
+        function = match.group(1).upper()
+        if function not in ['COUNT', 'SUM', 'MIN', 'MAX']:
+            raise exceptions.RuntimeError((400, f'分片查询不能合并 {function}，请分别使用 sum 和 count'))
+        # 各分片去重后的数量（和）相加不等于全局去重的结果
+        if match.group(2) and function in ['COUNT', 'SUM']:
+            raise exceptions.RuntimeError((400, f'分片查询不能合并 {function}(DISTINCT ...)'))
+
+        data = dict(self.query.data)
+        data.pop('order_by', None)
+        data.pop('skip', None)
+        data.pop('limit', None)
+        results = self.gather(data)
+        self.query.reset_data()
+
+        values = [list(x[0].values())[0] for x in results if len(x) > 0]
+        values = [x for x in values if x is not None]
+
+        if function == 'COUNT':
+            return sum(values)
+        elif len(values) == 0:
+            return None
+        elif function == 'SUM':
+            return sum(values)
+        elif function == 'MIN':
+            return min(values)
         else:
-            self.conn = conn
+            return max(values)
+
+    def aggregate(self, function: str, field: str):
+        ''' 聚合各分片
+
+        :param function: COUNT、SUM、MIN 或 MAX
+        :param field: 字段
+        :return 合并后的值
+        '''
+
+        self.query.select(f'{function}({field}) AS v')
+        return self.scalar()
+
+    def sum(self, field: str):
+        ''' 求和 '''
+
+        return self.aggregate('SUM', field)
+
+    def min(self, field: str):
+        ''' 最小值 '''
+
+        return self.aggregate('MIN', field)
+
+    def max(self, field: str):
+        ''' 最大值 '''
+
+        return self.aggregate('MAX', field)
+
+    def column(self):
+        ''' 查询一列 '''
+
+        results = self.all(fetch=True)
+        if len(results) > 0:
+            key = list(results[0].keys())[0]
+            return [item.get(key) for item in results]
+        else:
+            return ''
+
+    def index(self, key: str, value=None):
+        ''' 查询结果用key索引
+
+        :param key: 索引字段
+        :param value: 如果指定value字段，则返回一维dict，否则返回二维dict
+        :return dict
+        '''
+
+        result = dict()
+
+        for item in self.all():
+            if value is None:
+                result[item.get(key)] = item
+            else:
+                result[item.get(key)] = item.get(value)
+
+        return result
+
+    def count(self):
+        ''' 统计：各分片的数量相加 '''
+
+        data = dict(self.query.data)
+        skip, limit = data.pop('skip', 0), data.pop('limit', 0)
+        data.pop('order_by', None)
+        data['fields'] = 'count(*) as ct'
+
+        results = self.gather(data)
+        self.query.reset_data()
+
+        total = sum(x[0].get('ct') for x in results if len(x) > 0)
+        if limit > 0:
+            total = max(0, min(total - skip, limit))
+        return total
+
+
+# 事务处理
+class transaction:
+
+    def __init__(self, conn=None):
+        # 连接：None（默认连接）、连接名称、ConnectionProxy 或 pymysql 连接
+        self.conn = conn
+        # 实际使用的连接
+        self.real_conn = None
+        # 由本事务借出并固定的连接：(name, pool)
+        self.pinned = None
 
     @classmethod
     def atomic(cls, conn_or_func=None):
         ''' 原子性事务 '''
 
         # 上下文管理器
-        if conn_or_func is None or isinstance(conn_or_func, pymysql.connections.Connection):
+        if conn_or_func is None or isinstance(conn_or_func, (str, ConnectionProxy, pymysql.connections.Connection)):
             return cls(conn=conn_or_func)
 
         # 装饰器
+        @functools.wraps(conn_or_func)
         def wrapper(*args, **kwargs):
-            cls.adjust_level(1)
-
-            try:
-                result = conn_or_func(*args, **kwargs)
-                cls.adjust_level(-1)
-                if cls.get_level() == 0:
-                    global_conn.commit()
-                return result
-            except Exception as e:
-                cls.adjust_level(-1)
-                global_conn.rollback()
-                # 释放锁
-                if thread_lock.locked() is True:
-                    thread_lock.release()
-                raise e
+            with cls():
+                return conn_or_func(*args, **kwargs)
 
         return wrapper
 
     def __enter__(self):
-        self.__class__.adjust_level(1)
+        conn = self.conn
+
+        if not isinstance(conn, pymysql.connections.Connection):
+            name = conn.name if isinstance(conn, ConnectionProxy) else conn
+            name = name or default_name
+            conn = get_pinned().get(name)
+            # 最外层事务：从连接池借出连接（主库），并固定给当前线程/协程使用
+            if conn is None:
+                pool = route(name)
+                conn = pool.acquire()
+                set_pinned(name, conn)
+                self.pinned = (name, pool)
+
+        self.real_conn = conn
+
+        try:
+            if self.__class__.adjust_level(conn, 1) == 1 and conn.get_autocommit():
+                conn.begin()
+        except Exception:
+            self.__class__.adjust_level(conn, -1)
+            if self.pinned is not None:
+                name, pool = self.pinned
+                set_pinned(name)
+                pool.release(conn)
+            raise
 
-        return self.conn
+        return conn
 
     def __exit__(self, exc_type, exc_value, exc_tb):
-        self.__class__.adjust_level(-1)
-
-        if self.__class__.get_level() == 0:
-            if exc_type is None:
-                self.conn.commit()
-                return True
-            else:
-                self.conn.rollback()
-                # 回滚后，插入ID和影响行数都改为0
-                cache_data['effected_rows'] = 0
-                cache_data['last_insert_id'] = 0
-                # 释放锁
-                if thread_lock.locked() is True:
-                    thread_lock.release()
-                return False
+        conn = self.real_conn
+        level = None
+
+        try:
+            level = self.__class__.adjust_level(conn, -1)
+            if level == 0:
+                if exc_type is None:
+                    conn.commit()
+                    return True
+                else:
+                    conn.rollback()
+                    # 回滚后，插入ID和影响行数都改为0
+                    set_last_query(effected_rows=0, last_insert_id=0)
+                    return False
+        finally:
+            # 事务结束，使事务中写入的表的查询结果缓存失效
+            if level == 0 and id(conn) in written_tables.get():
+                written = dict(written_tables.get())
+                invalidate_tables(written.pop(id(conn)))
+                written_tables.set(written)
+
+            # 归还固定的连接
+            if self.pinned is not None:
+                name, pool = self.pinned
+                set_pinned(name)
+                pool.release(conn)
 
     @classmethod
-    def get_level(cls):
-        return cls.level
+    def get_level(cls, conn):
+        return transaction_levels.get().get(id(conn), 0)
 
     @classmethod
-    def adjust_level(cls, val: int):
-        cls.level += val
+    def adjust_level(cls, conn, val: int):
+        levels = dict(transaction_levels.get())
+        level = levels.get(id(conn), 0) + val
+        if level > 0:
+            levels[id(conn)] = level
+        else:
+            levels.pop(id(conn), None)
+        transaction_levels.set(levels)
+        return level
 
 
 # 查询构建器
@@ -105,7 +905,7 @@ class imysql:
     # 默认连接（静态变量）
     default_conn = None
 
-    def __init__(self, conn=None):
+    def __init__(self, name=None, db_name=None):
 
         # 数据
         self.data = dict()
@@ -113,33 +913,85 @@ class imysql:
         self.raw_sql = ''
         # 上一个SQL
         self.last_sql = ''
+        # 连接名称，None 表示默认连接
+        self.name = name
+        # 使用的数据库，None 表示连接的默认数据库
+        self.db_name = db_name
         # 连接
-        if conn is not None:
-            self.conn = conn
-        else:
-            self.conn = global_conn
+        self.conn = ConnectionProxy(name)
+        # 游标
+        self.cursor = None
 
-        # 加线程锁
-        thread_lock.acquire(timeout=locked_timeout)
+    @contextlib.contextmanager
+    def _borrow(self, read=False):
+        ''' 借出连接，执行完毕后归还连接池（read：查询，读写分离时使用从库） '''
 
-        # 断线重连
-        self.conn.ping(reconnect=True)
+        with borrow(self.name, self.db_name, read) as conn:
+            self.cursor = conn.cursor()
+            yield conn
 
-        # 游标
-        self.cursor = self.conn.cursor()
+    @classmethod
+    def connect(cls, options: dict, name='default', min_size=1, max_size=10, max_idle=600, max_lifetime=3600, acquire_timeout=10, ping_interval=30, replicas=None, balance='least', max_lag=None, lag_interval=5, hedge=None):
+        ''' 连接 MySql
+
+        :param options: https://pymysql.readthedocs.io/en/latest/modules/connections.html
+        :param name: 连接名称
+        :param min_size: 连接池最小连接数
+        :param max_size: 连接池最大连接数
+        :param max_idle: 最大空闲时间（秒），超过则关闭连接，0：不限制
+        :param max_lifetime: 连接最长存活时间（秒），0：不限制
+        :param acquire_timeout: 获取连接的超时时间（秒）
+        :param ping_interval: 连接空闲超过该时间（秒）才在使用前 ping 检测，0：每次使用前都检测
+        :param replicas: 从库的连接参数（与主库的参数合并），可指定 weight 权重，例如：[{'host': '10.0.0.2', 'weight': 2}]
+        :param balance: 从库负载均衡策略，least：未完成请求数最少（按权重），weighted：按权重随机
+        :param max_lag: 从库最大延迟（秒），超过则暂不使用该从库，None：不检测
+        :param lag_interval: 检测从库延迟的间隔（秒）
+        :param hedge: 对冲读的延迟百分位（例如 95），查询超过该延迟仍未返回时再发送到另一个从库，None：不开启
+        :return ConnectionProxy
+        '''
+
+        global default_name
+
+        pool_options = {
+            'min_size': min_size,
+            'max_size': max_size,
+            'max_idle': max_idle,
+            'max_lifetime': max_lifetime,
+            'acquire_timeout': acquire_timeout,
+            'ping_interval': ping_interval,
+        }
+
+        # 连接池
+        if name not in connections:
+            pool = ConnectionPool(cls.gen_options(options), **pool_options)
+
+            # 读写分离
+            if replicas:
+                pools = []
+                weights = []
+                for replica in replicas:
+                    replica = dict(replica)
+                    weights.append(replica.pop('weight', 1))
+                    pools.append(ConnectionPool(cls.gen_options(dict(options, **replica)), **pool_options))
+                pool.replicas = ReplicaSet(pools, weights, balance=balance, max_lag=max_lag, lag_interval=lag_interval, hedge=hedge)
+
+            connections[name] = pool
 
-        # 释放锁
-        thread_lock.release()
+        # 默认连接
+        if default_name is None:
+            default_name = name
+            cls.default_conn = ConnectionProxy()
+
+        return ConnectionProxy(name)
 
     @classmethod
-    def connect(cls, options: dict, name='default'):
-        ''' 连接 MySql
+    def gen_options(cls, options: dict):
+        ''' 合并默认连接参数
 
-        :param https://pymysql.readthedocs.io/en/latest/modules/connections.html
+        :param options: pymysql 连接参数
+        :return dict
         '''
 
-        global global_conn
-        
         conv = converters.conversions
         conv[FIELD_TYPE.NEWDECIMAL] = float
         conv[FIELD_TYPE.DATE] = str
@@ -153,27 +1005,13 @@ class imysql:
             'cursorclass': pymysql.cursors.DictCursor,
             'conv': conv,
             'use_unicode': True,
+            # 查询不开启事务，事务由 transaction 显式开启
+            'autocommit': True,
         }
 
         # 合并参数
         default_options.update(options)
-        options = default_options
-
-        # 连接
-        if name in connections:
-            # raise exceptions.RuntimeError((400, '请忽重复连接【%s】' % name))
-            conn = connections[name]
-        else:
-            conn = pymysql.connect(**options)
-            # 保存连接
-            connections[name] = conn
-
-        # 全局游标
-        if global_conn is None:
-            global_conn = conn
-            cls.default_conn = conn
-
-        return conn
+        return default_options
 
     @classmethod
     def switch(cls, name: str, db_name=None, inplace=False):
@@ -185,45 +1023,76 @@ class imysql:
         :return cursor
         '''
 
-        global global_conn
-        
+        global default_name
+
         if name.find('.') > -1:
             name, db_name = name.split('.')
 
         # 如果连接不存在，则报错
-        if name not in connections:
-            raise exceptions.RuntimeError((400, '【%s】连接不存在，请先连接'))
-        
-        # 连接
-        conn = connections[name]
-
-        # 加线程锁
-        thread_lock.acquire(timeout=locked_timeout)
-
-        # 断线重连
-        conn.ping(reconnect=True)
-
-        # 切换到同连接的其他数据库
-        if db_name is not None:
-            conn.select_db(db_name)
-
-        # 释放锁
-        thread_lock.release()
+        pool = get_pool(name)
 
-        # 全局游标
+        # 全局默认连接
         if inplace is True:
-            global_conn = conn
-            cls.default_conn = conn
+            # 切换到同连接的其他数据库
+            if db_name is not None:
+                pool.database = db_name
+                for replica in (pool.replicas.pools if pool.replicas is not None else []):
+                    replica.database = db_name
+            default_name = name
             return cls
         else:
             # 实例化
-            instance = cls(conn=conn)
+            instance = cls(name=name, db_name=db_name)
             # 动态修改 table 方法
             instance.table = instance._table
             # 动态修改 execute 方法
             instance.execute = instance._execute
             return instance
 
+    @classmethod
+    def shards(cls, names: list, key=None, router=None, workers=None):
+        ''' 分片查询：同一查询并发发送到多个连接，合并结果
+
+        :param names: 分片的连接名称，例如：['shard0', 'shard1']
+        :param key: 分片键，条件中有分片键（= 或 IN）时只查询对应的分片
+        :param router: 路由函数，参数为分片键的值，返回连接名称或下标；默认按值取模
+        :param workers: 并发数，默认为分片数
+        :return ShardQuery
+        '''
+
+        return ShardQuery(names, key, router, workers)
+
+    @classmethod
+    def get_pool_stats(cls, name=None):
+        ''' 获取连接池统计信息
+
+        :param name: 连接名称，默认为当前默认连接
+        :return dict，in_use：使用中，idle：空闲，wait_time：累计等待时间（秒），pings：ping 次数，reconnects：重连次数等；
+                读写分离时 replicas 为各从库的统计信息（另有 weight 权重、lag 延迟、available 是否可用）
+        '''
+
+        pool = get_pool(name)
+        stats = pool.stats()
+        if pool.replicas is not None:
+            stats['replicas'] = pool.replicas.stats()
+        return stats
+
+    @classmethod
+    @contextlib.contextmanager
+    def sticky(cls, name=None, after_write=True):
+        ''' read-your-writes：作用域中写入后的查询使用主库（读写分离时）
+
+        :param name: 连接名称（str 或 list），None：所有连接
+        :param after_write: True：写入后的查询使用主库，False：所有查询都使用主库
+        '''
+
+        names = None if name is None else set([name] if type(name) is str else name)
+        token = sticky_scope.set({'names': names, 'after_write': after_write, 'written': frozenset()})
+        try:
+            yield
+        finally:
+            sticky_scope.reset(token)
+
     @classmethod
     def table(cls, table: str, alias=''):
         ''' 设置表（静态调用） '''
@@ -237,154 +1106,537 @@ class imysql:
         return self
 
     @classmethod
-    def execute(cls, sql: str, args=None, fetch=False):
-        ''' 执行原生SQL
+    def execute(cls, sql: str, args=None, fetch=False, stream=False):
+        ''' 执行原生SQL
+
+        :param sql
+        :param args: sql 参数
+        :param fetch: False：返回 self，True：返回 list
+        :param stream: 是否流式读取（服务端游标），仅限查询语句
+        :return imysql、result 或 StreamResult
+        '''
+
+        instance = cls()
+        return instance._execute(sql, args=args, fetch=fetch, stream=stream)
+
+    def _execute(self, sql: str, args=None, fetch=False, stream=False):
+        ''' 执行原生SQL
+
+        :param sql
+        :param args: sql 参数
+        :param fetch: False：返回 self，True：返回 list
+        :param stream: 是否流式读取（服务端游标），仅限查询语句
+        :return imysql、result 或 StreamResult
+        '''
+
+        if stream is True:
+            operation = sql.strip().split(' ')[0].lower()
+            if operation not in ['select', 'show', 'explain', 'desc', 'describe', 'with']:
+                raise exceptions.RuntimeError((400, '只有查询语句才能流式读取'))
+            return StreamResult(self.name, self.db_name, sql, args)
+
+        read = is_read(sql)
+
+        # 对冲读（读写分离且开启 hedge 时，事务外的查询）
+        replicas = get_pool(self.name).replicas
+        if read and replicas is not None and replicas.hedge is not None and get_pinned().get(self.name or default_name) is None:
+            pool = route(self.name, True)
+            if pool in replicas.pools:
+                self.cursor, sql = replicas.execute_hedged(pool, sql, args, self.db_name)
+
+                # 记录SQL信息
+                self.raw_sql = sql
+                set_last_query(last_sql=sql, last_operation='select')
+
+                return self if fetch is False else self.cursor.fetchall()
+
+        with self._borrow(read) as conn:
+            sql = self.cursor.mogrify(sql, args)
+
+            operation = sql.split(' ')[0].strip().lower()
+
+            if operation in ['insert', 'replace', 'update', 'delete', 'truncate', 'create', 'drop', 'alter']:
+                with transaction.atomic(conn):
+                    self.cursor.execute(sql)
+                    invalidate(conn, sql)
+
+                    # 记录SQL信息
+                    insert_id = conn.insert_id()
+                    effected_rows = self.cursor.rowcount
+                    set_last_query(last_sql=sql, last_operation=operation, last_insert_id=insert_id, effected_rows=effected_rows)
+
+                    return insert_id if operation == 'insert' else effected_rows
+            else:
+                self._execute_read(conn, sql, operation)
+
+                # 记录SQL信息
+                self.raw_sql = sql
+                set_last_query(last_sql=sql, last_operation='select')
+
+                if fetch is False:
+                    return self
+                else:
+                    return self.cursor.fetchall()
+
+    def _execute_read(self, conn, sql: str, operation: str):
+        ''' 执行查询，连接断开时重连并重试（仅限事务外的只读查询） '''
+
+        try:
+            self.cursor.execute(sql)
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            if not is_connection_lost(e) or operation not in ['select', 'show', 'explain', 'desc', 'describe']:
+                raise e
+            # 事务中的查询不能重试（事务已随连接丢失）
+            if transaction.get_level(conn) > 0:
+                raise e
+
+            get_owner(self.name, conn).reconnect(conn, self.db_name)
+            self.cursor = conn.cursor()
+            self.cursor.execute(sql)
+
+    @classmethod
+    def execute_cross(cls, sql: str, chunk_size=500, workers=4, prefetch=2, flat=False, reorder=True):
+        ''' 执行跨库（连接）查询
+
+        主查询流式读取，每块的关联查询提交到线程池并发执行（不同连接的关联查询同时进行），
+        调用方处理当前块时，预先查询后面 prefetch 块；关联结果按连接键哈希连接，支持一对多、多对多；
+        排序、分组、分页在关联后处理（见 post_cross），排序字段都属于主查询时由主查询排序
+
+        :param sql
+        :param chunk_size: 每块（主查询）的行数
+        :param workers: 执行关联查询的线程数
+        :param prefetch: 预先查询的块数，0：不预先查询
+        :param flat: 是否逐行返回，默认 False：逐块返回（每块为 list）
+        :param reorder: 是否按估算行数选择主查询（见 plan_cross）
+        :return generator
+        '''
+
+        plan = cls.plan_cross(sql, reorder=reorder)
+        sql_list, names, post = plan.get('sql_list'), plan.get('names'), plan.get('post')
+
+        if len(names) == 1:
+            cursor = imysql.switch(names[0]).execute(sql_list[names[0]]).cursor
+            if flat is True:
+                yield from cursor
+            else:
+                yield cursor
+            return
+
+        chunks = cls.iter_cross_chunks(plan, chunk_size, workers, prefetch)
+
+        try:
+            if post is None:
+                for chunk in chunks:
+                    yield from (chunk if flat is True else [chunk])
+                return
+
+            rows = cls.post_cross(chunks, post)
+            if flat is True:
+                yield from rows
+                return
+
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if len(chunk) == 0:
+                    break
+                yield chunk
+        finally:
+            chunks.close()
+
+    @classmethod
+    def iter_cross_chunks(cls, plan: dict, chunk_size: int, workers: int, prefetch: int):
+        ''' 执行跨库（连接）查询 - 逐块返回关联后的结果
+
+        :return generator（每块为 list）
+        '''
+
+        sql_list, bridging, names = plan.get('sql_list'), plan.get('bridging'), plan.get('names')
+
+        # 需要的字段（关联后还需分组、排序时，未匹配的字段为 None，与 MySQL 一致）
+        default = '' if plan.get('post') is None else None
+        needs = {key: default for key in plan.get('column_alias')}
+
+        # 事务中固定的连接同一时间只能执行一个查询，不预先查询后面的块
+        pinned = get_pinned()
+        if any(pinned.get(x) is not None for x in names[1:]):
+            prefetch = 0
+
+        stream = imysql.switch(names[0]).execute(sql_list[names[0]], stream=True)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='chain_pymysql_cross')
+        # 已提交关联查询的块：(rows, {name: future})
+        pending = collections.deque()
+
+        try:
+            for rows in stream.chunks(chunk_size):
+                pending.append((rows, cls.submit_cross_chunk(executor, rows, sql_list, bridging, names[1:])))
+                if len(pending) > prefetch:
+                    yield cls.handle_cross_chunk(needs, *pending.popleft(), executor, sql_list, bridging, names[1:])
+
+            while len(pending) > 0:
+                yield cls.handle_cross_chunk(needs, *pending.popleft(), executor, sql_list, bridging, names[1:])
+        finally:
+            stream.close()
+            for rows, futures in pending:
+                for future in futures.values():
+                    future.cancel()
+            executor.shutdown(wait=False)
+
+    @classmethod
+    def post_cross(cls, chunks, post: dict):
+        ''' 执行跨库（连接）查询 - 关联后的分组聚合、排序及分页
+
+        分组：哈希聚合，每组只保留第一行及聚合状态；排序：有分页时只保留前 offset + count 行，
+        没有分页时须缓冲全部关联结果后排序；分页：取够行数后停止读取
+
+        :param chunks: 关联后的块
+        :param post: 见 DqlParse.plan_query
+        :return generator（逐行）
+        '''
+
+        offset, count = post.get('limit') or (0, None)
+        stop = offset + count if count is not None else None
+
+        if len(post.get('group')) > 0 or len(post.get('aggregates')) > 0:
+            rows = cls.aggregate_cross(chunks, post.get('group'), post.get('aggregates'))
+            if len(post.get('order')) > 0:
+                rows.sort(key=lambda x: CrossSortKey(x, post.get('order')))
+        elif len(post.get('order')) > 0:
+            rows = cls.sort_cross(chunks, post.get('order'), stop)
+        else:
+            rows = itertools.chain.from_iterable(chunks)
+
+        columns = post.get('columns')
+        for item in itertools.islice(rows, offset, stop):
+            yield {key: item.get(key) for key in columns}
+
+    @classmethod
+    def sort_cross(cls, chunks, order: list, stop=None):
+        ''' 执行跨库（连接）查询 - 排序
+
+        :param order: [(字段, 是否降序)]
+        :param stop: 只需要前 stop 行，None：不限制（缓冲全部关联结果，内存占用随结果集增大）
+        :return list
+        '''
+
+        key = functools.partial(CrossSortKey, order=order)
+
+        if stop is not None:
+            top = []
+            for chunk in chunks:
+                top = heapq.nsmallest(stop, top + chunk, key=key)
+            return top
+
+        return sorted(itertools.chain.from_iterable(chunks), key=key)
+
+    @classmethod
+    def aggregate_cross(cls, chunks, group: list, aggregates: list):
+        ''' 执行跨库（连接）查询 - 哈希分组聚合（COUNT、SUM、AVG、MIN、MAX，支持 DISTINCT，忽略 NULL）
+
+        :param group: 分组字段
+        :param aggregates: [(输出字段, 函数, 是否 DISTINCT, 查询字段)]，查询字段为 None 时计算行数
+        :return list（按分组首次出现的顺序）
+        '''
+
+        def new_states():
+            return [{'count': 0, 'value': None, 'seen': set() if x[2] else None} for x in aggregates]
+
+        # 分组 => (第一行, 聚合状态)
+        groups = dict()
+
+        for chunk in chunks:
+            for item in chunk:
+                key = tuple(item.get(x) for x in group)
+                if key not in groups:
+                    groups[key] = (item, new_states())
+
+                for (alias, function, distinct, source), state in zip(aggregates, groups[key][1]):
+                    if source is None:
+                        state['count'] += 1
+                        continue
+
+                    value = item.get(source)
+                    if value is None:
+                        continue
+                    if distinct is True:
+                        if value in state['seen']:
+                            continue
+                        state['seen'].add(value)
+
+                    state['count'] += 1
+                    if state['value'] is None:
+                        state['value'] = value
+                    elif function in ('SUM', 'AVG'):
+                        state['value'] += value
+                    elif function == 'MIN' and value < state['value']:
+                        state['value'] = value
+                    elif function == 'MAX' and value > state['value']:
+                        state['value'] = value
+
+        # 不分组时，没有数据也返回一行
+        if len(group) == 0 and len(groups) == 0:
+            groups[()] = (dict(), new_states())
+
+        result = []
+        for item, states in groups.values():
+            out = dict(item)
+            for (alias, function, distinct, source), state in zip(aggregates, states):
+                if function == 'COUNT':
+                    out[alias] = state['count']
+                elif function == 'AVG':
+                    out[alias] = state['value'] / state['count'] if state['count'] > 0 else None
+                else:
+                    out[alias] = state['value']
+            result.append(out)
+
+        return result
+
+    @classmethod
+    def explain_cross(cls, sql: str, reorder=True):
+        ''' 查看跨库（连接）查询的执行计划
+
+        :param sql
+        :param reorder: 是否按估算行数选择主查询
+        :return list，每步：step 序号、name 连接、type（driving：主查询，lookup：关联查询）、join 关联类型、
+                keys 连接键、rows 估算行数（未下推连接键）、sql 下推条件及字段后的 SQL；
+                需要关联后处理时，最后一步 type 为 post：group 分组字段、aggregates 聚合 [(字段, 函数)]、order 排序、limit 分页
+        '''
+
+        plan = cls.plan_cross(sql, reorder=reorder, estimate=True)
+        result = []
+
+        for i, name in enumerate(plan.get('names')):
+            step = {'step': i + 1, 'name': name, 'type': 'driving', 'join': None, 'keys': []}
+            if i > 0:
+                join_type, join_condition = plan.get('bridging').get(name)
+                step.update({'type': 'lookup', 'join': join_type.upper(), 'keys': [t[0] for t in join_condition]})
+            step.update({'rows': plan.get('rows').get(name), 'sql': plan.get('sql_list').get(name).strip()})
+            result.append(step)
+
+        post = plan.get('post')
+        if post is not None and len(plan.get('names')) > 1:
+            result.append({
+                'step': len(result) + 1, 'name': None, 'type': 'post',
+                'group': post.get('group'), 'aggregates': [x[0:2] for x in post.get('aggregates')],
+                'order': post.get('order'), 'limit': post.get('limit'),
+            })
+
+        return result
+
+    @classmethod
+    def plan_cross(cls, sql: str, reorder=True, estimate=False):
+        ''' 执行跨库（连接）查询 - 生成执行计划
+
+        条件及字段已按连接下推；关联都是 INNER JOIN 且没有排序、分组、分页时，按 EXPLAIN 估算各连接的行数，
+        选择行数最少的连接作为主查询，其他连接沿关联关系依次查询（行数少的先查询）；
+        估算的行数按规范化的 SQL 缓存 dqlparse.ROWS_CACHE_TTL 秒，结构相同的查询不再重复 EXPLAIN
 
         :param sql
-        :param args: sql 参数
-        :param fetch: False：返回 self，True：返回 list
-        :return imysql 或 result
+        :param reorder: 是否按估算行数选择主查询
+        :param estimate: 是否总是估算行数（不使用缓存）
+        :return dict，names：查询顺序（第一个为主查询），sql_list，bridging，column_alias，rows：估算行数，
+                post：关联后的分组、排序、分页（见 DqlParse.plan_query）
         '''
 
-        instance = cls()
-        return instance._execute(sql, args=args, fetch=fetch)
+        # 只有跨库查询才用到，按需导入
+        from . import dqlparse
+
+        parser = dqlparse.DqlParse()
+        sql_list, bridging, column_alias, post = parser.split_query(sql)
+        names = list(sql_list.keys())
+        rows = dict()
+
+        # 分页下推到主查询
+        if post is not None and post.get('limit') is not None and post.get('push_limit') is True:
+            sql_list[names[0]] = sql_list[names[0]].rstrip() + ' LIMIT {}'.format(sum(post.get('limit')))
+
+        # 更换主查询不改变结果：只有 INNER JOIN，且没有排序、分组、分页
+        movable = (
+            reorder is True and len(names) > 1 and post is None
+            and all(x[0].upper() == 'INNER' for x in bridging.values())
+        )
+
+        if estimate is True:
+            rows = {name: cls.estimate_cross_rows(name, sql_list.get(name)) for name in names}
+        elif movable:
+            key = parser.normalize(sql)[0]
+            rows = dqlparse.rows_cache.get(key)
+            if rows is None:
+                rows = {name: cls.estimate_cross_rows(name, sql_list.get(name)) for name in names}
+                # 估算失败时不缓存
+                if all(rows.get(x) is not None for x in names):
+                    dqlparse.rows_cache.set(key, rows, dqlparse.ROWS_CACHE_TTL)
+            rows = dict(rows)
+
+        if movable and all(rows.get(x) is not None for x in names):
+            # 行数相同时保留原主查询
+            driving = min(names, key=lambda x: rows.get(x))
+            if driving != names[0]:
+                names, bridging = cls.reroot_cross(driving, names, bridging, rows)
+
+        return {'names': names, 'sql_list': sql_list, 'bridging': bridging, 'column_alias': column_alias, 'rows': rows, 'post': post}
 
-    def _execute(self, sql: str, args=None, fetch=False):
-        ''' 执行原生SQL
+    @classmethod
+    def estimate_cross_rows(cls, name: str, sql: str):
+        ''' 执行跨库（连接）查询 - 按 EXPLAIN 估算查询的行数（各表 rows × filtered% 相乘），失败时返回 None '''
 
-        :param sql
-        :param args: sql 参数
-        :param fetch: False：返回 self，True：返回 list
-        :return imysql 或 result
-        '''
+        try:
+            result = imysql.switch(name).execute('EXPLAIN ' + sql, fetch=True)
+        except pymysql.MySQLError:
+            return None
 
-        thread_lock.acquire(timeout=locked_timeout)
+        total = 1
+        for item in result:
+            total *= (item.get('rows') or 0) * float(item.get('filtered') or 100) / 100
+        return int(total)
 
-        sql = self.cursor.mogrify(sql, args)
+    @classmethod
+    def reroot_cross(cls, driving: str, names: list, bridging: dict, rows: dict):
+        ''' 执行跨库（连接）查询 - 以 driving 为主查询，重新生成关联关系（仅限 INNER JOIN）
 
-        operation = sql.split(' ')[0].strip().lower()
+        :return (查询顺序, bridging)，关联关系不连通时返回原计划
+        '''
 
-        if operation in ['insert', 'replace', 'update', 'delete', 'truncate', 'create', 'drop', 'alter']:
-            with transaction.atomic(self.conn):
-                self.cursor.execute(sql)
+        # 关联关系（无向）：(连接, 字段, 连接, 字段, 连接键)
+        edges = []
+        for name, (join_type, join_condition) in bridging.items():
+            for alias, field, left_name, left_field in join_condition:
+                edges.append((left_name, left_field, name, field, alias))
 
-                # 记录SQL信息
-                cache_data['last_sql'] = sql
-                cache_data['last_operation'] = operation
-                cache_data['last_insert_id'] = self.conn.insert_id()
-                cache_data['effected_rows'] = self.cursor.rowcount
+        order = [driving]
+        result = dict()
 
-                thread_lock.release()
-                return cache_data['last_insert_id'] if operation == 'insert' else cache_data['effected_rows']
-        else:
-            try:
-                self.cursor.execute(sql)
-            except Exception as e:
-                # 释放锁
-                thread_lock.release()
-                raise e
+        while len(order) < len(names):
+            # 与已查询的连接有关联的连接
+            candidates = dict()
+            for left_name, left_field, right_name, right_field, alias in edges:
+                if left_name in order and right_name not in order:
+                    candidates.setdefault(right_name, []).append([alias, right_field, left_name, left_field])
+                elif right_name in order and left_name not in order:
+                    candidates.setdefault(left_name, []).append([alias, left_field, right_name, right_field])
 
-            # 记录SQL信息
-            self.raw_sql = sql
-            cache_data['last_operation'] = 'select'
-            cache_data['last_sql'] = sql
-            
-            if fetch is False:
-                result = self
-            else:
-                result = self.cursor.fetchall()
+            if len(candidates) == 0:
+                return names, bridging
+
+            name = min(candidates.keys(), key=lambda x: rows.get(x))
+            result[name] = ('INNER', candidates.get(name))
+            order.append(name)
 
-            thread_lock.release()
-            return result
+        return order, result
 
     @classmethod
-    def execute_cross(cls, sql: str, chunk_size=500):
-        ''' 执行跨库（连接）查询
+    def submit_cross_chunk(cls, executor, rows: list, sql_list: dict, bridging: dict, names: list):
+        ''' 执行跨库（连接）查询 - 提交块的关联查询
 
-        :param sql
-        :return generator
+        关联字段都已在行中的连接同时查询；关联字段来自其他关联查询的连接，在其合并后再查询
+
+        :return {name: future}
         '''
-        
-        sql_list, bridging, column_alias = dqlparse.DqlParse().split_sql(sql)
-        
-        # 需要的字段
-        needs = {key: '' for key in column_alias}
 
-        flag = True
-        for name, sql in sql_list.items():
-            if flag is True:
-                flag = False
-                cursor = imysql.switch(name).execute(sql).all()
+        ready = [x for x in names if all(t[0] in rows[0] for t in bridging.get(x)[1])] or names[0:1]
+        futures = dict()
 
-                if len(sql_list) == 1:
-                    yield cursor
-                    break
-            else:
-                join_type, join_condition = bridging.get(name)
+        for name in ready:
+            sql, args = cls.gen_cross_lookup(sql_list.get(name), bridging.get(name)[1], rows)
+            # 在调用方的上下文中执行（事务中固定的连接、sticky 作用域）
+            futures[name] = executor.submit(contextvars.copy_context().run, lambda name, sql, args: imysql.switch(name).execute(sql, args, fetch=True), name, sql, args)
 
-                chunk = dict()
-                codes_mapping = dict()
-
-                for item in cursor:
-                    keys = []
-                    for t in join_condition:
-                        value = str(item.get(t[0]))
-                        keys.append(value)
-                        if t[0] not in codes_mapping:
-                            codes_mapping[t[0]] = []
-                        codes_mapping[t[0]].append(value)
-                    unique_key = '_'.join(keys)
-                    chunk[unique_key] = item
-                    
-                    if len(chunk) == chunk_size:
-                        yield cls.handle_cross_chunk(needs, chunk, codes_mapping, sql, join_type, join_condition, name)
-                        chunk.clear()
-                        codes_mapping.clear()
-
-                if len(chunk) > 0:
-                    yield cls.handle_cross_chunk(needs, chunk, codes_mapping, sql, join_type, join_condition, name)
-                    chunk.clear()
-                    codes_mapping.clear()
-
-    @classmethod
-    def handle_cross_chunk(cls, needs: dict, chunk: dict, codes_mapping: dict, sql: str, join_type: str, join_condition: list, name: str):
-        ''' 执行跨库（连接）查询 - 块处理 '''
+        return futures
+
+    @classmethod
+    def gen_cross_lookup(cls, sql: str, join_condition: list, rows: list):
+        ''' 执行跨库（连接）查询 - 生成块的关联查询，关联字段的值（去重，不含 NULL）使用 %s 占位
+
+        :return (sql, args)
+        '''
+
+        sql = sql.replace('%', '%%')
+        args = []
 
         for t in join_condition:
-            codes = "','".join(codes_mapping.get(t[0]))
-            sql += f" AND {t[1]} IN ('{codes}')"
+            codes = list(dict.fromkeys(item.get(t[0]) for item in rows if item.get(t[0]) is not None)) or [None]
+            sql += ' AND {} IN ({})'.format(t[1], ','.join(['%s'] * len(codes)))
+            args.extend(codes)
 
         sql = sql.replace('WHERE 1  AND', 'WHERE')
+        return sql, args
 
-        extra_data = imysql.switch(name).execute(sql).all()
-        
-        extra_mapping = dict()
+    @classmethod
+    def handle_cross_chunk(cls, needs: dict, rows: list, futures: dict, executor, sql_list: dict, bridging: dict, names: list):
+        ''' 执行跨库（连接）查询 - 块处理：哈希连接关联查询的结果
 
-        for item in extra_data:
-            keys = []
-            for t in join_condition:
-                keys.append(str(item.get(t[0])))
-            unique_key = '_'.join(keys)
-            extra_mapping[unique_key] = item
+        关联结果按连接键分桶，一对多、多对多时每个匹配生成一行
 
-        join_type = join_type.upper()
+        :return list
+        '''
 
-        for unique_key, item in chunk.items():
-            extra = extra_mapping.get(unique_key)
-            if extra is not None:
-                chunk[unique_key].update(extra)
+        done = set()
 
+        while True:
+            for name, future in futures.items():
+                join_type, join_condition = bridging.get(name)
+                columns = [t[0] for t in join_condition]
+
+                # 连接键 => 关联的多行
+                buckets = dict()
+                for item in future.result():
+                    key = cls.gen_cross_key(item, columns)
+                    if key is not None:
+                        buckets.setdefault(key, []).append(item)
+
+                joined = []
+                for item in rows:
+                    key = cls.gen_cross_key(item, columns)
+                    matches = buckets.get(key) if key is not None else None
+                    if matches:
+                        for extra in matches:
+                            # 连接键保留主查询的值
+                            out = dict(extra)
+                            out.update(item)
+                            joined.append(out)
+                    elif join_type.upper() == 'LEFT':
+                        joined.append(item)
+                rows = joined
+
+                done.add(name)
+
+            remaining = [x for x in names if x not in done]
+            if len(remaining) == 0 or len(rows) == 0:
+                break
+            futures = cls.submit_cross_chunk(executor, rows, sql_list, bridging, remaining)
+
+        result = []
+        for item in rows:
             # 过滤字段
             out = needs.copy()
-            for k, v in chunk[unique_key].items():
+            for k, v in item.items():
                 if k in needs:
                     out[k] = v
+            result.append(out)
+
+        return result
+
+    @classmethod
+    def gen_cross_key(cls, item: dict, columns: list):
+        ''' 执行跨库（连接）查询 - 连接键
+
+        数字统一为字符串（与 MySQL 比较数字与字符串的结果一致），任一值为 NULL 时返回 None（NULL 不匹配任何值）
 
-            if join_type == 'LEFT':
-                yield out
-            elif join_type in ['RIGHT', 'INNER']:
-                if extra is not None:
-                    yield out
+        :return tuple 或 None
+        '''
+
+        key = []
+        for column in columns:
+            value = item.get(column)
+            if value is None:
+                return None
+            if isinstance(value, (bytes, bytearray)):
+                value = bytes(value).decode('utf8', 'surrogateescape')
+            elif isinstance(value, float) and value.is_integer():
+                value = str(int(value))
+            elif not isinstance(value, str):
+                value = str(value)
+            key.append(value)
+        return tuple(key)
 
     @classmethod
     def gen_table(cls, table: str, alias=''):
@@ -412,21 +1664,23 @@ class imysql:
         return table
 
     def gen_setter(self, data: dict):
-        ''' 处理 SQL SET 部分
+        ''' 处理 SQL SET 部分（值已转义并拼接到 SQL 中）
 
         :param data: 更新的内容
         :return sql
         '''
 
-        s = ''
-        for k, v in data.items():
-            if v is None:
-                s += "`{}`=NULL,".format(k)
-            else:
-                s += "`{}`='{}',".format(k, v)
+        return self.__class__.inline_args(*self.compile_setter(data))
+
+    def compile_setter(self, data: dict):
+        ''' 编译 SQL SET 部分，值使用 %s 占位
+
+        :param data: 更新的内容
+        :return (sql, args)
+        '''
 
-        s = s[0:-1]
-        return s
+        fields = ['`{}`=%s'.format(k.replace('%', '%%')) for k in data.keys()]
+        return ','.join(fields), list(data.values())
 
     def gen_fields(self, data: 'list|dict'):
         ''' 处理 insert_many fields 部分
@@ -462,87 +1716,138 @@ class imysql:
         return values
 
     @classmethod
-    def check_validity(cls, data: 'str|dict|list'):
+    def check_validity(cls, data: 'str|dict|list', validator=None):
         ''' 检查字符串合法性
 
         :param data: 需要验证的内容
+        :param validator: 验证器（Validator），默认使用内置规则
         :return bool
         '''
 
-        if type(data) is str:
-            s = data
-        else:
-            s = json.dumps(data)
+        if not isinstance(validator, Validator):
+            validator = validate.default
 
-        if s == '':
-            return True
-        
-        # 过滤规则
-        filter_rule = "\\<.+javascript:window\\[.{1}\\\\x|<.*=(&#\\d+?;?)+?>|<.*data=data:text\\/html.*>|\\b(alert\\(|confirm\\(|expression\\(|prompt\\(|benchmark\s*?\\(\d+?|sleep\s*?\\([\d\.]+?\\)|load_file\s*?\\()|<[^>]*?\\b(onerror|onmousemove|onload|onclick|onmouseover)\\b|\\b(and|or)\\b\\s*?([\\(\\)'\"\\d]+?=[\\(\\)'\"\\d]+?|[\\(\\)'\"a-zA-Z]+?=[\\(\\)'\"a-zA-Z]+?|>|<|\s+?[\\w]+?\\s+?\\bin\\b\\s*?\(|\\blike\\b\\s+?[\"'])|\\/\\*.+?\\*\\/|<\\s*script\\b|\\bEXEC\\b|UNION.+?SELECT(\\(.+\\)|\\s+?.+?)|UPDATE(\\(.+\\)|\\s+?.+?)SET|INSERT\\s+INTO.+?VALUES|(SELECT|DELETE)(\\(.+\\)|\\s+?|\\s+?.+?\\s+?)FROM(\\(.+\\)|\\s+?.+?)|(CREATE|ALTER|DROP|TRUNCATE)\\s+(TABLE|DATABASE)|(EXTRACTVALUE|UPDATEXML)(\\(.+\\)|\\s+?.+?)"
-        
-        return re.search(filter_rule, s, re.I) is None
+        return validator.check(data)
+
+    @classmethod
+    def inline_args(cls, sql: str, args: 'list|tuple'):
+        ''' 把参数转义后拼接到 SQL 模板中
+
+        :param sql: SQL 模板（%s 占位，% 转义为 %%）
+        :param args: 参数
+        :return sql
+        '''
+
+        return sql % tuple(converters.escape_item(x, 'utf8') for x in args)
 
     @classmethod
     def gen_condition(cls, condition: 'str|dict'):
-        ''' 处理条件
+        ''' 处理条件（值已转义并拼接到 SQL 中，用于拼接原生SQL）
 
         :param condition: 条件，字符串或字典
         :return sql
         '''
 
-        if cls.check_validity(condition) is False:
-            raise exceptions.RuntimeError((403, '筛选条件中包含非法参数'))
+        return cls.inline_args(*cls.compile_condition(condition))
+
+    @classmethod
+    def compile_condition(cls, condition: 'str|dict'):
+        ''' 编译条件，值使用 %s 占位，由驱动统一转义
+
+        :param condition: 条件，字符串或字典
+        :return (sql, args)
+        '''
+
+        shape, args = cls.parse_condition(condition)
+        return cls.render_condition(shape), args
+
+    @classmethod
+    def parse_condition(cls, condition: 'str|dict'):
+        ''' 解析条件的结构及参数（不验证、不拼接SQL，结构相同的条件编译结果相同）
+
+        :param condition: 条件，字符串或字典
+        :return (shape, args)
+        '''
 
         if type(condition) is str:
-            return condition
-        
-        s = ''
+            return ('str', condition), []
+
+        items = []
+        args = []
         if type(condition) is dict:
             for key in condition:
                 operate = '='
                 value = condition[key]
+                placeholder = '%s'
+                # 是否为不使用引号的字段或表达式（需要验证）
+                raw = False
                 if value is None:
                     continue
-                elif type(value) is str:
-                    value = f"'{escape_string(value)}'"
                 elif type(value) is list or type(value) is tuple:
                     operate = value[0].upper()
                     quote = value[2] if len(value) >= 3 else True
                     value = value[1]
-                    
-                    if type(value) is str:
-                        value = escape_string(value)
+
+                    if value is None:
+                        placeholder = 'NULL'
+                    elif type(value) is str:
                         if quote is True:
-                            value = "'{}'".format(escape_string(value))
+                            args.append(value)
+                        else:
+                            # 不使用引号时为字段或表达式，例如：t2.id
+                            placeholder = escape_string(value).replace('%', '%%')
+                            raw = True
                     elif hasattr(value, '__iter__'):
                         if quote is True:
-                            value = [escape_string(str(x)) for x in value]
+                            value = list(value)
                         else:
                             value = [int(x) if str(x).isnumeric() else 0 for x in value]
-                        
+
                         if operate in ['IN', 'NOT IN']:
-                            value = [str(x) for x in value]
-                            if quote is True:
-                                value = "('{}')".format("','".join(value))
+                            if len(value) > 0:
+                                placeholder = '({})'.format(','.join(['%s'] * len(value)))
+                                args.extend(value)
                             else:
-                                value = "({})".format(','.join(value))
+                                placeholder = '(NULL)'
                         elif operate in ['BETWEEN', 'NOT BETWEEN']:
-                            if quote is True:
-                                value = f"'{value[0]}' AND '{value[1]}'"
-                            else:
-                                value = f"{value[0]} AND {value[1]}"
+                            placeholder = '%s AND %s'
+                            args.extend(value[0:2])
+                        else:
+                            args.append(value)
+                    else:
+                        args.append(value)
+                else:
+                    args.append(value)
 
-                if key.find('.') > -1:
-                    key = key.replace('.', '`.`')
+                items.append((key, operate, placeholder, raw))
 
-                if value is None:
-                    value = 'NULL'
-                
-                s += f' AND `{key}` {operate} {value}'
-            
-            s = s[5:]
-        
-        return s
+        return ('dict', tuple(items)), args
+
+    @classmethod
+    def render_condition(cls, shape: tuple):
+        ''' 验证条件结构（字段、操作符、表达式）并生成 SQL 模板
+
+        :param shape: parse_condition 返回的结构
+        :return sql
+        '''
+
+        kind, items = shape
+
+        if kind == 'str':
+            if cls.check_validity(items) is False:
+                raise exceptions.RuntimeError((403, '筛选条件中包含非法参数'))
+            return items.replace('%', '%%')
+
+        checks = [[key, operate, placeholder if raw else ''] for (key, operate, placeholder, raw) in items]
+        if cls.check_validity(checks) is False:
+            raise exceptions.RuntimeError((403, '筛选条件中包含非法参数'))
+
+        conditions = []
+        for key, operate, placeholder, raw in items:
+            key = key.replace('.', '`.`').replace('%', '%%')
+            conditions.append(f'`{key}` {operate} {placeholder}')
+
+        return ' AND '.join(conditions)
 
     @classmethod
     def gen_order_by(cls, by: 'str|list|tuple', ascending: 'bool|list' = True):
@@ -568,7 +1873,7 @@ class imysql:
                 if x.find(' ') > -1:
                     s += f' {x},'
                 else:
-                    if type(ascending) is list:
+                    if isinstance(ascending, (list, tuple)):
                         flag = 'ASC' if ascending[i] else 'DESC'
                     else:
                         flag = 'ASC' if ascending else 'DESC'
@@ -605,15 +1910,7 @@ class imysql:
         :return self
         '''
 
-        if self.__class__.check_validity(fields) is False:
-            raise exceptions.RuntimeError((403, '字段中包含非法字符'))
-
-        if type(fields) is str:
-            self.data['fields'] = fields
-        else:
-            fields = '`,`'.join([x.replace('.', '`.`') for x in fields])
-            self.data['fields'] = '`%s`' % fields
-        
+        self.data['fields'] = fields if type(fields) is str else tuple(fields)
         return self
 
     def join(self, table: str, on: 'str|dict', alias='', how='left'):
@@ -626,15 +1923,8 @@ class imysql:
         :return self
         '''
 
-        if self.data.get('join') is None:
-            self.data['join'] = []
-        
         table = self.__class__.gen_table(table, alias)
-        
-        s = f' {how.upper()} JOIN {table} ON '
-        s += self.__class__.gen_condition(on)
-
-        self.data['join'].append(s)
+        self.data['join'] = self.data.get('join', []) + [(table, on, how.upper())]
 
         return self
 
@@ -645,7 +1935,7 @@ class imysql:
         :return self
         '''
 
-        self.data['where'] = self.__class__.gen_condition(condition)
+        self.data['where'] = [('', condition)]
         return self
 
     def and_where(self, condition: 'str|dict'):
@@ -655,11 +1945,7 @@ class imysql:
         :return self
         '''
 
-        if self.data.get('where'):
-            self.data['where'] = '(%s) AND (%s)' % (self.data.get('where'), self.__class__.gen_condition(condition))
-        else:
-            self.data['where'] = self.__class__.gen_condition(condition)
-        
+        self.data['where'] = self.data.get('where', []) + [('AND', condition)]
         return self
 
     def or_where(self, condition: 'str|dict'):
@@ -669,11 +1955,7 @@ class imysql:
         :return self
         '''
 
-        if self.data.get('where'):
-            self.data['where'] = '(%s) OR (%s)' % (self.data.get('where'), self.__class__.gen_condition(condition))
-        else:
-            self.data['where'] = self.__class__.gen_condition(condition)
-        
+        self.data['where'] = self.data.get('where', []) + [('OR', condition)]
         return self
 
     def group_by(self, group_by: 'str|list|tuple'):
@@ -683,14 +1965,7 @@ class imysql:
         :return self
         '''
 
-        if self.__class__.check_validity(group_by) is False:
-            raise exceptions.RuntimeError((403, '分组条件中包含非法参数'))
-
-        if type(group_by) is str:
-            self.data['group_by'] = group_by
-        else:
-            self.data['group_by'] = ','.join(group_by)
-        
+        self.data['group_by'] = group_by if type(group_by) is str else tuple(group_by)
         return self
 
     def having(self, condition: 'str|dict'):
@@ -700,7 +1975,7 @@ class imysql:
         :return self
         '''
 
-        self.data['having'] = self.__class__.gen_condition(condition)
+        self.data['having'] = condition
         return self
 
     def order_by(self, by: 'str|list', ascending: 'bool|list' = True):
@@ -711,8 +1986,10 @@ class imysql:
         :return sql
         '''
 
-        self.data['order_by'] = self.__class__.gen_order_by(by, ascending)
-        
+        by = by if type(by) is str or by is None else tuple(by)
+        ascending = tuple(ascending) if type(ascending) is list else ascending
+        self.data['order_by'] = (by, ascending)
+
         return self
 
     def skip(self, num: int):
@@ -728,60 +2005,432 @@ class imysql:
         self.data['skip'] = num
         return self
 
-    def limit(self, num: int):
-        ''' 分页
+    def limit(self, num: int):
+        ''' 分页
+
+        :param num: 分页大小
+        :return self
+        '''
+
+        if num < 0:
+            raise exceptions.RuntimeError((400, 'limit: num 须大于等于0'))
+        
+        self.data['limit'] = num
+        
+        return self
+
+    def cache(self, ttl=60, shared=False):
+        ''' 缓存查询结果（all、one、scalar、column、count、index），表被写入时缓存失效
+
+        :param ttl: 过期时间（秒），None：不过期（直到表被写入或被淘汰）
+        :param shared: 是否使用跨进程共享的缓存（须先调用 imysql.use_shared_cache）
+        :return self
+        '''
+
+        if ttl is not None and ttl <= 0:
+            raise exceptions.RuntimeError((400, 'cache: ttl 须大于0'))
+
+        if shared is True and shared_cache is None:
+            raise exceptions.RuntimeError((400, '请先调用 imysql.use_shared_cache 开启共享缓存'))
+
+        self.data['cache'] = (ttl, shared)
+        return self
+
+    def compile(self, wrapper=''):
+        ''' 编译查询，值使用 %s 占位
+
+        按查询结构（表、字段、联表、条件的字段及操作符、排序、分页等）缓存 SQL 模板，
+        结构相同的查询只解析参数，不再验证及拼接SQL
+
+        :param wrapper: 外层 SQL，例如：SELECT COUNT(*) AS ct FROM (%s) t
+        :return (sql, args)
+        '''
+
+        if self.raw_sql != '':
+            return self.raw_sql.replace('%', '%%'), []
+
+        key, args = self.parse(wrapper)
+
+        sql = query_cache.get(key)
+        if sql is None:
+            sql = self.__class__.render(key)
+            query_cache.set(key, sql)
+
+        return sql, args
+
+    def parse(self, wrapper=''):
+        ''' 解析查询的结构及参数
+
+        :param wrapper: 外层 SQL
+        :return (shape, args)
+        '''
+
+        cls = self.__class__
+        data = self.data
+        args = []
+
+        joins = []
+        for table, on, how in data.get('join', []):
+            shape, _args = cls.parse_condition(on)
+            joins.append((table, shape, how))
+            args += _args
+
+        wheres = []
+        for glue, condition in data.get('where', []):
+            shape, _args = cls.parse_condition(condition)
+            wheres.append((glue, shape))
+            args += _args
+
+        seek = data.get('seek')
+        if seek is not None:
+            keys, values, ascending = seek
+            seek = (tuple(keys), ascending)
+            args += cls.seek_args(values)
+
+        having = data.get('having')
+        if having is not None:
+            having, _args = cls.parse_condition(having)
+            args += _args
+
+        skip = data.get('skip', 0)
+        limit = data.get('limit', 0)
+        if limit > 0:
+            if skip > 0:
+                args.append(skip)
+            args.append(limit)
+
+        shape = (
+            data.get('table'),
+            data.get('fields', '*'),
+            tuple(joins),
+            tuple(wheres),
+            seek,
+            data.get('group_by'),
+            having,
+            data.get('order_by'),
+            skip > 0 and limit > 0,
+            limit > 0,
+            wrapper,
+        )
+
+        return shape, args
+
+    @classmethod
+    def render(cls, shape: tuple):
+        ''' 验证查询结构并生成 SQL 模板
+
+        :param shape: parse 返回的结构
+        :return sql
+        '''
+
+        table, fields, joins, wheres, seek, group_by, having, order_by, has_skip, has_limit, wrapper = shape
+
+        if cls.check_validity(fields) is False:
+            raise exceptions.RuntimeError((403, '字段中包含非法字符'))
+
+        if type(fields) is not str:
+            fields = '`%s`' % '`,`'.join([x.replace('.', '`.`') for x in fields])
+
+        sql = 'SELECT {} FROM {}'.format(fields.replace('%', '%%'), table)
+
+        for table, condition, how in joins:
+            sql += f' {how} JOIN {table} ON ' + cls.render_condition(condition)
+
+        where = ''
+        for glue, condition in wheres:
+            condition = cls.render_condition(condition)
+            if where and glue:
+                where = f'({where}) {glue} ({condition})'
+            else:
+                where = condition
+
+        if seek is not None:
+            condition = cls.render_seek_condition(*seek)
+            where = f'({where}) AND ({condition})' if where else condition
+
+        if where:
+            sql += ' WHERE ' + where
+
+        if group_by:
+            if cls.check_validity(group_by) is False:
+                raise exceptions.RuntimeError((403, '分组条件中包含非法参数'))
+            if type(group_by) is not str:
+                group_by = ','.join(group_by)
+            sql += ' GROUP BY ' + group_by.replace('%', '%%')
+
+        if having is not None:
+            having = cls.render_condition(having)
+            if having:
+                sql += ' HAVING ' + having
+
+        if order_by is not None:
+            sql += cls.gen_order_by(*order_by).replace('%', '%%')
+
+        if has_limit:
+            sql += ' LIMIT %s,%s' if has_skip else ' LIMIT %s'
+
+        if wrapper != '':
+            sql = wrapper % sql
+
+        return sql
+
+    @classmethod
+    def get_query_cache_stats(cls):
+        ''' 获取查询构建器编译缓存的统计信息
+
+        :return dict，hits：命中次数，misses：未命中次数，hit_rate：命中率，size：缓存数量，maxsize：最大缓存数量
+        '''
+
+        return query_cache.stats()
+
+    @classmethod
+    def set_query_cache_size(cls, maxsize: int):
+        ''' 设置查询构建器编译缓存的最大数量，0：不缓存 '''
+
+        query_cache.resize(maxsize)
+
+    @classmethod
+    def use_shared_cache(cls, path=None, size=64 * 1024 * 1024, slots=65536):
+        ''' 开启跨进程共享的查询结果缓存（同一主机的所有进程使用同一个文件，参数须相同）
+
+        :param path: 共享内存文件，须为当前用户所有且其他用户不可读写；默认：/dev/shm/chain_pymysql.<uid>.cache
+        :param size: 数据区大小（字节），写满后覆盖最早的缓存
+        :param slots: 槽位数（最大缓存数量）
+        '''
+
+        global shared_cache
+
+        from .shm import SharedResultCache
+
+        if path is None:
+            path = f'/dev/shm/chain_pymysql.{os.getuid()}.cache'
+        if shared_cache is not None:
+            shared_cache.close()
+        shared_cache = SharedResultCache(path, size=size, slots=slots)
+
+    @classmethod
+    def get_result_cache_stats(cls, shared=False):
+        ''' 获取查询结果缓存的统计信息
+
+        :param shared: 是否为共享缓存
+        :return dict，字段同 get_query_cache_stats，另有 evictions：淘汰次数，expirations：过期次数，invalidations：写入失效次数；
+                共享缓存另有 used：已使用的字节数，maxsize：数据区大小，slots：槽位数
+        '''
+
+        if shared is True:
+            if shared_cache is None:
+                raise exceptions.RuntimeError((400, '请先调用 imysql.use_shared_cache 开启共享缓存'))
+            return shared_cache.stats()
+
+        return result_cache.stats()
+
+    @classmethod
+    def set_result_cache_size(cls, maxsize: int):
+        ''' 设置查询结果缓存的最大数量，0：不缓存 '''
+
+        result_cache.resize(maxsize)
+
+    @classmethod
+    def clear_result_cache(cls, tables: 'str|list|tuple' = None):
+        ''' 清空查询结果缓存（例如其他进程写入了表）
+
+        :param tables: 表名，None：清空所有缓存
+        '''
+
+        if tables is None:
+            result_cache.clear()
+            if shared_cache is not None:
+                shared_cache.clear()
+        else:
+            tables = [tables] if type(tables) is str else tables
+            invalidate_tables(frozenset(x.split('.')[-1].strip('`').lower() for x in tables))
+
+    @classmethod
+    def get_plan_cache_stats(cls):
+        ''' 获取跨库查询执行计划缓存的统计信息（字段同 get_query_cache_stats） '''
+
+        from . import dqlparse
+
+        return dqlparse.plan_cache.stats()
+
+    @classmethod
+    def set_plan_cache_size(cls, maxsize: int):
+        ''' 设置跨库查询执行计划（及估算行数）缓存的最大数量，0：不缓存 '''
+
+        from . import dqlparse
+
+        dqlparse.plan_cache.resize(maxsize)
+        dqlparse.rows_cache.resize(maxsize)
+
+    def get_raw_sql(self, wrapper=''):
+        ''' 获取原生 SQL（值已转义并拼接到 SQL 中） '''
+
+        if self.raw_sql != '':
+            return self.raw_sql
+
+        sql = self.__class__.inline_args(*self.compile(wrapper))
+
+        # 记录SQL信息
+        set_last_query(last_sql=sql, last_operation='select')
+
+        self.raw_sql = sql
+
+        return sql
+
+    @classmethod
+    def render_seek_condition(cls, keys: tuple, ascending=True):
+        ''' 生成游标分页（keyset）条件，复合键展开为：a > x OR (a = x AND b > y)
+
+        :param keys: 排序键
+        :param ascending: 是否升序
+        :return sql
+        '''
+
+        operate = '>' if ascending else '<'
+        fields = ['`{}`'.format(key.replace('.', '`.`')) for key in keys]
+
+        conditions = []
+        for i in range(len(fields)):
+            parts = [f'{fields[j]} = %s' for j in range(i)]
+            parts.append(f'{fields[i]} {operate} %s')
+            conditions.append(' AND '.join(parts))
+
+        if len(conditions) == 1:
+            return conditions[0]
+        return ' OR '.join(f'({x})' for x in conditions)
+
+    @classmethod
+    def seek_args(cls, values: list):
+        ''' 游标分页（keyset）条件的参数，顺序与 render_seek_condition 一致 '''
+
+        args = []
+        for i in range(len(values)):
+            args.extend(values[0:i + 1])
+        return args
+
+    @classmethod
+    def gen_page_token(cls, keys: list, values: list):
+        ''' 生成下一页的 token '''
+
+        s = json.dumps({'k': keys, 'v': values}, default=str, separators=(',', ':'))
+        return base64.urlsafe_b64encode(s.encode('utf8')).decode('ascii').rstrip('=')
+
+    @classmethod
+    def parse_page_token(cls, keys: list, token: str):
+        ''' 解析 token，返回上一页最后一行的键值 '''
+
+        try:
+            s = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf8')
+            data = json.loads(s)
+            values = data['v']
+        except Exception:
+            raise exceptions.RuntimeError((400, '分页 token 无效'))
+
+        if data.get('k') != keys or type(values) is not list or len(values) != len(keys):
+            raise exceptions.RuntimeError((400, '分页 token 与排序键不匹配'))
+
+        return values
+
+    def _seek(self, keys: list, size: int, last=None, ascending=True):
+        ''' 设置游标分页（keyset）的查询条件、排序及分页
+
+        :param keys: 排序键
+        :param size: 每页行数
+        :param last: 上一页最后一行的键值，None：第一页
+        :param ascending: 是否升序
+        '''
+
+        if last is not None:
+            self.data['seek'] = (keys, last, ascending)
+
+        self.data['order_by'] = (tuple(keys), ascending)
+        self.data['skip'] = 0
+        self.data['limit'] = size
+
+    def _seek_keys(self, key: 'str|list|tuple', size: int):
+        ''' 检查排序键及每页行数，返回排序键列表 '''
+
+        if size < 1:
+            raise exceptions.RuntimeError((400, 'size 须大于0'))
+
+        keys = [key] if type(key) is str else list(key)
+        if len(keys) == 0 or any(re.search(r'[^\w.]', x) for x in keys):
+            raise exceptions.RuntimeError((403, '排序键中包含非法参数'))
+
+        return keys
+
+    @classmethod
+    def get_seek_values(cls, keys: list, row: dict):
+        ''' 获取一行的键值（查询字段中须包含排序键） '''
+
+        values = []
+        for key in keys:
+            column = key.split('.')[-1]
+            if column not in row:
+                raise exceptions.RuntimeError((400, f'查询字段中须包含排序键：{key}'))
+            values.append(row.get(column))
+        return values
 
-        :param num: 分页大小
-        :return self
+    def chunk_by(self, key: 'str|list|tuple' = 'id', size=1000, ascending=True):
+        ''' 按键分块遍历（keyset 分页：WHERE key > 上一块最后的值 ORDER BY key LIMIT size），每块耗时不随遍历深度增加
+
+        :param key: 排序键（须唯一，通常为主键），复合键可传 list
+        :param size: 每块的行数
+        :param ascending: 是否升序，默认 True
+        :return generator
         '''
 
-        if num < 0:
-            raise exceptions.RuntimeError((400, 'limit: num 须大于等于0'))
-        
-        self.data['limit'] = num
-        
-        return self
+        keys = self._seek_keys(key, size)
+        data = dict(self.data)
+        last = None
 
-    def get_raw_sql(self, wrapper=''):
-        ''' 获取原生 SQL '''
+        while True:
+            self.data = dict(data)
+            self._seek(keys, size, last, ascending)
+            rows = self.all(fetch=True)
 
-        if self.raw_sql != '':
-            return self.raw_sql
+            if len(rows) > 0:
+                yield rows
+            if len(rows) < size:
+                break
 
-        table = self.data.get('table')
-        fields = self.data.get('fields', '*')
-        
-        sql = f'SELECT {fields} FROM {table}'
+            last = self.__class__.get_seek_values(keys, rows[-1])
 
-        if self.data.get('join'):
-            sql += ''.join(self.data.get('join'))
+    def scan(self, key: 'str|list|tuple' = 'id', batch_size=1000, ascending=True):
+        ''' 按键逐行遍历全表（keyset 分页）
 
-        if self.data.get('where'):
-            sql += ' WHERE ' + self.data.get('where')
+        :param key: 排序键（须唯一，通常为主键），复合键可传 list
+        :param batch_size: 每批查询的行数
+        :param ascending: 是否升序，默认 True
+        :return generator
+        '''
 
-        if self.data.get('group_by'):
-            sql += ' GROUP BY ' + self.data.get('group_by')
+        for rows in self.chunk_by(key, batch_size, ascending):
+            yield from rows
 
-        if self.data.get('having'):
-            sql += ' HAVING ' + self.data.get('having')
+    def paginate(self, key: 'str|list|tuple' = 'id', size=20, token=None, ascending=True):
+        ''' 游标分页（keyset），适用于 API 分页
 
-        if self.data.get('order_by'):
-            sql += self.data.get('order_by')
+        :param key: 排序键（须唯一，通常为主键），复合键可传 list
+        :param size: 每页行数
+        :param token: 上一次返回的 next_token，None：第一页
+        :param ascending: 是否升序，默认 True
+        :return dict，items：本页数据，next_token：下一页的 token（没有下一页时为 None）
+        '''
 
-        skip = self.data.get('skip', 0)
-        limit = self.data.get('limit', 0)
-        sql += self.__class__.gen_limit(skip, limit)
+        keys = self._seek_keys(key, size)
+        last = self.__class__.parse_page_token(keys, token) if token else None
 
-        if wrapper != '':
-            sql = wrapper % sql
-        
-        # 记录SQL信息
-        cache_data['last_operation'] = 'select'
-        cache_data['last_sql'] = sql
+        # 多查一行，用于判断是否有下一页
+        self._seek(keys, size + 1, last, ascending)
+        rows = self.all(fetch=True)
 
-        self.raw_sql = sql
+        next_token = None
+        if len(rows) > size:
+            rows = rows[0:size]
+            next_token = self.__class__.gen_page_token(keys, self.__class__.get_seek_values(keys, rows[-1]))
 
-        return sql
+        return {'items': rows, 'next_token': next_token}
 
     def reset_data(self):
         ''' 重置数据 '''
@@ -789,15 +2438,24 @@ class imysql:
         self.data = dict()
         self.raw_sql = ''
 
-    def all(self, fetch=False):
+    def all(self, fetch=False, stream=False):
         ''' 查询多行
 
         :param fetch: fetch结果，默认 False
-        :return cursor 或 result
+        :param stream: 是否流式读取（服务端游标），默认 False
+        :return cursor、result 或 StreamResult（开启 cache 时返回 result）
         '''
 
-        sql = self.get_raw_sql()
-        self._execute(sql)
+        sql, args = self.compile()
+
+        if stream is True:
+            self.reset_data()
+            return self._execute(sql, args, stream=True)
+
+        if 'cache' in self.data:
+            return self._cached(sql, args)
+
+        self._execute(sql, args)
         self.reset_data()
 
         if fetch is True:
@@ -805,6 +2463,18 @@ class imysql:
         else:
             return self.cursor
 
+    def iter_chunks(self, size=1000):
+        ''' 流式分块查询（服务端游标）
+
+        :param size: 每块的行数
+        :return generator
+        '''
+
+        if size < 1:
+            raise exceptions.RuntimeError((400, 'iter_chunks: size 须大于0'))
+
+        return self.all(stream=True).chunks(size)
+
     def index(self, key: str, value=None):
         ''' 查询结果用key索引
 
@@ -829,8 +2499,13 @@ class imysql:
         self.skip(num=0)
         self.limit(num=1)
 
-        sql = self.get_raw_sql()
-        self._execute(sql)
+        sql, args = self.compile()
+
+        if 'cache' in self.data:
+            results = self._cached(sql, args)
+            return results[0] if len(results) > 0 else None
+
+        self._execute(sql, args)
         self.reset_data()
 
         return self.cursor.fetchone()
@@ -864,60 +2539,436 @@ class imysql:
         else:
             self.data['fields'] = 'count(*) as ct'
         
-        sql = self.get_raw_sql(wrapper)
-        self._execute(sql)
+        sql, args = self.compile(wrapper)
+
+        if 'cache' in self.data:
+            results = self._cached(sql, args)
+            return results[0].get('ct') if len(results) > 0 else False
+
+        self._execute(sql, args)
         self.reset_data()
         one = self.cursor.fetchone()
         return one.get('ct') if one else False
 
-    def insert_many(self, data: list, return_insert_id=False, verify=True):
+    def _cached(self, sql: str, args: list):
+        ''' 查询结果缓存：命中时直接返回，否则查询并缓存（事务中不使用缓存）
+
+        :return result（每次返回新的 list 及 dict，修改不影响缓存）
+        '''
+
+        ttl, shared = self.data.get('cache')
+        cache = shared_cache if shared is True else result_cache
+        self.reset_data()
+
+        name = self.name or default_name
+        key = (name, self.db_name, sql, tuple(args))
+        try:
+            hash(key)
+        except TypeError:
+            key = None
+
+        if key is None or get_pinned().get(name) is not None:
+            return self._execute(sql, args, fetch=True)
+
+        results = cache.get(key)
+        if results is None:
+            tables = get_tables(sql)
+            version = cache.version(tables)
+            results = self._execute(sql, args, fetch=True)
+            cache.set(key, tuple(results) if cache is result_cache else results, ttl, tables, version)
+            return [dict(x) for x in results]
+
+        # 共享缓存每次解码出新的对象
+        return results if cache is shared_cache else [dict(x) for x in results]
+
+    def insert_many(self, data: 'list|dict|iterable', return_insert_id=False, verify=True, batch_size=1000, commit_every=0, progress=None):
         ''' 批量插入数据
 
-        :param data: 插入的数据，dict 或 list
+        多行合并为一条 INSERT 语句，每条语句不超过 batch_size 行及服务器的 max_allowed_packet；
+        data 可以是生成器，边读取边插入，内存占用不随数据量增加
+
+        :param data: 插入的数据，dict、list 或 可迭代对象（每行的字段须一致）
         :param return_insert_id: 返回插入的ID，默认 False
-        :param verify: 是否验证数据合法性，默认 True
+        :param verify: 是否验证数据合法性，默认 True，也可传入验证器（Validator）
+        :param batch_size: 每条 INSERT 语句的最大行数，默认 1000
+        :param commit_every: 每插入多少条语句提交一次事务，默认 0：全部插入后再提交（在事务中调用时不分批提交）
+        :param progress: 进度回调，每插入一条语句调用一次：progress(已插入的行数)
         :return 影响行数，当 return_insert_id = True 时，返回 insert_id
         '''
 
-        if verify is True and self.__class__.check_validity(data) is False:
-            raise exceptions.RuntimeError((403, '插入内容中包含非法字符'))
+        if batch_size < 1:
+            raise exceptions.RuntimeError((400, 'batch_size 须大于0'))
 
-        # 加线程锁
-        thread_lock.acquire(timeout=locked_timeout)
+        if type(data) is dict:
+            data = [data]
 
-        # 开启事务处理
-        with transaction.atomic(self.conn):
+        rows = iter(data)
+        first = next(rows, None)
+        if first is None:
+            return 0
+
+        fields = list(first.keys())
+        head = 'INSERT INTO {} {} VALUES '.format(self.data.get('table'), self.gen_fields(first))
+        stats = {'rows': 0, 'effected_rows': 0, 'insert_id': 0}
+
+        self._write_rows(head, '', fields, itertools.chain([first], rows), verify, batch_size, commit_every, progress, stats)
+
+        sql = head + '({})'.format(','.join(['%s'] * len(fields)))
+        # 记录SQL信息
+        set_last_query(last_operation='insert', last_sql=sql, effected_rows=stats['effected_rows'], last_insert_id=stats['insert_id'])
+        # 返回插入的ID或影响的行数
+        return stats['insert_id'] if return_insert_id else stats['effected_rows']
+
+    def upsert_many(self, data: 'list|dict|iterable', update_fields: 'list|tuple' = None, increment_fields: 'list|tuple' = None, verify=True, batch_size=1000, commit_every=0, progress=None):
+        ''' 批量插入或更新数据（INSERT ... ON DUPLICATE KEY UPDATE），主键/唯一键重复时更新
+
+        多行合并为一条语句，分批方式同 insert_many
+
+        :param data: 数据，dict、list 或 可迭代对象（每行的字段须一致）
+        :param update_fields: 重复时更新的字段（更新为新值），默认：除 increment_fields 外的所有字段
+        :param increment_fields: 重复时累加的字段（原值 + 新值）
+        :param verify: 是否验证数据合法性，默认 True，也可传入验证器（Validator）
+        :param batch_size: 每条语句的最大行数，默认 1000
+        :param commit_every: 每执行多少条语句提交一次事务，默认 0：全部执行后再提交（在事务中调用时不分批提交）
+        :param progress: 进度回调，每执行一条语句调用一次：progress(已处理的行数)
+        :return dict，inserted：插入的行数，updated：更新的行数，unchanged：重复但值未改变的行数
+        '''
+
+        if batch_size < 1:
+            raise exceptions.RuntimeError((400, 'batch_size 须大于0'))
+
+        if type(data) is dict:
+            data = [data]
+
+        rows = iter(data)
+        first = next(rows, None)
+        if first is None:
+            return {'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+        fields = list(first.keys())
+        head = 'INSERT INTO {} {} VALUES '.format(self.data.get('table'), self.gen_fields(first))
+        tail = self.__class__.gen_upsert_setter(fields, update_fields, increment_fields)
+        stats = {'rows': 0, 'effected_rows': 0, 'insert_id': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+        self._write_rows(head, tail, fields, itertools.chain([first], rows), verify, batch_size, commit_every, progress, stats)
+
+        sql = head + '({})'.format(','.join(['%s'] * len(fields))) + tail
+        # 记录SQL信息
+        set_last_query(last_operation='upsert', last_sql=sql, effected_rows=stats['effected_rows'], last_insert_id=stats['insert_id'])
+        return {'inserted': stats['inserted'], 'updated': stats['updated'], 'unchanged': stats['unchanged']}
+
+    @classmethod
+    def gen_upsert_setter(cls, fields: list, update_fields: 'list|tuple' = None, increment_fields: 'list|tuple' = None):
+        ''' 处理 ON DUPLICATE KEY UPDATE 部分
+
+        :param fields: 插入的字段
+        :param update_fields: 更新为新值的字段
+        :param increment_fields: 累加的字段
+        :return sql
+        '''
+
+        increment_fields = list(increment_fields or [])
+        if update_fields is None:
+            update_fields = [x for x in fields if x not in increment_fields]
+
+        if any(x not in fields for x in itertools.chain(update_fields, increment_fields)):
+            raise exceptions.RuntimeError((400, '更新的字段须包含在插入的数据中'))
+
+        setter = ['`{0}`=VALUES(`{0}`)'.format(x) for x in update_fields]
+        setter += ['`{0}`=`{0}`+VALUES(`{0}`)'.format(x) for x in increment_fields]
+
+        if len(setter) == 0:
+            raise exceptions.RuntimeError((400, 'update_fields 和 increment_fields 不能都为空'))
+
+        return ' ON DUPLICATE KEY UPDATE ' + ','.join(setter)
+
+    @classmethod
+    def count_upserted(cls, conn, rows: int, effected_rows: int, message=None):
+        ''' 统计一条 INSERT ... ON DUPLICATE KEY UPDATE 语句插入、更新及未改变的行数
+
+        影响行数：插入的行计 1，更新的行计 2，未改变的行计 0（连接开启 FOUND_ROWS 时计 1）；
+        多行语句的服务器信息中有重复的行数，例如：Records: 3  Duplicates: 1  Warnings: 0
+
+        :param conn: 连接
+        :param rows: 语句的行数
+        :param effected_rows: 影响行数
+        :param message: 服务器信息
+        :return (inserted, updated, unchanged)
+        '''
+
+        info = cls.parse_info(message)
+        found_rows = getattr(conn, 'client_flag', 0) & CLIENT.FOUND_ROWS
+
+        if 'Duplicates' in info:
+            duplicates = info['Duplicates']
+        elif rows == 1:
+            # 单行语句没有服务器信息
+            duplicates = 0 if effected_rows == 1 else 1
+        else:
+            duplicates = max(effected_rows - rows, 0)
+
+        inserted = rows - duplicates
+        if found_rows:
+            updated = effected_rows - inserted - duplicates
+        else:
+            updated = (effected_rows - inserted) // 2
+        updated = min(max(updated, 0), duplicates)
+
+        return inserted, updated, duplicates - updated
+
+    @classmethod
+    def parse_info(cls, message):
+        ''' 解析服务器返回的信息，例如：Records: 3  Duplicates: 1  Warnings: 0
+
+        :return dict
+        '''
 
-            table = self.data.get('table')
-            fields = self.gen_fields(data)
-            values = self.gen_values(data)
-            types = ['%s' for x in values[0]]
-            placeholder = "(%s)" % (','.join(types))
+        if isinstance(message, (bytes, bytearray)):
+            message = bytes(message).decode('utf8', 'replace')
+        return {k: int(v) for k, v in re.findall(r'(\w+):\s*(\d+)', message or '')}
 
-            sql = f'INSERT INTO {table} {fields} VALUES {placeholder}'
+    def _write_rows(self, head: str, tail: str, fields: list, rows, verify, batch_size: int, commit_every: int, progress, stats: dict):
+        ''' 把多行数据打包为多行语句并执行，每 commit_every 条语句提交一次事务 '''
+
+        with self._borrow() as conn:
+            max_packet = self.get_max_packet(conn)
+            batches = self.pack_rows(conn, head, fields, rows, verify, batch_size, max_packet, tail)
+            self._run_batches(conn, batches, commit_every, stats, progress)
+
+    def _run_batches(self, conn, batches, commit_every: int, stats: dict, progress=None):
+        ''' 开启事务执行多条打包后的语句，每 commit_every 条语句提交一次（0：全部执行后再提交） '''
+
+        while True:
+            # 没有剩余的语句时不再开启事务
+            batch = next(batches, None)
+            if batch is None:
+                break
+            with transaction.atomic(conn):
+                finished = self._execute_batches(conn, itertools.chain([batch], batches), commit_every, stats, progress)
+            if finished:
+                break
+
+    def get_max_packet(self, conn):
+        ''' 单条 SQL 语句的最大字节数（服务器的 max_allowed_packet，缓存在连接池中）
+
+        :param conn: 连接
+        :return int
+        '''
+
+        pool = get_pool(self.name)
+
+        if pool.max_allowed_packet is None:
+            cursor = conn.cursor(pymysql.cursors.DictCursor)
+            cursor.execute('SELECT @@max_allowed_packet AS `size`')
+            pool.max_allowed_packet = int(cursor.fetchone().get('size'))
+            cursor.close()
+
+        # 客户端也会限制包的大小；预留协议头的长度
+        size = min(pool.max_allowed_packet, getattr(conn, 'max_allowed_packet', pool.max_allowed_packet))
+        return size - 64
+
+    def pack_rows(self, conn, head: str, fields: list, rows, verify=True, batch_size=1000, max_packet=1048576, tail=''):
+        ''' 把多行数据打包为多行 INSERT 语句
+
+        :param conn: 连接（用于转义）
+        :param head: 语句开头，例如：INSERT INTO `t` (`a`,`b`) VALUES
+        :param fields: 字段
+        :param rows: 可迭代的多行数据
+        :param verify: 是否验证数据合法性，也可传入验证器（Validator）
+        :param batch_size: 每条语句的最大行数
+        :param max_packet: 每条语句的最大字节数
+        :param tail: 语句结尾，例如：ON DUPLICATE KEY UPDATE ...
+        :return generator：(sql, 行数)
+        '''
+
+        cls = self.__class__
+        encoding = conn.encoding
+        head = head.encode(encoding)
+        tail = tail.encode(encoding)
+        values = []
+        size = len(head) + len(tail)
+
+        for row in rows:
+            if verify is not False and cls.check_validity(row, verify) is False:
+                raise exceptions.RuntimeError((403, '插入内容中包含非法字符'))
+
+            if len(row) != len(fields):
+                raise exceptions.RuntimeError((400, '每行的字段须与第一行一致'))
 
             try:
-                effected_rows = self.cursor.executemany(sql, values)
-            except Exception as e:
-                thread_lock.release()
-                raise e
+                value = '({})'.format(','.join([conn.escape(row[k]) for k in fields]))
+            except KeyError:
+                raise exceptions.RuntimeError((400, '每行的字段须与第一行一致'))
 
-            insert_id = self.conn.insert_id()
-            # 记录SQL信息
-            cache_data['last_operation'] = 'insert'
-            cache_data['last_sql'] = sql
-            cache_data['effected_rows'] = effected_rows
-            cache_data['last_insert_id'] = insert_id
-            # 释放锁
-            thread_lock.release()
-            # 返回插入的ID或影响的行数
-            return insert_id if return_insert_id else effected_rows
+            value = value.encode(encoding, 'surrogateescape')
+
+            if len(head) + len(value) + len(tail) > max_packet:
+                raise exceptions.RuntimeError((400, '单行数据超过 max_allowed_packet'))
+
+            if len(values) >= batch_size or size + len(value) + 1 > max_packet:
+                yield head + b','.join(values) + tail, len(values)
+                values = []
+                size = len(head) + len(tail)
+
+            values.append(value)
+            size += len(value) + 1
+
+        if len(values) > 0:
+            yield head + b','.join(values) + tail, len(values)
+
+    def _execute_batches(self, conn, batches, limit: int, stats: dict, progress=None):
+        ''' 执行多条打包后的语句，执行 limit 条后返回（0：不限制）
+
+        :return bool，是否已全部执行
+        '''
+
+        cls = self.__class__
+        count = 0
+        for sql, rows in batches:
+            effected_rows = self.cursor.execute(sql)
+            invalidate(conn, sql)
+            stats['effected_rows'] += effected_rows
+            stats['insert_id'] = conn.insert_id()
+            stats['rows'] += rows
+
+            # 统计插入、更新的行数（upsert_many）
+            if 'updated' in stats:
+                message = getattr(getattr(self.cursor, '_result', None), 'message', None)
+                for key, val in zip(('inserted', 'updated', 'unchanged'), cls.count_upserted(conn, rows, effected_rows, message)):
+                    stats[key] += val
+
+            if progress is not None:
+                progress(stats['rows'])
+
+            count += 1
+            if limit > 0 and count >= limit:
+                return False
+
+        return True
+
+    def bulk_load(self, source, columns: 'list|tuple|dict' = None, duplicate=None, delimiter=None, enclosure='"', ignore_lines=0, charset=None, line_terminator=None):
+        ''' 批量导入数据（LOAD DATA LOCAL INFILE），适用于大量数据的初始化导入
+
+        数据边读取边发送，不生成临时文件；需在连接参数中开启 local_infile（服务器也须开启 local_infile）；
+        不验证数据合法性（数据不拼接到 SQL 中）
+
+        :param source: 文件路径（CSV/TSV），或 可迭代的多行数据（dict 或 tuple/list，None 导入为 NULL）
+        :param columns: 导入的字段，默认：dict 取第一行的键，tuple/文件按表的字段顺序；
+                        dict 行可传 {键: 字段} 映射
+        :param duplicate: 主键/唯一键重复时的处理，None：默认（LOCAL 时等同于 ignore），ignore：跳过，replace：替换
+        :param delimiter: 文件的字段分隔符，默认：.tsv 为 \\t，其他为 ,
+        :param enclosure: 文件的字段包围符，默认 "
+        :param ignore_lines: 跳过文件开头的行数（例如表头）
+        :param charset: 文件的字符集，默认使用连接的字符集
+        :param line_terminator: 文件的行结束符，默认：按文件开头检测（\\r\\n 或 \\n）
+        :return dict，rows：导入的行数，deleted：替换的行数，skipped：跳过的行数，warnings：警告数
+        '''
+
+        if duplicate not in (None, 'ignore', 'replace'):
+            raise exceptions.RuntimeError((400, 'duplicate 只能是 ignore 或 replace'))
+
+        # 字段：键 => 字段
+        if isinstance(columns, dict):
+            mapping = dict(columns)
+        elif columns is not None:
+            mapping = {k: k for k in columns}
+        else:
+            mapping = None
+
+        is_file = isinstance(source, str)
+        rows = None
+
+        if not is_file:
+            rows = iter([source] if isinstance(source, dict) else source)
+            first = next(rows, None)
+            if first is None:
+                return {'rows': 0, 'deleted': 0, 'skipped': 0, 'warnings': 0}
+            if mapping is None and isinstance(first, dict):
+                mapping = {k: k for k in first.keys()}
+            if mapping is not None and not isinstance(first, dict) and len(first) != len(mapping):
+                raise exceptions.RuntimeError((400, '每行的字段数须与 columns 一致'))
+            rows = itertools.chain([first], rows)
+
+        sql = 'LOAD DATA LOCAL INFILE %s'
+        if duplicate is not None:
+            sql += ' ' + duplicate.upper()
+        sql += ' INTO TABLE ' + self.data.get('table')
+
+        if is_file:
+            if delimiter is None:
+                delimiter = '\t' if source.lower().endswith('.tsv') else ','
+            if charset is not None:
+                sql += ' CHARACTER SET ' + re.sub(r'[^\w]', '', charset)
+            if line_terminator is None:
+                line_terminator = self.__class__.detect_line_terminator(source)
+            sql += " FIELDS TERMINATED BY %s OPTIONALLY ENCLOSED BY %s ESCAPED BY '\\\\' LINES TERMINATED BY %s"
+            args = [source, delimiter, enclosure, line_terminator]
+            if ignore_lines > 0:
+                sql += ' IGNORE {} LINES'.format(int(ignore_lines))
+        else:
+            # 按默认格式编码：字段以 \t 分隔，行以 \n 结尾，NULL 为 \N
+            sql += ' CHARACTER SET utf8mb4'
+            args = [None]
+
+        if mapping is not None:
+            sql += ' ({})'.format(','.join(['`{}`'.format(x.replace('`', '``')) for x in mapping.values()]))
+
+        with self._borrow() as conn:
+            if not getattr(conn, '_local_infile', False):
+                raise exceptions.RuntimeError((400, 'bulk_load 需在连接参数中开启 local_infile'))
+
+            filename = None
+            if not is_file:
+                loader.install()
+                keys = list(mapping.keys()) if mapping is not None else None
+                filename = loader.register(loader.encode_rows(rows, keys))
+                args[0] = filename
+
+            # 开启事务处理
+            try:
+                with transaction.atomic(conn):
+                    effected_rows = self.cursor.execute(sql, args)
+                    invalidate(conn, sql)
+            finally:
+                if filename is not None:
+                    loader.unregister(filename)
+
+            # 服务器返回的信息，例如：Records: 3  Deleted: 0  Skipped: 0  Warnings: 0
+            stats = self.__class__.parse_info(getattr(getattr(conn, '_result', None), 'message', None))
+
+            result = {
+                'rows': stats['Records'] - stats.get('Skipped', 0) if 'Records' in stats else effected_rows,
+                'deleted': stats.get('Deleted', 0),
+                'skipped': stats.get('Skipped', 0),
+                'warnings': self.cursor.warning_count if hasattr(self.cursor, 'warning_count') else int(stats.get('Warnings', 0)),
+            }
+
+        # 记录SQL信息
+        set_last_query(last_operation='load', last_sql=sql, effected_rows=effected_rows)
+        return result
+
+    @classmethod
+    def detect_line_terminator(cls, path: str, size=65536):
+        ''' 按文件开头检测行结束符
+
+        :param path: 文件路径
+        :param size: 读取的字节数
+        :return \\r\\n 或 \\n
+        '''
+
+        try:
+            with open(path, 'rb') as f:
+                head = f.read(size)
+        except OSError:
+            return '\n'
+
+        return '\r\n' if b'\r\n' in head else '\n'
 
     def insert_one(self, data: dict, verify=True):
         ''' 批量插入数据
 
         :param data: 插入的数据，dict 或 list
-        :param verify: 是否验证数据合法性，默认 True
+        :param verify: 是否验证数据合法性，默认 True，也可传入验证器（Validator）
         :return insert_id
         '''
         return self.insert_many([data], return_insert_id=True, verify=verify)
@@ -928,38 +2979,183 @@ class imysql:
         :param condition: 筛选条件，str 或 dict
         :param data: 更新的数据，字典类型
         :param limit: 限制更新的数量，默认 0，不限制
-        :param verify: 是否验证数据合法性，默认 True
+        :param verify: 是否验证数据合法性，默认 True，也可传入验证器（Validator）
         :return 影响行数
         '''
 
-        if verify is True and self.__class__.check_validity(data) is False:
+        if verify is not False and self.__class__.check_validity(data, verify) is False:
             raise exceptions.RuntimeError((403, '更新内容中包含非法字符'))
 
         # 开启事务处理
         with transaction.atomic(self.conn):
-            
-            sql = "UPDATE {table} SET {setter} WHERE {where}{limit}".format(
-                table=self.data.get('table'),
-                setter=self.gen_setter(data),
-                where=self.__class__.gen_condition(condition),
-                limit=" LIMIT " + str(limit) if limit > 0 else ''
-            )
 
-            effected_rows = self._execute(sql)
+            sql, args = self.compile_update(condition, data, limit)
+            effected_rows = self._execute(sql, args)
 
             # 记录SQL信息
-            cache_data['last_operation'] = 'update'
-            cache_data['last_sql'] = sql
-            cache_data['effected_rows'] = effected_rows
+            set_last_query(last_operation='update', effected_rows=effected_rows)
             # 返回影响的行情
             return effected_rows
 
+    def compile_update(self, condition: 'str|dict', data: dict, limit=0):
+        ''' 编译 UPDATE 语句
+
+        :param condition: 筛选条件，str 或 dict
+        :param data: 更新的数据，字典类型
+        :param limit: 限制更新的数量，0：不限制
+        :return (sql, args)
+        '''
+
+        setter, setter_args = self.compile_setter(data)
+        where, where_args = self.__class__.compile_condition(condition)
+
+        sql = "UPDATE {table} SET {setter} WHERE {where}{limit}".format(
+            table=self.data.get('table'),
+            setter=setter,
+            where=where,
+            limit=" LIMIT " + str(int(limit)) if limit > 0 else ''
+        )
+
+        return sql, setter_args + where_args
+
+    def update_batch(self, data: 'list|iterable', key: 'str|list|tuple' = 'id', verify=True, batch_size=1000, progress=None):
+        ''' 按键批量更新多行（每行的值可以不同）
+
+        多行合并为一条语句：UPDATE ... SET col = CASE key WHEN ... THEN ... ELSE col END WHERE key IN (...)，
+        每条语句不超过 batch_size 行及服务器的 max_allowed_packet，每条语句一个事务（在事务中调用时不分批提交）；
+        每行可以只包含部分字段，同一批中键重复时后面的值覆盖前面的值
+
+        :param data: 更新的数据，list 或 可迭代对象，每行须包含键
+        :param key: 键（通常为主键），复合键可传 list
+        :param verify: 是否验证数据合法性，默认 True，也可传入验证器（Validator）
+        :param batch_size: 每条语句的最大行数，默认 1000
+        :param progress: 进度回调，每执行一条语句调用一次：progress(已处理的行数)
+        :return 影响行数
+        '''
+
+        if batch_size < 1:
+            raise exceptions.RuntimeError((400, 'batch_size 须大于0'))
+
+        keys = [key] if type(key) is str else list(key)
+        if len(keys) == 0 or any(re.search(r'[^\w]', x) for x in keys):
+            raise exceptions.RuntimeError((403, '键中包含非法参数'))
+
+        rows = iter([data] if type(data) is dict else data)
+        first = next(rows, None)
+        if first is None:
+            return 0
+
+        stats = {'rows': 0, 'effected_rows': 0, 'insert_id': 0}
+
+        with self._borrow() as conn:
+            max_packet = self.get_max_packet(conn)
+            batches = self.pack_updates(conn, keys, itertools.chain([first], rows), verify, batch_size, max_packet)
+            # 每条语句一个事务
+            self._run_batches(conn, batches, 1, stats, progress)
+
+        placeholders = {tuple(['%s'] * len(keys)): {k: '%s' for k in first.keys() if k not in keys}}
+        # 记录SQL信息
+        set_last_query(last_operation='update', last_sql=self.gen_update_batch(keys, placeholders), effected_rows=stats['effected_rows'])
+        # 返回影响的行数
+        return stats['effected_rows']
+
+    def pack_updates(self, conn, keys: list, rows, verify=True, batch_size=1000, max_packet=1048576):
+        ''' 把多行数据打包为多条 UPDATE ... CASE 语句
+
+        :param conn: 连接（用于转义）
+        :param keys: 键
+        :param rows: 可迭代的多行数据
+        :param verify: 是否验证数据合法性，也可传入验证器（Validator）
+        :param batch_size: 每条语句的最大行数
+        :param max_packet: 每条语句的最大字节数
+        :return generator：(sql, 行数)
+        '''
+
+        cls = self.__class__
+        encoding = conn.encoding
+        # 键 => {字段: 值}（值已转义）
+        chunk = dict()
+        rows_num = 0
+        # 表名、WHERE 等固定部分的长度（估算）
+        base = len(self.data.get('table')) + 64
+        size = base
+
+        for row in rows:
+            if verify is not False and cls.check_validity(row, verify) is False:
+                raise exceptions.RuntimeError((403, '更新内容中包含非法字符'))
+
+            try:
+                key = tuple(conn.escape(row[k]) for k in keys)
+            except KeyError:
+                raise exceptions.RuntimeError((400, '每行须包含键：{}'.format(','.join(keys))))
+
+            values = {k: conn.escape(v) for k, v in row.items() if k not in keys}
+            if len(values) == 0:
+                continue
+
+            # 每个值一个 WHEN ... THEN ...，WHERE IN 中一个键
+            key_size = len(','.join(key).encode(encoding, 'surrogateescape')) + len(keys) * 8 + 4
+            row_size = key_size * (len(values) + 1)
+            row_size += sum(len(v.encode(encoding, 'surrogateescape')) + len(k) * 2 + 32 for k, v in values.items())
+
+            if base + row_size > max_packet:
+                raise exceptions.RuntimeError((400, '单行数据超过 max_allowed_packet'))
+
+            if key not in chunk and (len(chunk) >= batch_size or size + row_size > max_packet):
+                yield self.gen_update_batch(keys, chunk).encode(encoding, 'surrogateescape'), rows_num
+                chunk = dict()
+                rows_num = 0
+                size = base
+
+            chunk.setdefault(key, dict()).update(values)
+            rows_num += 1
+            size += row_size
+
+        if len(chunk) > 0:
+            yield self.gen_update_batch(keys, chunk).encode(encoding, 'surrogateescape'), rows_num
+
+    def gen_update_batch(self, keys: list, chunk: dict):
+        ''' 生成 UPDATE ... CASE 语句
+
+        :param keys: 键
+        :param chunk: 键（已转义的 tuple） => {字段: 值（已转义）}
+        :return sql
+        '''
+
+        # 所有行的字段（按出现顺序）
+        fields = dict()
+        for values in chunk.values():
+            fields.update(dict.fromkeys(values))
+
+        if len(keys) == 1:
+            case = 'CASE `{}`'.format(keys[0])
+            whens = {key: f'WHEN {key[0]}' for key in chunk}
+            where = '`{}` IN ({})'.format(keys[0], ','.join(key[0] for key in chunk))
+        else:
+            case = 'CASE'
+            whens = {key: 'WHEN ' + ' AND '.join(f'`{k}`={v}' for k, v in zip(keys, key)) for key in chunk}
+            where = '({}) IN ({})'.format(
+                ','.join(f'`{k}`' for k in keys),
+                ','.join('({})'.format(','.join(key)) for key in chunk)
+            )
+
+        setter = []
+        for field in fields:
+            cases = ' '.join(f'{whens[key]} THEN {values[field]}' for key, values in chunk.items() if field in values)
+            setter.append(f'`{field}`={case} {cases} ELSE `{field}` END')
+
+        return 'UPDATE {table} SET {setter} WHERE {where}'.format(
+            table=self.data.get('table'),
+            setter=','.join(setter),
+            where=where
+        )
+
     def update_one(self, condition: 'str|dict', data: dict, verify=True):
         ''' 更新一行
 
         :param condition: 筛选条件，str 或 dict
         :param data: 更新的数据，字典类型
-        :param verify: 是否验证数据合法性，默认 True
+        :param verify: 是否验证数据合法性，默认 True，也可传入验证器（Validator）
         :return 影响行数
         '''
         return self.update_many(condition, data, limit=1, verify=verify)
@@ -974,44 +3170,222 @@ class imysql:
 
         # 开启事务处理
         with transaction.atomic(self.conn):
-            
-            sql = "DELETE FROM {table} WHERE {where}{limit}".format(
-                table=self.data.get('table'),
-                where=self.__class__.gen_condition(condition),
-                limit=" LIMIT " + str(limit) if limit > 0 else ''
-            )
-            
-            effected_rows = self._execute(sql)
+
+            sql, args = self.compile_delete(condition, limit)
+            effected_rows = self._execute(sql, args)
 
             # 记录SQL信息
-            cache_data['last_operation'] = 'delete'
-            cache_data['last_sql'] = sql
-            cache_data['effected_rows'] = effected_rows
+            set_last_query(last_operation='delete', effected_rows=effected_rows)
             # 返回影响的行数
             return effected_rows
 
+    def compile_delete(self, condition: 'str|dict', limit=0):
+        ''' 编译 DELETE 语句
+
+        :param condition: 筛选条件，str 或 dict
+        :param limit: 限制删除的数量，0：不限制
+        :return (sql, args)
+        '''
+
+        where, args = self.__class__.compile_condition(condition)
+
+        sql = "DELETE FROM {table} WHERE {where}{limit}".format(
+            table=self.data.get('table'),
+            where=where,
+            limit=" LIMIT " + str(int(limit)) if limit > 0 else ''
+        )
+
+        return sql, args
+
+    def purge(self, condition: 'str|dict' = None, batch_size=1000, sleep_ms=0, max_lag=None, lag_source=None, key: 'str|list|tuple' = 'id', keys=None, progress=None):
+        ''' 分批删除大量数据，每批一个短事务（在事务中调用时不分批提交），避免长时间锁表及主从延迟
+
+        按键遍历符合条件的行（keyset），每批执行 DELETE ... WHERE key IN (...) AND (condition)；
+        也可以直接传入要删除的键列表 keys
+
+        :param condition: 筛选条件，str 或 dict，不传 keys 时不能为空
+        :param batch_size: 每批的行数，默认 1000
+        :param sleep_ms: 每批之间暂停的毫秒数，默认 0
+        :param max_lag: 从库最大延迟（秒），超过时暂停直到延迟恢复，默认 None：不检测
+        :param lag_source: 检测延迟的从库连接名称（str 或 list），或返回延迟秒数的函数
+        :param key: 键（须唯一，通常为主键），复合键可传 list
+        :param keys: 要删除的键列表（可以是生成器），复合键的值为 tuple
+        :param progress: 进度回调，每批调用一次：progress(已删除的行数)
+        :return 影响行数
+        '''
+
+        def compile_batch(where: str, args: list):
+            return 'DELETE FROM {} WHERE {}'.format(self.data.get('table'), where), args
+
+        effected_rows = self._run_in_batches(compile_batch, condition, batch_size, sleep_ms, max_lag, lag_source, key, keys, progress)
+
+        # 记录SQL信息
+        set_last_query(last_operation='delete', effected_rows=effected_rows)
+        return effected_rows
+
+    def backfill(self, condition: 'str|dict', data: dict, batch_size=1000, sleep_ms=0, max_lag=None, lag_source=None, key: 'str|list|tuple' = 'id', keys=None, progress=None, verify=True):
+        ''' 分批更新大量数据，每批一个短事务（在事务中调用时不分批提交），参数同 purge
+
+        :param condition: 筛选条件，str 或 dict，不传 keys 时不能为空
+        :param data: 更新的数据，字典类型
+        :param verify: 是否验证数据合法性，默认 True，也可传入验证器（Validator）
+        :return 影响行数
+        '''
+
+        if verify is not False and self.__class__.check_validity(data, verify) is False:
+            raise exceptions.RuntimeError((403, '更新内容中包含非法字符'))
+
+        setter, setter_args = self.compile_setter(data)
+
+        def compile_batch(where: str, args: list):
+            return 'UPDATE {} SET {} WHERE {}'.format(self.data.get('table'), setter, where), setter_args + args
+
+        effected_rows = self._run_in_batches(compile_batch, condition, batch_size, sleep_ms, max_lag, lag_source, key, keys, progress)
+
+        # 记录SQL信息
+        set_last_query(last_operation='update', effected_rows=effected_rows)
+        return effected_rows
+
+    def _run_in_batches(self, compile_batch, condition, batch_size, sleep_ms, max_lag, lag_source, key, keys, progress):
+        ''' 按键分批执行语句（purge、backfill）
+
+        :param compile_batch: 编译每批的语句：compile_batch(where, args) => (sql, args)
+        :return 影响行数
+        '''
+
+        cls = self.__class__
+        key_names = self._seek_keys(key, batch_size)
+
+        if max_lag is not None and lag_source is None:
+            raise exceptions.RuntimeError((400, '检测从库延迟须指定 lag_source'))
+
+        if condition:
+            cond_sql, cond_args = cls.compile_condition(condition)
+        elif keys is None:
+            raise exceptions.RuntimeError((400, 'condition 和 keys 不能都为空'))
+
+        if keys is not None:
+            keys = iter(keys)
+            batches = iter(lambda: list(itertools.islice(keys, batch_size)), [])
+        else:
+            # 按键遍历符合条件的行，只查询键
+            query = cls(self.name, self.db_name)
+            query.data['table'] = self.data.get('table')
+            query.select(key_names).where(condition)
+            batches = ([cls.get_seek_values(key_names, row) for row in rows] for rows in query.chunk_by(key_names, batch_size))
+
+        effected_rows = 0
+        first = True
+        while True:
+            # 键在主库上查询（读写分离时从库可能有延迟，漏掉刚写入的行），每批的写入不在该作用域中
+            with cls.sticky(self.name or default_name, after_write=False):
+                values = next(batches, None)
+            if values is None:
+                break
+
+            if not first and sleep_ms > 0:
+                time.sleep(sleep_ms / 1000)
+            first = False
+            cls.wait_for_lag(max_lag, lag_source)
+
+            where, args = cls.compile_keys_in(key_names, values)
+            if condition:
+                where += f' AND ({cond_sql})'
+                args += cond_args
+
+            # 每批一个事务
+            with transaction.atomic(self.conn):
+                effected_rows += self._execute(*compile_batch(where, args))
+
+            if progress is not None:
+                progress(effected_rows)
+
+        return effected_rows
+
+    @classmethod
+    def compile_keys_in(cls, keys: list, values: list):
+        ''' 编译 key IN (...) 条件
+
+        :param keys: 键
+        :param values: 键值列表，复合键的值为 tuple/list
+        :return (sql, args)
+        '''
+
+        columns = ['`{}`'.format(x.replace('.', '`.`')) for x in keys]
+
+        if len(keys) == 1:
+            values = [x[0] if isinstance(x, (list, tuple)) else x for x in values]
+            return '{} IN ({})'.format(columns[0], ','.join(['%s'] * len(values))), list(values)
+
+        if any(len(x) != len(keys) for x in values):
+            raise exceptions.RuntimeError((400, '复合键的值须与键一一对应'))
+
+        item = '({})'.format(','.join(['%s'] * len(keys)))
+        sql = '({}) IN ({})'.format(','.join(columns), ','.join([item] * len(values)))
+        return sql, [v for x in values for v in x]
+
+    @classmethod
+    def wait_for_lag(cls, max_lag, lag_source):
+        ''' 从库延迟超过 max_lag 秒时暂停，直到延迟恢复（复制中断时一直等待）
+
+        :param max_lag: 最大延迟（秒），None：不检测
+        :param lag_source: 从库连接名称（str 或 list），或返回延迟秒数的函数
+        '''
+
+        if max_lag is None:
+            return
+
+        while True:
+            lag = cls.get_replica_lag(lag_source)
+            if lag is not None and lag <= max_lag:
+                return
+            time.sleep(1)
+
+    @classmethod
+    def get_replica_lag(cls, lag_source):
+        ''' 获取从库延迟（秒），多个从库时取最大值，复制中断时返回 None
+
+        :param lag_source: 从库连接名称（str 或 list），或返回延迟秒数的函数
+        :return int 或 None
+        '''
+
+        if callable(lag_source):
+            return lag_source()
+
+        names = [lag_source] if type(lag_source) is str else list(lag_source)
+        lags = []
+
+        for name in names:
+            lag = get_pool(name).replica_lag()
+            if lag is None:
+                return None
+            lags.append(lag)
+
+        return max(lags) if len(lags) > 0 else 0
+
     @staticmethod
     def get_last_sql():
-        return cache_data.get('last_sql', '')
+        return last_query.get().get('last_sql', '')
 
     @staticmethod
     def get_insert_id():
-        return cache_data.get('last_insert_id', 0)
+        return last_query.get().get('last_insert_id', 0)
 
     @staticmethod
     def get_effected_rows():
-        return cache_data.get('effected_rows', 0)
+        return last_query.get().get('effected_rows', 0)
 
     @staticmethod
     def close(name=None):
+        global default_name
+
         if name is not None:
             if name in connections:
-                conn = connections.get(name)
-                conn.cursor().close()
-                conn.close()
-                del connections[name]
+                connections.pop(name).close()
+                if name == default_name:
+                    default_name = None
         else:
-            for name, conn in connections.items():
-                conn.cursor().close()
-                conn.close()
+            for name, pool in connections.items():
+                pool.close()
             connections.clear()
+            default_name = None
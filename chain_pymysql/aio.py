@@ -0,0 +1,998 @@
+# chain-pymysql: Easy to use pymysql.
+
+# @link https://github.com/Tiacx/chain-pymysql
+# @copyright Copyright (c) 2022 Tiac
+# @license MIT
+# @author Tiac
+# @since 1.1
+
+import re
+import time
+import asyncio
+import inspect
+import functools
+import itertools
+import contextlib
+import contextvars
+import pymysql
+import aiomysql
+from . import imysql, exceptions, set_last_query, get_tables, invalidate_tables, written_tables, result_cache
+from .pool import is_connection_lost
+
+
+# 连接池集合
+connections = dict()
+# 默认连接名称
+default_name = None
+# 事务中固定使用的连接：name => conn（每个协程独立，只读，修改时整体替换）
+pinned_conns = contextvars.ContextVar('aio_pinned_conns', default=dict())
+# 事务嵌套层级：id(conn) => level（每个协程独立，只读，修改时整体替换）
+transaction_levels = contextvars.ContextVar('aio_transaction_levels', default=dict())
+
+
+def get_pool(name=None):
+    ''' 获取连接池
+
+    :param name: 连接名称，默认为当前默认连接
+    :return aiomysql.Pool
+    '''
+
+    name = name or default_name
+
+    # 如果连接不存在，则报错
+    if name not in connections:
+        raise exceptions.RuntimeError((400, '【%s】连接不存在，请先连接' % name))
+
+    return connections[name]
+
+
+def set_pinned(name: str, conn=None):
+    ''' 固定（conn 为 None 时解除固定）当前协程事务中使用的连接 '''
+
+    pinned = dict(pinned_conns.get())
+    if conn is None:
+        pinned.pop(name, None)
+    else:
+        pinned[name] = conn
+    pinned_conns.set(pinned)
+
+
+def invalidate(conn, sql: str):
+    ''' 写入后使相关表的查询结果缓存失效；事务中写入的表在事务结束时再次失效（同 chain_pymysql.invalidate） '''
+
+    tables = get_tables(sql, write=True)
+    if len(tables) == 0:
+        return
+
+    invalidate_tables(tables)
+
+    if transaction.get_level(conn) > 0:
+        written = dict(written_tables.get())
+        written[id(conn)] = written.get(id(conn), frozenset()) | tables
+        written_tables.set(written)
+
+
+async def acquire(pool):
+    ''' 从连接池借出连接（超时抛出 408 异常）；空闲超过 ping_interval 的连接借出前 ping 检测（断线重连） '''
+
+    try:
+        conn = await asyncio.wait_for(pool.acquire(), pool.acquire_timeout)
+    except asyncio.TimeoutError:
+        raise exceptions.RuntimeError((408, '获取数据库连接超时（连接池已满）'))
+
+    released_at = getattr(conn, 'chain_released_at', None)
+    if released_at is not None and time.monotonic() - released_at < pool.ping_interval:
+        return conn
+
+    try:
+        thread_id = None if conn.closed else conn.thread_id()
+        await conn.ping(reconnect=True)
+        # 重连后会回到连接参数里的数据库
+        if conn.thread_id() != thread_id:
+            conn.chain_db = pool.connect_database
+    except Exception:
+        conn.close()
+        pool.release(conn)
+        raise
+
+    return conn
+
+
+def release(pool, conn):
+    ''' 归还连接，记录归还时间（用于 ping 检测） '''
+
+    conn.chain_released_at = time.monotonic()
+    pool.release(conn)
+
+
+async def use_db(pool, conn, db_name=None):
+    ''' 切换连接使用的数据库（记录在连接上，与当前的数据库相同时不切换，同 ConnectionPool.use_db）
+
+    :param db_name: 使用的数据库，默认为连接池的默认数据库
+    '''
+
+    db_name = db_name or pool.database
+    if db_name and db_name != getattr(conn, 'chain_db', pool.connect_database):
+        await conn.select_db(db_name)
+        conn.chain_db = db_name
+
+
+@contextlib.asynccontextmanager
+async def borrow(name=None, db_name=None):
+    ''' 借出连接，用完自动归还连接池（事务中使用固定的连接）
+
+    :param name: 连接名称，默认为当前默认连接
+    :param db_name: 使用的数据库，默认为连接的默认数据库
+    :return aiomysql.Connection
+    '''
+
+    name = name or default_name
+    pool = get_pool(name)
+    conn = pinned_conns.get().get(name)
+    pinned = conn is not None
+
+    if not pinned:
+        conn = await acquire(pool)
+
+    try:
+        await use_db(pool, conn, db_name)
+        yield conn
+    finally:
+        if not pinned:
+            release(pool, conn)
+
+
+# 异步事务处理
+class transaction:
+
+    def __init__(self, conn=None):
+        # 连接：None（默认连接）、连接名称 或 aiomysql 连接
+        self.conn = conn
+        # 实际使用的连接
+        self.real_conn = None
+        # 由本事务借出并固定的连接：(name, pool)
+        self.pinned = None
+
+    @classmethod
+    def atomic(cls, conn_or_func=None):
+        ''' 原子性事务 '''
+
+        # 上下文管理器
+        if conn_or_func is None or isinstance(conn_or_func, (str, aiomysql.Connection)):
+            return cls(conn=conn_or_func)
+
+        # 装饰器
+        @functools.wraps(conn_or_func)
+        async def wrapper(*args, **kwargs):
+            async with cls():
+                return await conn_or_func(*args, **kwargs)
+
+        return wrapper
+
+    async def __aenter__(self):
+        conn = self.conn
+
+        if not isinstance(conn, aiomysql.Connection):
+            name = conn or default_name
+            conn = pinned_conns.get().get(name)
+            # 最外层事务：从连接池借出连接，并固定给当前协程使用
+            if conn is None:
+                pool = get_pool(name)
+                conn = await acquire(pool)
+                set_pinned(name, conn)
+                self.pinned = (name, pool)
+
+        self.real_conn = conn
+
+        try:
+            if self.__class__.adjust_level(conn, 1) == 1 and conn.get_autocommit():
+                await conn.begin()
+        except Exception:
+            self.__class__.adjust_level(conn, -1)
+            self._release()
+            raise
+
+        return conn
+
+    async def __aexit__(self, exc_type, exc_value, exc_tb):
+        conn = self.real_conn
+        level = self.__class__.adjust_level(conn, -1)
+
+        try:
+            if level == 0:
+                if exc_type is None:
+                    await conn.commit()
+                    return True
+                else:
+                    await conn.rollback()
+                    # 回滚后，插入ID和影响行数都改为0
+                    set_last_query(effected_rows=0, last_insert_id=0)
+                    return False
+        finally:
+            # 事务结束，使事务中写入的表的查询结果缓存失效
+            if level == 0 and id(conn) in written_tables.get():
+                written = dict(written_tables.get())
+                invalidate_tables(written.pop(id(conn)))
+                written_tables.set(written)
+
+            self._release()
+
+    def _release(self):
+        ''' 归还固定的连接 '''
+
+        if self.pinned is not None:
+            name, pool = self.pinned
+            set_pinned(name)
+            release(pool, self.real_conn)
+            self.pinned = None
+
+    @classmethod
+    def get_level(cls, conn):
+        return transaction_levels.get().get(id(conn), 0)
+
+    @classmethod
+    def adjust_level(cls, conn, val: int):
+        levels = dict(transaction_levels.get())
+        level = levels.get(id(conn), 0) + val
+        if level > 0:
+            levels[id(conn)] = level
+        else:
+            levels.pop(id(conn), None)
+        transaction_levels.set(levels)
+        return level
+
+
+# 异步查询构建器
+class aimysql(imysql):
+
+    def __init__(self, name=None, db_name=None):
+        super().__init__(name=name, db_name=db_name)
+        # 连接名称，可传给 transaction.atomic
+        self.conn = name
+        # 查询结果
+        self.rows = []
+
+    @contextlib.asynccontextmanager
+    async def _borrow(self):
+        ''' 借出连接，执行完毕后归还连接池 '''
+
+        async with borrow(self.name, self.db_name) as conn:
+            self.cursor = await conn.cursor()
+            try:
+                yield conn
+            finally:
+                await self.cursor.close()
+
+    @classmethod
+    async def connect(cls, options: dict, name='default', min_size=1, max_size=10, max_lifetime=3600, acquire_timeout=10, ping_interval=30):
+        ''' 连接 MySql（异步）
+
+        :param options: pymysql 连接参数（database 会转换为 aiomysql 的 db）
+        :param name: 连接名称
+        :param min_size: 连接池最小连接数
+        :param max_size: 连接池最大连接数
+        :param max_lifetime: 连接最长存活时间（秒），-1：不限制
+        :param acquire_timeout: 获取连接的超时时间（秒）
+        :param ping_interval: 连接空闲超过该时间（秒）才在借出前 ping 检测，0：每次借出都检测
+        :return aiomysql.Pool
+        '''
+
+        global default_name
+
+        options = cls.gen_options(options)
+        options['cursorclass'] = aiomysql.DictCursor
+        if 'database' in options:
+            options['db'] = options.pop('database')
+
+        # 连接池
+        if name not in connections:
+            pool = await aiomysql.create_pool(minsize=min_size, maxsize=max_size, pool_recycle=max_lifetime, **options)
+            # 连接参数里的数据库 及 默认数据库（switch 永久切换数据库时会修改）
+            pool.connect_database = pool.database = options.get('db')
+            pool.acquire_timeout = acquire_timeout
+            pool.ping_interval = ping_interval
+            pool.max_allowed_packet = None
+            connections[name] = pool
+
+        # 默认连接
+        if default_name is None:
+            default_name = name
+
+        return connections[name]
+
+    @classmethod
+    def switch(cls, name: str, db_name=None, inplace=False):
+        ''' 切换数据库连接
+
+        :param name: 连接实例名称，例如：prod1、prod2 或 prod1.prod_member
+        :param db_name: 数据库名称，例如：prod_member
+        :param inplace: 是否永久生效
+        :return aimysql
+        '''
+
+        global default_name
+
+        if name.find('.') > -1:
+            name, db_name = name.split('.')
+
+        # 如果连接不存在，则报错
+        pool = get_pool(name)
+
+        if inplace is True:
+            if db_name is not None:
+                pool.database = db_name
+            default_name = name
+            return cls
+        else:
+            instance = cls(name=name, db_name=db_name)
+            instance.table = instance._table
+            instance.execute = instance._execute
+            return instance
+
+    @classmethod
+    def get_pool_stats(cls, name=None):
+        ''' 获取连接池统计信息
+
+        :param name: 连接名称，默认为当前默认连接
+        :return dict
+        '''
+
+        pool = get_pool(name)
+        return {
+            'size': pool.size,
+            'in_use': pool.size - pool.freesize,
+            'idle': pool.freesize,
+            'min_size': pool.minsize,
+            'max_size': pool.maxsize,
+        }
+
+    @classmethod
+    def execute(cls, sql: str, args=None, fetch=False):
+        ''' 执行原生SQL（异步）
+
+        :param sql
+        :param args: sql 参数
+        :param fetch: False：返回 self，True：返回 list
+        :return coroutine
+        '''
+
+        instance = cls()
+        return instance._execute(sql, args=args, fetch=fetch)
+
+    async def _execute(self, sql: str, args=None, fetch=False):
+        ''' 执行原生SQL（异步）
+
+        :param sql
+        :param args: sql 参数
+        :param fetch: False：返回 self（结果已读取到 self.rows），True：返回 list
+        :return aimysql 或 result
+        '''
+
+        async with self._borrow() as conn:
+            sql = self.cursor.mogrify(sql, args)
+
+            operation = sql.split(' ')[0].strip().lower()
+
+            if operation in ['insert', 'replace', 'update', 'delete', 'truncate', 'create', 'drop', 'alter']:
+                async with transaction.atomic(conn):
+                    await self.cursor.execute(sql)
+                    invalidate(conn, sql)
+
+                    # 记录SQL信息
+                    insert_id = conn.insert_id()
+                    effected_rows = self.cursor.rowcount
+                    set_last_query(last_sql=sql, last_operation=operation, last_insert_id=insert_id, effected_rows=effected_rows)
+
+                    return insert_id if operation == 'insert' else effected_rows
+            else:
+                await self._execute_read(conn, sql, operation)
+
+                # 记录SQL信息
+                self.raw_sql = sql
+                set_last_query(last_sql=sql, last_operation='select')
+
+                self.rows = await self.cursor.fetchall()
+                return self if fetch is False else self.rows
+
+    async def _execute_read(self, conn, sql: str, operation: str):
+        ''' 执行查询，连接断开时重连并重试（仅限事务外的只读查询） '''
+
+        try:
+            await self.cursor.execute(sql)
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            if not is_connection_lost(e) or operation not in ['select', 'show', 'explain', 'desc', 'describe']:
+                raise e
+            # 事务中的查询不能重试（事务已随连接丢失）
+            if transaction.get_level(conn) > 0:
+                raise e
+
+            pool = get_pool(self.name)
+            await conn.ping(reconnect=True)
+            # 不确定是否已重连，重新选择数据库
+            conn.chain_db = None
+            await use_db(pool, conn, self.db_name)
+            self.cursor = await conn.cursor()
+            await self.cursor.execute(sql)
+
+    async def all(self, fetch=False, stream=False):
+        ''' 查询多行（异步）
+
+        :param fetch: 兼容同步接口，结果均为 list
+        :param stream: 不支持，流式读取请使用 iter_chunks
+        :return result（开启 cache 时每次返回新的 list 及 dict）
+        '''
+
+        if stream is True:
+            raise exceptions.RuntimeError((400, '异步（aimysql）all 不支持 stream，请使用 iter_chunks'))
+
+        sql, args = self.compile()
+
+        if 'cache' in self.data:
+            return await self._cached(sql, args)
+
+        await self._execute(sql, args)
+        self.reset_data()
+
+        return self.rows
+
+    async def _cached(self, sql: str, args: list):
+        ''' 查询结果缓存（异步）：命中时直接返回，否则查询并缓存（事务中不使用缓存），同 imysql._cached
+
+        :return result（每次返回新的 list 及 dict，修改不影响缓存）
+        '''
+
+        from . import shared_cache
+
+        ttl, shared = self.data.get('cache')
+        cache = shared_cache if shared is True else result_cache
+        self.reset_data()
+
+        name = self.name or default_name
+        key = ('aio', name, self.db_name, sql, tuple(args))
+        try:
+            hash(key)
+        except TypeError:
+            key = None
+
+        if key is None or pinned_conns.get().get(name) is not None:
+            return await self._execute(sql, args, fetch=True)
+
+        results = cache.get(key)
+        if results is None:
+            tables = get_tables(sql)
+            version = cache.version(tables)
+            results = await self._execute(sql, args, fetch=True)
+            cache.set(key, tuple(results) if cache is result_cache else results, ttl, tables, version)
+            return [dict(x) for x in results]
+
+        # 共享缓存每次解码出新的对象
+        return results if cache is shared_cache else [dict(x) for x in results]
+
+    async def iter_chunks(self, size=1000):
+        ''' 流式分块查询（服务端游标，异步生成器）
+
+        事务外独占一个连接，读取完毕或关闭生成器后归还；事务中使用固定的连接，读取完毕前不能执行其他查询
+
+        :param size: 每块的行数
+        :return async generator
+        '''
+
+        if size < 1:
+            raise exceptions.RuntimeError((400, 'iter_chunks: size 须大于0'))
+
+        sql, args = self.compile()
+        self.reset_data()
+
+        async with borrow(self.name, self.db_name) as conn:
+            cursor = await conn.cursor(aiomysql.SSDictCursor)
+            try:
+                sql = cursor.mogrify(sql, args)
+                await cursor.execute(sql)
+
+                # 记录SQL信息
+                set_last_query(last_sql=sql, last_operation='select')
+
+                while True:
+                    rows = await cursor.fetchmany(size)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                await cursor.close()
+
+    async def index(self, key: str, value=None):
+        ''' 查询结果用key索引（异步）
+
+        :param key: 索引字段
+        :param value: 如果指定value字段，则返回一维dict，否则返回二维dict
+        :return result
+        '''
+
+        result = dict()
+
+        for item in await self.all():
+            if value is None:
+                result[item.get(key)] = item
+            else:
+                result[item.get(key)] = item.get(value)
+
+        return result
+
+    async def one(self):
+        ''' 查询一行（异步） '''
+
+        self.skip(num=0)
+        self.limit(num=1)
+
+        rows = await self.all()
+        return rows[0] if len(rows) > 0 else None
+
+    async def scalar(self):
+        ''' 查询一个值（异步） '''
+
+        one = await self.one()
+        if type(one) is dict:
+            return list(one.values())[0]
+        else:
+            return ''
+
+    async def column(self):
+        ''' 查询一列（异步） '''
+
+        results = await self.all()
+        if len(results) > 0:
+            key = list(results[0].keys())[0]
+            return [item.get(key) for item in results]
+        else:
+            return ''
+
+    async def count(self):
+        ''' 统计（异步） '''
+
+        wrapper = ''
+
+        if self.data.get('limit'):
+            wrapper = 'SELECT COUNT(*) AS ct FROM (%s) t'
+        else:
+            self.data['fields'] = 'count(*) as ct'
+
+        sql, args = self.compile(wrapper)
+        await self._execute(sql, args)
+        self.reset_data()
+        return self.rows[0].get('ct') if self.rows else False
+
+    async def chunk_by(self, key: 'str|list|tuple' = 'id', size=1000, ascending=True):
+        ''' 按键分块遍历（keyset 分页，异步生成器）
+
+        :param key: 排序键（须唯一，通常为主键），复合键可传 list
+        :param size: 每块的行数
+        :param ascending: 是否升序，默认 True
+        :return async generator
+        '''
+
+        keys = self._seek_keys(key, size)
+        data = dict(self.data)
+        last = None
+
+        while True:
+            self.data = dict(data)
+            self._seek(keys, size, last, ascending)
+            rows = await self.all()
+
+            if len(rows) > 0:
+                yield rows
+            if len(rows) < size:
+                break
+
+            last = self.__class__.get_seek_values(keys, rows[-1])
+
+    async def scan(self, key: 'str|list|tuple' = 'id', batch_size=1000, ascending=True):
+        ''' 按键逐行遍历全表（keyset 分页，异步生成器） '''
+
+        async for rows in self.chunk_by(key, batch_size, ascending):
+            for row in rows:
+                yield row
+
+    async def paginate(self, key: 'str|list|tuple' = 'id', size=20, token=None, ascending=True):
+        ''' 游标分页（keyset，异步）
+
+        :return dict，items：本页数据，next_token：下一页的 token（没有下一页时为 None）
+        '''
+
+        keys = self._seek_keys(key, size)
+        last = self.__class__.parse_page_token(keys, token) if token else None
+
+        self._seek(keys, size + 1, last, ascending)
+        rows = await self.all()
+
+        next_token = None
+        if len(rows) > size:
+            rows = rows[0:size]
+            next_token = self.__class__.gen_page_token(keys, self.__class__.get_seek_values(keys, rows[-1]))
+
+        return {'items': rows, 'next_token': next_token}
+
+    async def insert_many(self, data: 'list|dict|iterable', return_insert_id=False, verify=True, batch_size=1000, commit_every=0, progress=None):
+        ''' 批量插入数据（异步），参数同 imysql.insert_many
+
+        :return 影响行数，当 return_insert_id = True 时，返回 insert_id
+        '''
+
+        if batch_size < 1:
+            raise exceptions.RuntimeError((400, 'batch_size 须大于0'))
+
+        if type(data) is dict:
+            data = [data]
+
+        rows = iter(data)
+        first = next(rows, None)
+        if first is None:
+            return 0
+
+        fields = list(first.keys())
+        head = 'INSERT INTO {} {} VALUES '.format(self.data.get('table'), self.gen_fields(first))
+        stats = {'rows': 0, 'effected_rows': 0, 'insert_id': 0}
+
+        await self._write_rows(head, '', fields, itertools.chain([first], rows), verify, batch_size, commit_every, progress, stats)
+
+        sql = head + '({})'.format(','.join(['%s'] * len(fields)))
+        # 记录SQL信息
+        set_last_query(last_operation='insert', last_sql=sql, effected_rows=stats['effected_rows'], last_insert_id=stats['insert_id'])
+        # 返回插入的ID或影响的行数
+        return stats['insert_id'] if return_insert_id else stats['effected_rows']
+
+    async def upsert_many(self, data: 'list|dict|iterable', update_fields: 'list|tuple' = None, increment_fields: 'list|tuple' = None, verify=True, batch_size=1000, commit_every=0, progress=None):
+        ''' 批量插入或更新数据（异步），参数同 imysql.upsert_many
+
+        :return dict，inserted：插入的行数，updated：更新的行数，unchanged：重复但值未改变的行数
+        '''
+
+        if batch_size < 1:
+            raise exceptions.RuntimeError((400, 'batch_size 须大于0'))
+
+        if type(data) is dict:
+            data = [data]
+
+        rows = iter(data)
+        first = next(rows, None)
+        if first is None:
+            return {'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+        fields = list(first.keys())
+        head = 'INSERT INTO {} {} VALUES '.format(self.data.get('table'), self.gen_fields(first))
+        tail = self.__class__.gen_upsert_setter(fields, update_fields, increment_fields)
+        stats = {'rows': 0, 'effected_rows': 0, 'insert_id': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+        await self._write_rows(head, tail, fields, itertools.chain([first], rows), verify, batch_size, commit_every, progress, stats)
+
+        sql = head + '({})'.format(','.join(['%s'] * len(fields))) + tail
+        # 记录SQL信息
+        set_last_query(last_operation='upsert', last_sql=sql, effected_rows=stats['effected_rows'], last_insert_id=stats['insert_id'])
+        return {'inserted': stats['inserted'], 'updated': stats['updated'], 'unchanged': stats['unchanged']}
+
+    async def _write_rows(self, head: str, tail: str, fields: list, rows, verify, batch_size: int, commit_every: int, progress, stats: dict):
+        ''' 把多行数据打包为多行语句并执行，每 commit_every 条语句提交一次事务 '''
+
+        async with self._borrow() as conn:
+            max_packet = await self.get_max_packet(conn)
+            batches = self.pack_rows(conn, head, fields, rows, verify, batch_size, max_packet, tail)
+            await self._run_batches(conn, batches, commit_every, stats, progress)
+
+    async def _run_batches(self, conn, batches, commit_every: int, stats: dict, progress=None):
+        ''' 开启事务执行多条打包后的语句，每 commit_every 条语句提交一次（0：全部执行后再提交） '''
+
+        while True:
+            # 没有剩余的语句时不再开启事务
+            batch = next(batches, None)
+            if batch is None:
+                break
+            async with transaction.atomic(conn):
+                finished = await self._execute_batches(conn, itertools.chain([batch], batches), commit_every, stats, progress)
+            if finished:
+                break
+
+    async def _execute_batches(self, conn, batches, limit: int, stats: dict, progress=None):
+        ''' 执行多条打包后的语句，执行 limit 条后返回（0：不限制）
+
+        :return bool，是否已全部执行
+        '''
+
+        cls = self.__class__
+        count = 0
+        for sql, rows in batches:
+            effected_rows = await self.cursor.execute(sql)
+            invalidate(conn, sql)
+            stats['effected_rows'] += effected_rows
+            stats['insert_id'] = conn.insert_id()
+            stats['rows'] += rows
+
+            # 统计插入、更新的行数（upsert_many）
+            if 'updated' in stats:
+                message = getattr(getattr(self.cursor, '_result', None), 'message', None)
+                for key, val in zip(('inserted', 'updated', 'unchanged'), cls.count_upserted(conn, rows, effected_rows, message)):
+                    stats[key] += val
+
+            if progress is not None:
+                progress(stats['rows'])
+
+            count += 1
+            if limit > 0 and count >= limit:
+                return False
+
+        return True
+
+    async def get_max_packet(self, conn):
+        ''' 单条 SQL 语句的最大字节数（服务器的 max_allowed_packet，缓存在连接池中） '''
+
+        pool = get_pool(self.name)
+
+        if pool.max_allowed_packet is None:
+            cursor = await conn.cursor(aiomysql.DictCursor)
+            await cursor.execute('SELECT @@max_allowed_packet AS `size`')
+            pool.max_allowed_packet = int((await cursor.fetchone()).get('size'))
+            await cursor.close()
+
+        # 客户端也会限制包的大小；预留协议头的长度
+        size = min(pool.max_allowed_packet, getattr(conn, 'max_allowed_packet', pool.max_allowed_packet))
+        return size - 64
+
+    def bulk_load(self, *args, **kwargs):
+        ''' 不支持异步（LOAD DATA LOCAL INFILE 依赖同步连接） '''
+
+        raise exceptions.RuntimeError((400, '异步（aimysql）不支持 bulk_load，请使用 insert_many'))
+
+    async def insert_one(self, data: dict, verify=True):
+        ''' 插入一行数据（异步）
+
+        :param data: 插入的数据
+        :param verify: 是否验证数据合法性，默认 True，也可传入验证器（Validator）
+        :return insert_id
+        '''
+        return await self.insert_many([data], return_insert_id=True, verify=verify)
+
+    async def update_many(self, condition: 'str|dict', data: dict, limit=0, verify=True):
+        ''' 更新多行（异步）
+
+        :param condition: 筛选条件，str 或 dict
+        :param data: 更新的数据，字典类型
+        :param limit: 限制更新的数量，默认 0，不限制
+        :param verify: 是否验证数据合法性，默认 True，也可传入验证器（Validator）
+        :return 影响行数
+        '''
+
+        if verify is not False and self.__class__.check_validity(data, verify) is False:
+            raise exceptions.RuntimeError((403, '更新内容中包含非法字符'))
+
+        sql, args = self.compile_update(condition, data, limit)
+        effected_rows = await self._execute(sql, args)
+
+        # 记录SQL信息
+        set_last_query(last_operation='update', effected_rows=effected_rows)
+        # 返回影响的行情
+        return effected_rows
+
+    async def update_batch(self, data: 'list|iterable', key: 'str|list|tuple' = 'id', verify=True, batch_size=1000, progress=None):
+        ''' 按键批量更新多行（异步），参数同 imysql.update_batch
+
+        :return 影响行数
+        '''
+
+        if batch_size < 1:
+            raise exceptions.RuntimeError((400, 'batch_size 须大于0'))
+
+        keys = [key] if type(key) is str else list(key)
+        if len(keys) == 0 or any(re.search(r'[^\w]', x) for x in keys):
+            raise exceptions.RuntimeError((403, '键中包含非法参数'))
+
+        rows = iter([data] if type(data) is dict else data)
+        first = next(rows, None)
+        if first is None:
+            return 0
+
+        stats = {'rows': 0, 'effected_rows': 0, 'insert_id': 0}
+
+        async with self._borrow() as conn:
+            max_packet = await self.get_max_packet(conn)
+            batches = self.pack_updates(conn, keys, itertools.chain([first], rows), verify, batch_size, max_packet)
+            # 每条语句一个事务
+            await self._run_batches(conn, batches, 1, stats, progress)
+
+        placeholders = {tuple(['%s'] * len(keys)): {k: '%s' for k in first.keys() if k not in keys}}
+        # 记录SQL信息
+        set_last_query(last_operation='update', last_sql=self.gen_update_batch(keys, placeholders), effected_rows=stats['effected_rows'])
+        # 返回影响的行数
+        return stats['effected_rows']
+
+    async def update_one(self, condition: 'str|dict', data: dict, verify=True):
+        ''' 更新一行（异步）
+
+        :param condition: 筛选条件，str 或 dict
+        :param data: 更新的数据，字典类型
+        :param verify: 是否验证数据合法性，默认 True，也可传入验证器（Validator）
+        :return 影响行数
+        '''
+        return await self.update_many(condition, data, limit=1, verify=verify)
+
+    async def delete(self, condition: 'str|dict', limit=0):
+        ''' 删除数据（异步）
+
+        :param condition: 筛选条件，str 或 dict
+        :param limit: 限制删除的数量，默认 0，不限制
+        :return 影响行数
+        '''
+
+        sql, args = self.compile_delete(condition, limit)
+        effected_rows = await self._execute(sql, args)
+
+        # 记录SQL信息
+        set_last_query(last_operation='delete', effected_rows=effected_rows)
+        # 返回影响的行数
+        return effected_rows
+
+    async def purge(self, condition: 'str|dict' = None, batch_size=1000, sleep_ms=0, max_lag=None, lag_source=None, key: 'str|list|tuple' = 'id', keys=None, progress=None):
+        ''' 分批删除大量数据（异步），参数同 imysql.purge
+
+        :return 影响行数
+        '''
+
+        def compile_batch(where: str, args: list):
+            return 'DELETE FROM {} WHERE {}'.format(self.data.get('table'), where), args
+
+        effected_rows = await self._run_in_batches(compile_batch, condition, batch_size, sleep_ms, max_lag, lag_source, key, keys, progress)
+
+        # 记录SQL信息
+        set_last_query(last_operation='delete', effected_rows=effected_rows)
+        return effected_rows
+
+    async def backfill(self, condition: 'str|dict', data: dict, batch_size=1000, sleep_ms=0, max_lag=None, lag_source=None, key: 'str|list|tuple' = 'id', keys=None, progress=None, verify=True):
+        ''' 分批更新大量数据（异步），参数同 imysql.backfill
+
+        :return 影响行数
+        '''
+
+        if verify is not False and self.__class__.check_validity(data, verify) is False:
+            raise exceptions.RuntimeError((403, '更新内容中包含非法字符'))
+
+        setter, setter_args = self.compile_setter(data)
+
+        def compile_batch(where: str, args: list):
+            return 'UPDATE {} SET {} WHERE {}'.format(self.data.get('table'), setter, where), setter_args + args
+
+        effected_rows = await self._run_in_batches(compile_batch, condition, batch_size, sleep_ms, max_lag, lag_source, key, keys, progress)
+
+        # 记录SQL信息
+        set_last_query(last_operation='update', effected_rows=effected_rows)
+        return effected_rows
+
+    async def _run_in_batches(self, compile_batch, condition, batch_size, sleep_ms, max_lag, lag_source, key, keys, progress):
+        ''' 按键分批执行语句（purge、backfill），每条语句自动提交 '''
+
+        cls = self.__class__
+        key_names = self._seek_keys(key, batch_size)
+
+        if max_lag is not None and lag_source is None:
+            raise exceptions.RuntimeError((400, '检测从库延迟须指定 lag_source'))
+
+        if condition:
+            cond_sql, cond_args = cls.compile_condition(condition)
+        elif keys is None:
+            raise exceptions.RuntimeError((400, 'condition 和 keys 不能都为空'))
+
+        async def gen_batches():
+            if keys is not None:
+                it = iter(keys)
+                for values in iter(lambda: list(itertools.islice(it, batch_size)), []):
+                    yield values
+            else:
+                # 按键遍历符合条件的行，只查询键
+                query = cls(self.name, self.db_name)
+                query.data['table'] = self.data.get('table')
+                query.select(key_names).where(condition)
+                async for rows in query.chunk_by(key_names, batch_size):
+                    yield [cls.get_seek_values(key_names, row) for row in rows]
+
+        effected_rows = 0
+        first = True
+        async for values in gen_batches():
+            if not first and sleep_ms > 0:
+                await asyncio.sleep(sleep_ms / 1000)
+            first = False
+            await cls.wait_for_lag(max_lag, lag_source)
+
+            where, args = cls.compile_keys_in(key_names, values)
+            if condition:
+                where += f' AND ({cond_sql})'
+                args += cond_args
+
+            effected_rows += await self._execute(*compile_batch(where, args))
+
+            if progress is not None:
+                progress(effected_rows)
+
+        return effected_rows
+
+    @classmethod
+    def execute_cross(cls, *args, **kwargs):
+        ''' 不支持异步（跨库查询在线程池中同步执行） '''
+
+        raise exceptions.RuntimeError((400, '异步（aimysql）不支持 execute_cross，请使用 imysql.execute_cross'))
+
+    @classmethod
+    def explain_cross(cls, *args, **kwargs):
+        ''' 不支持异步 '''
+
+        raise exceptions.RuntimeError((400, '异步（aimysql）不支持 explain_cross，请使用 imysql.explain_cross'))
+
+    @classmethod
+    def shards(cls, *args, **kwargs):
+        ''' 不支持异步（分片查询在线程池中同步执行） '''
+
+        raise exceptions.RuntimeError((400, '异步（aimysql）不支持 shards，请使用 imysql.shards'))
+
+    @classmethod
+    async def wait_for_lag(cls, max_lag, lag_source):
+        ''' 从库延迟超过 max_lag 秒时暂停，直到延迟恢复（异步） '''
+
+        if max_lag is None:
+            return
+
+        while True:
+            lag = await cls.get_replica_lag(lag_source)
+            if lag is not None and lag <= max_lag:
+                return
+            await asyncio.sleep(1)
+
+    @classmethod
+    async def get_replica_lag(cls, lag_source):
+        ''' 获取从库延迟（秒，异步），多个从库时取最大值，复制中断时返回 None
+
+        :param lag_source: 从库连接名称（str 或 list），或返回延迟秒数的函数（可以是协程函数）
+        :return int 或 None
+        '''
+
+        if callable(lag_source):
+            lag = lag_source()
+            return await lag if inspect.isawaitable(lag) else lag
+
+        names = [lag_source] if type(lag_source) is str else list(lag_source)
+        lags = []
+
+        for name in names:
+            async with borrow(name) as conn:
+                cursor = await conn.cursor(aiomysql.DictCursor)
+                try:
+                    await cursor.execute('SHOW REPLICA STATUS')
+                except pymysql.err.ProgrammingError:
+                    # MySQL < 8.0.22
+                    await cursor.execute('SHOW SLAVE STATUS')
+                status = await cursor.fetchone()
+                await cursor.close()
+
+            # 不是从库
+            if not status:
+                continue
+
+            lag = status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+            if lag is None:
+                return None
+            lags.append(int(lag))
+
+        return max(lags) if len(lags) > 0 else 0
+
+    @staticmethod
+    async def close(name=None):
+        ''' 关闭连接池（异步） '''
+
+        global default_name
+
+        if name is not None:
+            names = [name] if name in connections else []
+        else:
+            names = list(connections.keys())
+
+        for name in names:
+            pool = connections.pop(name)
+            pool.close()
+            await pool.wait_closed()
+            if name == default_name:
+                default_name = None
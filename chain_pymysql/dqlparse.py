@@ -1,40 +1,306 @@
-from pyparsing import pyparsing_unicode as ppu
-from pyparsing import Word, alphas, alphanums, printables, Group, ZeroOrMore, OneOrMore, CaselessKeyword
+import re
+import copy
+from . import exceptions
+from .lru import LRUCache, ResultCache
+
+
+# 执行计划缓存：规范化的 SQL => (sql_list, bridging, columns_alias)，WHERE 之后的字面量为占位符
+plan_cache = LRUCache(256)
+# 估算行数缓存：规范化的 SQL => {连接: 估算行数}（用于选择主查询），过期后重新 EXPLAIN
+rows_cache = ResultCache(256)
+# 估算行数缓存的过期时间（秒）
+ROWS_CACHE_TTL = 60
+
+# 字符串字面量（奇数下标）及其他部分
+STRING_PATTERN = re.compile(r"""('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")""", re.S)
+NUMBER_PATTERN = re.compile(r'(?<![\w.])\d+(?:\.\d+)?(?![\w.])')
+WHERE_PATTERN = re.compile(r'\bWHERE\b', re.I)
+PARAM_PATTERN = re.compile(r'__chain_param_(\d+)__')
+# 表别名.字段
+FIELD_PATTERN = re.compile(r'(\w+)\s*\.\s*(\w+)')
+# 聚合函数
+AGGREGATE_PATTERN = re.compile(r'^(COUNT|SUM|AVG|MIN|MAX)\s*\(\s*(DISTINCT\s+)?(.*)\)$', re.I | re.S)
+
+# 词法：空白、字符串、标识符（含中文、数字）、比较运算符、其他单个字符
+TOKEN_PATTERN = re.compile(r"""(\s+)|('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")|(\w+)|(<=>|<=|>=|<>|!=|=|<|>)|(.)""", re.S)
+TOKEN_KINDS = (None, 'space', 'string', 'word', 'op', 'char')
+
+# 关联类型
+JOIN_TYPES = ('LEFT', 'RIGHT', 'INNER', 'OUTER', 'CROSS')
+# 条件中的关键字运算符
+OPERATORS = ('IN', 'NOT', 'LIKE', 'IS', 'REGEXP', 'RLIKE')
+# 条件之后的子句
+CLAUSES = ('GROUP', 'HAVING', 'ORDER', 'LIMIT')
+
+
+def tokenize(dql: str):
+    ''' 词法分析（忽略空白）
+
+    :param dql
+    :return [(类型, 文本, 开始位置, 结束位置)]，类型：string、word、op、char
+    '''
+
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(dql):
+        kind = TOKEN_KINDS[match.lastindex]
+        if kind != 'space':
+            tokens.append((kind, match.group(), match.start(), match.end()))
+    return tokens
+
+
+class DqlParser(object):
+    ''' 跨库查询 SQL 解析器（递归下降，只支持 SELECT ... FROM ... JOIN ... ON ... WHERE ... 子集） '''
+
+    def __init__(self, dql: str):
+        self.dql = dql
+        self.tokens = tokenize(dql)
+        self.pos = 0
+
+        # 忽略结尾的分号
+        while len(self.tokens) > 0 and self.tokens[-1][0] == 'char' and self.tokens[-1][1] == ';':
+            self.tokens.pop()
+
+    def peek(self, offset=0):
+        i = self.pos + offset
+        return self.tokens[i] if i < len(self.tokens) else None
+
+    def is_keyword(self, keywords: tuple, offset=0):
+        token = self.peek(offset)
+        return token is not None and token[0] == 'word' and token[1].upper() in keywords
+
+    def is_char(self, char: str):
+        token = self.peek()
+        return token is not None and token[0] != 'string' and token[1] == char
+
+    def is_join(self):
+        ''' 当前位置是否为 [LEFT|RIGHT|INNER] [OUTER] JOIN '''
+
+        for offset in range(3):
+            if self.is_keyword(('JOIN',), offset):
+                return True
+            if not self.is_keyword(JOIN_TYPES, offset):
+                return False
+        return False
+
+    def is_operator(self):
+        token = self.peek()
+        return token is not None and (token[0] == 'op' or self.is_keyword(OPERATORS))
+
+    def is_condition_end(self):
+        return self.is_keyword(('AND',) + CLAUSES)
+
+    def error(self, message: str):
+        token = self.peek()
+        near = self.dql[token[2]:token[2] + 30] if token else '结尾'
+        raise exceptions.RuntimeError((400, f'跨库查询解析失败：{message}（{near}）'))
+
+    def expect(self, keyword: str):
+        if not self.is_keyword((keyword,)):
+            self.error(f'缺少 {keyword}')
+        self.pos += 1
+        return keyword
+
+    def parse(self):
+        ''' 解析为 {columns, table, joins, conditions, other} '''
+
+        self.expect('SELECT')
+        columns = self.parse_columns()
+        self.expect('FROM')
+        table = self.parse_table()
+
+        joins = []
+        while self.is_join():
+            joins.append(self.parse_join())
+
+        conditions = []
+        if self.is_keyword(('WHERE',)):
+            self.pos += 1
+            conditions = self.parse_conditions()
+
+        other = []
+        token = self.peek()
+        if token is not None:
+            other.append(self.dql[token[2]:self.tokens[-1][3]].strip())
+
+        clauses = self.parse_clauses()
+
+        return {'columns': columns, 'table': table, 'joins': joins, 'conditions': conditions, 'other': other, 'clauses': clauses}
+
+    def parse_operand(self, stop):
+        ''' 解析字段或表达式，遇到（括号外的）stop 时结束
+
+        :param stop: 是否结束的判断函数
+        :return 表别名.字段：[表别名, '.', 字段]，其他：[原文]
+        '''
+
+        start = self.pos
+        depth = 0
+        while self.peek() is not None:
+            if depth == 0 and stop():
+                break
+            if self.is_char('('):
+                depth += 1
+            elif self.is_char(')'):
+                depth -= 1
+            self.pos += 1
+
+        tokens = self.tokens[start:self.pos]
+        if len(tokens) == 0:
+            self.error('缺少字段')
+
+        # 表别名.字段（可多级）
+        if len(tokens) % 2 == 1 and all(x[0] == 'word' if i % 2 == 0 else x[1] == '.' for i, x in enumerate(tokens)):
+            return [x[1] for x in tokens]
+
+        return [self.dql[tokens[0][2]:tokens[-1][3]]]
+
+    def parse_columns(self):
+        columns = []
+        while True:
+            column = self.parse_operand(lambda: self.is_char(',') or self.is_keyword(('AS', 'FROM')))
+            if self.is_keyword(('AS',)):
+                self.pos += 1
+                token = self.peek()
+                if token is None or token[0] not in ('word', 'string'):
+                    self.error('缺少字段别名')
+                column += ['AS', token[1]]
+                self.pos += 1
+            columns.append(column)
+
+            if not self.is_char(','):
+                return columns
+            self.pos += 1
+            columns.append(',')
+
+    def parse_table(self):
+        ''' 解析 连接名.数据库.表名 别名 '''
+
+        table = []
+        while True:
+            token = self.peek()
+            if token is None or token[0] != 'word':
+                self.error('缺少表名')
+            table.append(token[1])
+            self.pos += 1
+            if not self.is_char('.'):
+                break
+            table.append('.')
+            self.pos += 1
+
+        if len(table) < 5:
+            self.error('表名必须带连接名前缀')
+
+        if self.is_keyword(('AS',)):
+            self.pos += 1
+        token = self.peek()
+        if token is None or token[0] != 'word' or self.is_keyword(('ON', 'WHERE', 'JOIN') + JOIN_TYPES + CLAUSES):
+            self.error('表名必须定义别名')
+        table.append(token[1])
+        self.pos += 1
+
+        return table
+
+    def parse_join(self):
+        ''' 解析 [LEFT|RIGHT|INNER] JOIN 表 别名 ON 条件 [AND 条件 ...] '''
+
+        label = 'INNER' if self.is_keyword(('JOIN',)) else self.peek()[1]
+        while not self.is_keyword(('JOIN',)):
+            self.pos += 1
+        self.pos += 1
+
+        item = [label, 'JOIN'] + self.parse_table()
+        item.append(self.expect('ON'))
+
+        while True:
+            left = self.parse_operand(lambda: self.peek()[0] == 'op' or self.is_keyword(('AND', 'WHERE')))
+            token = self.peek()
+            if token is None or token[1] != '=':
+                self.error('关联条件只支持 =')
+            self.pos += 1
+            right = self.parse_operand(lambda: self.is_keyword(('AND', 'WHERE') + CLAUSES) or self.is_join())
+            item.append(left + ['='] + right)
+
+            if not self.is_keyword(('AND',)):
+                return item
+            self.pos += 1
+            item.append('AND')
+
+    def parse_clauses(self):
+        ''' 解析 GROUP BY、HAVING、ORDER BY、LIMIT
+
+        :return {group: [(字段, False)], having: 原文, order: [(字段, 是否降序)], limit: (offset, count)}
+        '''
+
+        clauses = dict()
+        while self.peek() is not None:
+            if self.is_keyword(('GROUP', 'ORDER')) and self.is_keyword(('BY',), 1):
+                name = self.peek()[1].lower()
+                self.pos += 2
+                items = []
+                while True:
+                    field = self.parse_operand(lambda: self.is_char(',') or self.is_keyword(CLAUSES + ('ASC', 'DESC')))
+                    desc = False
+                    if self.is_keyword(('ASC', 'DESC')):
+                        desc = self.peek()[1].upper() == 'DESC'
+                        self.pos += 1
+                    items.append((field, desc))
+                    if not self.is_char(','):
+                        break
+                    self.pos += 1
+                clauses[name] = items
+            elif self.is_keyword(('HAVING',)):
+                self.pos += 1
+                start = self.pos
+                self.parse_operand(lambda: self.is_keyword(CLAUSES))
+                clauses['having'] = self.dql[self.tokens[start][2]:self.tokens[self.pos - 1][3]]
+            elif self.is_keyword(('LIMIT',)):
+                self.pos += 1
+                values = []
+                while self.peek() is not None and self.peek()[0] == 'word' and not self.is_keyword(('OFFSET',)):
+                    values.append(self.peek()[1])
+                    self.pos += 1
+                    if not self.is_char(','):
+                        break
+                    self.pos += 1
+                if self.is_keyword(('OFFSET',)) and len(values) == 1:
+                    self.pos += 1
+                    values.insert(0, self.peek()[1] if self.peek() is not None else '')
+                    self.pos += 1
+                if len(values) not in (1, 2):
+                    self.error('LIMIT 格式错误')
+                clauses['limit'] = tuple(values) if len(values) == 2 else ('0', values[0])
+            else:
+                self.error('无法识别的语句')
+
+        return clauses
+
+    def parse_conditions(self):
+        ''' 解析 字段 运算符 值 [AND 字段 运算符 值 ...] '''
+
+        conditions = []
+        while True:
+            field = self.parse_operand(lambda: self.is_operator() or self.is_condition_end())
+            if not self.is_operator():
+                self.error('缺少运算符')
+            operator = self.peek()[1]
+            self.pos += 1
+
+            start = self.pos
+            self.parse_operand(self.is_condition_end)
+            value = self.dql[self.tokens[start][2]:self.tokens[self.pos - 1][3]]
+            conditions.append(field + [operator, value])
+
+            if not self.is_keyword(('AND',)):
+                return conditions
+            self.pos += 1
+            conditions.append('AND')
 
 
 class DqlParse(object):
 
     def parse(self, dql: str):
         dql = dql.replace("`", '')
-        word = Word(alphanums + '_')
-        table = ZeroOrMore(word + '.') + word
-        table_alias = word
-        normal_field = ZeroOrMore(table_alias + '.') + word
-        field_alias = CaselessKeyword('AS') + Word(ppu.Chinese.alphanums + '"' + "'" + '_' + '(' + ')' + '（' + '）')
-        function_field = ZeroOrMore(word) + '(' + Word(printables + '\n' + ' ' + ppu.Chinese.alphanums, excludeChars=')') + ')'
-        function_field.set_parse_action(''.join)
-        string_field = Word(printables, exclude_chars=',')
-        field = normal_field ^ function_field ^ string_field
-        from_label = CaselessKeyword('FROM')
-        join_label = Word(alphas) + CaselessKeyword('JOIN')
-        on_condition = OneOrMore(ZeroOrMore('AND') + Group(field + '=' + field))
-        join_expr = join_label + table + table_alias + CaselessKeyword('ON') + on_condition
-        where_label = CaselessKeyword('WHERE')
-        where_condition = field + Word(alphas + '>' + '<' + '=', exclude_chars='B') + Word(ppu.Chinese.alphanums + printables + ' ', exclude_chars='AO')
-        where_condition.set_parse_action(lambda x: [i.strip() for i in x])
-
-        parser = (
-            CaselessKeyword('SELECT')
-            + Group(OneOrMore(Group(field + ZeroOrMore(field_alias)) + ZeroOrMore(','), stop_on=from_label)).set_results_name('columns')
-            + from_label
-            + Group(table + table_alias).set_results_name('table')
-            + Group(OneOrMore(Group(join_expr), stop_on=where_label)).set_results_name('joins')
-            + where_label
-            + Group(OneOrMore(ZeroOrMore('AND') + Group(where_condition))).set_results_name('conditions')
-            + ZeroOrMore(Word(printables + ' ')).set_results_name('other')
-        )
-
-        return parser.parse_string(dql).as_dict()
+        return DqlParser(dql).parse()
 
     def split_tables_joins(self, result: dict):
         name, _, database, _, table, table_alias = result.get('table')
@@ -59,9 +325,6 @@ class DqlParse(object):
         columns = {name: [] for name in mapping.values()}
         columns_alias = []
 
-        word = Word(alphanums + '_')
-        field_expr = word + '.' + word
-
         for item in result.get('columns'):
             if type(item) is not list:
                 continue
@@ -69,11 +332,11 @@ class DqlParse(object):
             if len(item) == 2 or item[1] == '.':
                 name = mapping.get(item[0])
             else:
-                matches = field_expr.search_string(item[0])
+                matches = FIELD_PATTERN.findall(item[0])
                 name = mapping.get(matches[0][0])
                 for x in matches[1:]:
                     if mapping.get(x[0]) != name:
-                        fields = ', '.join(''.join(x) for x in matches)
+                        fields = ', '.join('.'.join(x) for x in matches)
                         raise AssertionError(f'【{fields}】字段结合跨链接异常')
 
             if len(item) >= 3:
@@ -85,9 +348,6 @@ class DqlParse(object):
     def split_conditions(self, mapping: dict, result: dict):
         conditions = {name: [] for name in mapping.values()}
 
-        word = Word(alphanums + '_')
-        field_expr = word + '.' + word
-
         for item in result.get('conditions'):
             if type(item) is not list:
                 continue
@@ -95,10 +355,10 @@ class DqlParse(object):
             if item[1] == '.':
                 name = mapping.get(item[0])
             else:
-                matches = field_expr.search_string(item[0])
+                matches = FIELD_PATTERN.findall(item[0])
                 name = mapping.get(matches[0][0])
                 for x in matches[1:]:
-                    assert mapping.get(x[0]) == name, f'【{x[0]}.{x[2]}】字段结合跨链接异常'
+                    assert mapping.get(x[0]) == name, f'【{x[0]}.{x[1]}】字段结合跨链接异常'
 
             if len(item) > 3 and item[3].upper() in ['IS', 'IN', 'LIKE', 'NOT']:
                 conditions[name].append(''.join(item[0:3]) + ' ' + ' '.join(item[3:]))
@@ -119,6 +379,8 @@ class DqlParse(object):
                     field_mapping[t[0]] = t[-1].strip("'\"")
         
         flag = False
+        # 关联表所在的连接
+        name = None
 
         result = []
         for i, x in enumerate(join_item.copy()):
@@ -138,8 +400,10 @@ class DqlParse(object):
                     left_alias = left[2]
                     columns[_name].append(''.join(left))
                 
+                name = rigth_link
                 right = ''.join(right)
-                result.append([left_alias, right])
+                # [连接键, 关联字段, 主表所在的连接, 主表字段]
+                result.append([left_alias, right, left_link, ''.join(left)])
                 columns[name].append(f"{right} AS '{left_alias}'")
 
                 if name in bridging:
@@ -154,8 +418,224 @@ class DqlParse(object):
 
         return flag, join_item
 
+    def normalize(self, dql: str):
+        ''' 规范化 SQL：合并空白，WHERE 之后的字面量（字符串、数字）替换为占位符
+
+        :param dql
+        :return (规范化的 SQL, 字面量列表)
+        '''
+
+        parts = []
+        literals = []
+        where = False
+
+        def param(literal: str):
+            literals.append(literal)
+            return f'__chain_param_{len(literals) - 1}__'
+
+        for i, part in enumerate(STRING_PATTERN.split(dql)):
+            if i % 2 == 1:
+                parts.append(param(part) if where else part)
+                continue
+
+            part = re.sub(r'\s+', ' ', part)
+            if where is False:
+                match = WHERE_PATTERN.search(part)
+                if match is None:
+                    parts.append(part)
+                    continue
+                where = True
+                parts.append(part[0:match.end()])
+                part = part[match.end():]
+            parts.append(NUMBER_PATTERN.sub(lambda x: param(x.group(0)), part))
+
+        return ''.join(parts).strip(), literals
+
     def split_sql(self, dql: str):
+        ''' 按连接拆分跨库 SQL（排序、分组、分页附加在主查询上）；结构相同（只有字面量不同）的 SQL 复用缓存的执行计划
+
+        :param dql
+        :return (sql_list, bridging, columns_alias)
+        '''
+
+        (sql_list, bridging, columns_alias), literals = self.get_plan(dql, self.plan)
+        sql_list = {name: self.bind(sql, literals) for name, sql in sql_list.items()}
+
+        # 返回副本，避免调用方修改缓存
+        return sql_list, copy.deepcopy(bridging), list(columns_alias)
+
+    def split_query(self, dql: str):
+        ''' 按连接拆分跨库 SQL，排序、分组、分页及聚合函数在关联后处理（能下推到主查询的除外）
+
+        :param dql
+        :return (sql_list, bridging, columns_alias, post)，post 为 None 时不需要关联后处理，见 plan_query
+        '''
+
+        (sql_list, bridging, columns_alias, post), literals = self.get_plan(dql, self.plan_query)
+        sql_list = {name: self.bind(sql, literals) for name, sql in sql_list.items()}
+
+        post = copy.deepcopy(post)
+        if post is not None and post.get('limit') is not None:
+            post['limit'] = tuple(int(self.bind(x, literals)) for x in post.get('limit'))
+
+        return sql_list, copy.deepcopy(bridging), list(columns_alias), post
+
+    def get_plan(self, dql: str, planner):
+        ''' 获取缓存的执行计划
+
+        :return (执行计划, 字面量列表)
+        '''
+
+        key, literals = self.normalize(dql)
+        plan = plan_cache.get((planner.__name__, key))
+        if plan is None:
+            plan = planner(key)
+            plan_cache.set((planner.__name__, key), plan)
+
+        return plan, literals
+
+    def bind(self, sql: str, literals: list):
+        ''' 把占位符替换回字面量 '''
+
+        return PARAM_PATTERN.sub(lambda x: literals[int(x.group(1))], sql)
+
+    def plan(self, dql: str):
+        ''' 生成执行计划（拆分后的 SQL、关联关系、字段别名） '''
+
+        return self.build(self.parse(dql))
+
+    def plan_query(self, dql: str):
+        ''' 生成执行计划，排序、分组、分页及聚合函数在关联后处理
+
+        聚合函数改为查询其参数（COUNT(*) 不查询），分组、排序字段未在查询字段中时追加隐藏字段；
+        不分组且排序字段都属于主查询时，排序下推到主查询（主查询的顺序即结果的顺序）；
+        此时关联都是 LEFT JOIN 的，分页（offset + count 行）也下推到主查询
+
+        :return (sql_list, bridging, columns_alias, post)，post：columns 输出字段、group 分组字段、
+                aggregates 聚合 [(输出字段, 函数, 是否 DISTINCT, 查询字段)]、order 排序 [(字段, 是否降序)]、
+                limit (offset, count)、push_limit 分页是否下推到主查询
+        '''
+
         result = self.parse(dql)
+        clauses = result.pop('clauses', dict())
+        tables, _ = self.split_tables_joins(result)
+
+        # 单个连接时全部由数据库处理
+        if len(tables) == 1:
+            return self.build(result) + (None,)
+
+        mapping = {t[2]: name for name, items in tables.items() for t in items}
+        driving = list(tables.keys())[0]
+
+        columns = []
+        output = []
+        # 字段表达式 => 输出字段
+        expressions = dict()
+        aggregates = []
+
+        for item in result.get('columns'):
+            if type(item) is not list:
+                continue
+
+            alias = item[-1].strip("'\"")
+            expression = ''.join(item[0:-2]) if len(item) >= 3 and item[-2] == 'AS' else ''.join(item)
+            output.append(alias)
+            expressions[expression] = alias
+
+            match = AGGREGATE_PATTERN.match(expression)
+            if match is not None and not self.is_balanced(match.group(3)):
+                # 例如：SUM(a) + SUM(b)
+                match = None
+            if match is None:
+                columns.append(item)
+                continue
+
+            function, distinct, argument = match.group(1).upper(), match.group(2) is not None, match.group(3).strip()
+            if function == 'COUNT' and distinct is False and argument in ('*', '1'):
+                # 只计算行数，不需要查询
+                aggregates.append((alias, function, False, None))
+                continue
+
+            source = f'__agg_{len(aggregates)}'
+            columns.append([argument, 'AS', source])
+            aggregates.append((alias, function, distinct, source))
+
+        # 没有排序、分组、分页及聚合函数
+        if len(clauses) == 0 and len(aggregates) == 0:
+            return self.build(result) + (None,)
+
+        if 'having' in clauses:
+            raise exceptions.RuntimeError((400, '跨库查询不支持 HAVING'))
+
+        def resolve(expression: str, prefix: str):
+            ''' 分组、排序字段对应的输出字段，未在查询字段中时追加隐藏字段 '''
+
+            if expression in expressions:
+                return expressions.get(expression)
+            if expression in output:
+                return expression
+            alias = f'{prefix}{len(columns)}'
+            columns.append([expression, 'AS', alias])
+            expressions[expression] = alias
+            return alias
+
+        group = [resolve(''.join(field), '__group_') for field, _ in clauses.get('group', [])]
+        grouped = len(group) > 0 or len(aggregates) > 0
+
+        order = []
+        push_order = ''
+        for field, desc in clauses.get('order', []):
+            expression = ''.join(field)
+            if grouped:
+                alias = expressions.get(expression, expression)
+                if alias not in output and alias not in group:
+                    raise exceptions.RuntimeError((400, f'分组查询的排序字段须为分组字段或查询字段：{expression}'))
+            else:
+                alias = resolve(expression, '__order_')
+            order.append((alias, desc))
+
+        # 不分组且排序字段都属于主查询时，排序下推到主查询
+        if grouped is False and len(order) > 0:
+            fields = [FIELD_PATTERN.findall(''.join(field)) for field, _ in clauses.get('order')]
+            if all(len(x) > 0 and all(mapping.get(t[0]) == driving for t in x) for x in fields):
+                push_order = ' ORDER BY ' + ', '.join(''.join(field) + (' DESC' if desc else '') for field, desc in clauses.get('order'))
+                order = []
+
+        result['columns'] = columns
+        result['other'] = []
+        sql_list, bridging, columns_alias = self.build(result)
+
+        if push_order != '':
+            sql_list[driving] = sql_list[driving].rstrip() + push_order
+
+        post = {
+            'columns': output,
+            'group': group,
+            'aggregates': aggregates,
+            'order': order,
+            'limit': clauses.get('limit'),
+            # 关联都是 LEFT JOIN 时，结果的前 N 行只来自主查询的前 N 行
+            'push_limit': grouped is False and len(order) == 0 and all(x[0].upper() == 'LEFT' for x in bridging.values()),
+        }
+
+        return sql_list, bridging, columns_alias, post
+
+    def is_balanced(self, expression: str):
+        ''' 括号是否配对 '''
+
+        depth = 0
+        for token in tokenize(expression):
+            if token[1] == '(':
+                depth += 1
+            elif token[1] == ')':
+                depth -= 1
+                if depth < 0:
+                    return False
+        return depth == 0
+
+    def build(self, result: dict):
+        ''' 按解析结果生成执行计划 '''
+
         tables, joins = self.split_tables_joins(result)
         mapping = dict()
         sql_map = dict()
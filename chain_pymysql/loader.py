@@ -0,0 +1,144 @@
+# chain-pymysql: Easy to use pymysql.
+
+# @link https://github.com/Tiacx/chain-pymysql
+# @copyright Copyright (c) 2022 Tiac
+# @license MIT
+# @author Tiac
+# @since 1.1
+
+import uuid
+import threading
+import pymysql.connections
+
+
+# 虚拟文件：文件名 => 数据块生成器（LOAD DATA LOCAL INFILE 请求该文件名时发送生成器的数据）
+streams = dict()
+# 是否已替换 PyMySQL 发送本地文件的函数
+installed = False
+install_lock = threading.Lock()
+
+# LOAD DATA 默认格式（FIELDS ESCAPED BY '\\'）需要转义的字符
+ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'})
+BYTES_ESCAPES = ((b'\\', b'\\\\'), (b'\t', b'\\t'), (b'\n', b'\\n'), (b'\r', b'\\r'), (b'\0', b'\\0'))
+
+
+def install():
+    ''' 替换 PyMySQL 发送本地文件的函数，使 LOAD DATA LOCAL INFILE 支持虚拟文件（只替换一次） '''
+
+    global installed
+
+    with install_lock:
+        if installed:
+            return
+
+        if hasattr(pymysql.connections, '_send_local_file'):
+            # PyMySQL >= 1.1
+            send_local_file = pymysql.connections._send_local_file
+
+            def _send_local_file(filename, conn):
+                data = streams.pop(normalize(filename), None)
+                if data is None:
+                    return send_local_file(filename, conn)
+                send_stream(conn, data)
+
+            pymysql.connections._send_local_file = _send_local_file
+        else:
+            # PyMySQL < 1.1
+            LoadLocalFile = pymysql.connections.LoadLocalFile
+            send_data = LoadLocalFile.send_data
+
+            def _send_data(self):
+                data = streams.pop(normalize(self.filename), None)
+                if data is None:
+                    return send_data(self)
+                try:
+                    send_stream(self.connection, data)
+                finally:
+                    # 空包表示发送完毕
+                    self.connection.write_packet(b'')
+
+            LoadLocalFile.send_data = _send_data
+
+        installed = True
+
+
+def normalize(filename):
+    ''' 服务器返回的文件名可能是 bytes '''
+
+    if isinstance(filename, (bytes, bytearray)):
+        return bytes(filename).decode('utf8', 'surrogateescape')
+    return filename
+
+
+def register(chunks):
+    ''' 注册虚拟文件
+
+    :param chunks: 数据块生成器（bytes）
+    :return 文件名
+    '''
+
+    filename = 'chain_pymysql_stream_' + uuid.uuid4().hex
+    streams[filename] = chunks
+    return filename
+
+
+def unregister(filename: str):
+    ''' 注销虚拟文件（执行失败、服务器没有读取时） '''
+
+    streams.pop(filename, None)
+
+
+def send_stream(conn, chunks):
+    ''' 按包发送数据块 '''
+
+    packet_size = min(conn.max_allowed_packet, 16 * 1024)
+
+    for chunk in chunks:
+        for i in range(0, len(chunk), packet_size):
+            conn.write_packet(chunk[i:i + packet_size])
+
+
+def encode_value(value):
+    ''' 按 LOAD DATA 默认格式编码一个值 '''
+
+    if value is None:
+        return b'\\N'
+    if value is True or value is False:
+        return b'1' if value else b'0'
+    if isinstance(value, (bytes, bytearray)):
+        value = bytes(value)
+        for k, v in BYTES_ESCAPES:
+            value = value.replace(k, v)
+        return value
+    return str(value).translate(ESCAPES).encode('utf8', 'surrogateescape')
+
+
+def encode_rows(rows, keys=None, chunk_size=65536):
+    ''' 把多行数据编码为 LOAD DATA 默认格式（字段以 \\t 分隔，行以 \\n 结尾，NULL 为 \\N）
+
+    :param rows: 可迭代的多行数据，dict 或 tuple/list
+    :param keys: dict 行取值的键
+    :param chunk_size: 每个数据块的大约字节数
+    :return generator（bytes）
+    '''
+
+    lines = []
+    size = 0
+
+    for row in rows:
+        if isinstance(row, dict):
+            values = [row.get(k) for k in keys]
+        else:
+            values = row
+
+        line = b'\t'.join([encode_value(x) for x in values]) + b'\n'
+        lines.append(line)
+        size += len(line)
+
+        if size >= chunk_size:
+            yield b''.join(lines)
+            lines = []
+            size = 0
+
+    if len(lines) > 0:
+        yield b''.join(lines)
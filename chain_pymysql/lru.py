@@ -0,0 +1,190 @@
+# chain-pymysql: Easy to use pymysql.
+
+# @link https://github.com/Tiacx/chain-pymysql
+# @copyright Copyright (c) 2022 Tiac
+# @license MIT
+# @author Tiac
+# @since 1.1
+
+import time
+import threading
+import collections
+
+
+class LRUCache(object):
+    ''' 线程安全的 LRU 缓存（超过容量时淘汰最久未使用的项） '''
+
+    def __init__(self, maxsize=1024):
+        '''
+        :param maxsize: 最大缓存数量，0：不缓存
+        '''
+
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key, default=None):
+        ''' 获取缓存，命中时移到最近使用的位置 '''
+
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self._stats['misses'] += 1
+                return default
+            self._data.move_to_end(key)
+            self._stats['hits'] += 1
+            return value
+
+    def set(self, key, value):
+        ''' 设置缓存 '''
+
+        with self._lock:
+            if self.maxsize <= 0:
+                return
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def resize(self, maxsize: int):
+        ''' 修改最大缓存数量 '''
+
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._data) > max(maxsize, 0):
+                self._data.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        ''' 清空缓存 '''
+
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        ''' 缓存统计信息 '''
+
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({'size': len(self._data), 'maxsize': self.maxsize})
+            total = stats['hits'] + stats['misses']
+            stats['hit_rate'] = stats['hits'] / total if total else 0.0
+            return stats
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResultCache(LRUCache):
+    ''' 查询结果缓存：LRU + 过期时间，按表记录缓存项，表被写入时使相关的缓存失效 '''
+
+    def __init__(self, maxsize=1024):
+        '''
+        :param maxsize: 最大缓存数量，0：不缓存
+        '''
+
+        super().__init__(maxsize)
+        # 表 => 缓存键集合
+        self._tables = dict()
+        # 表 => 失效次数（查询期间表被写入时不缓存查询结果）
+        self._versions = dict()
+        self._stats.update({'expirations': 0, 'invalidations': 0})
+
+    def get(self, key, default=None):
+        ''' 获取缓存，过期时删除 '''
+
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._stats['misses'] += 1
+                return default
+
+            value, expires_at, _ = item
+            if expires_at is not None and time.monotonic() >= expires_at:
+                self._remove(key)
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return default
+
+            self._data.move_to_end(key)
+            self._stats['hits'] += 1
+            return value
+
+    def version(self, tables: frozenset):
+        ''' 表的失效次数（查询前获取，缓存时比较） '''
+
+        with self._lock:
+            return tuple(self._versions.get(x, 0) for x in sorted(tables))
+
+    def set(self, key, value, ttl=None, tables=frozenset(), version=None):
+        ''' 设置缓存
+
+        :param key: 缓存键
+        :param value: 查询结果
+        :param ttl: 过期时间（秒），None：不过期
+        :param tables: 查询的表
+        :param version: 查询前的 version(tables)，查询期间表被写入时不缓存
+        '''
+
+        with self._lock:
+            if self.maxsize <= 0:
+                return
+            if version is not None and version != tuple(self._versions.get(x, 0) for x in sorted(tables)):
+                return
+
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, None if ttl is None else time.monotonic() + ttl, tables)
+            for table in tables:
+                self._tables.setdefault(table, set()).add(key)
+
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+                self._stats['evictions'] += 1
+
+    def invalidate(self, tables):
+        ''' 使表的缓存失效
+
+        :param tables: 表名集合
+        :return 失效的缓存数量
+        '''
+
+        count = 0
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+                for key in list(self._tables.get(table, ())):
+                    self._remove(key)
+                    count += 1
+            self._stats['invalidations'] += count
+        return count
+
+    def _remove(self, key):
+        ''' 删除缓存项及表的索引（在锁内调用） '''
+
+        _, _, tables = self._data.pop(key)
+        for table in tables:
+            keys = self._tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._tables[table]
+
+    def resize(self, maxsize: int):
+        ''' 修改最大缓存数量 '''
+
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._data) > max(maxsize, 0):
+                self._remove(next(iter(self._data)))
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        ''' 清空缓存 '''
+
+        with self._lock:
+            self._data.clear()
+            self._tables.clear()
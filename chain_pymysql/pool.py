@@ -0,0 +1,627 @@
+# chain-pymysql: Easy to use pymysql.
+
+# @link https://github.com/Tiacx/chain-pymysql
+# @copyright Copyright (c) 2022 Tiac
+# @license MIT
+# @author Tiac
+# @since 1.1
+
+import time
+import random
+import threading
+import collections
+import concurrent.futures
+import pymysql
+import pymysql.cursors
+from pymysql.constants import CR, SERVER_STATUS
+from . import exceptions
+
+
+# 连接断开的错误码
+LOST_CONNECTION_ERRORS = (CR.CR_SERVER_GONE_ERROR, CR.CR_SERVER_LOST, CR.CR_SERVER_LOST_EXTENDED)
+# KILL QUERY 使用的连接的超时时间（秒）
+KILL_TIMEOUT = 2
+
+
+def is_connection_lost(e: Exception):
+    ''' 是否为连接断开的异常 '''
+
+    if isinstance(e, pymysql.err.OperationalError):
+        return len(e.args) > 0 and e.args[0] in LOST_CONNECTION_ERRORS
+    # 连接已关闭时，pymysql 抛出 InterfaceError(0, '')
+    return isinstance(e, pymysql.err.InterfaceError)
+
+
+class ConnectionPool(object):
+    ''' 连接池（每个连接名称对应一个连接池） '''
+
+    def __init__(self, options: dict, min_size=1, max_size=10, max_idle=600, max_lifetime=3600, acquire_timeout=10, ping_interval=30):
+        '''
+        :param options: pymysql 连接参数
+        :param min_size: 最小连接数，回收空闲连接时至少保留的连接数
+        :param max_size: 最大连接数
+        :param max_idle: 最大空闲时间（秒），超过则关闭连接，0：不限制
+        :param max_lifetime: 连接最长存活时间（秒），超过则在归还时关闭连接，0：不限制
+        :param acquire_timeout: 获取连接的超时时间（秒）
+        :param ping_interval: 连接空闲超过该时间（秒）才在借出前 ping 检测，0：每次借出都检测
+        '''
+
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise exceptions.RuntimeError((400, '连接池大小须满足 0 <= min_size <= max_size 且 max_size >= 1'))
+
+        self.options = options
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.acquire_timeout = acquire_timeout
+        self.ping_interval = ping_interval
+        # 默认数据库（switch 永久切换数据库时会修改）
+        self.database = options.get('database', options.get('db'))
+        # 服务器的 max_allowed_packet（首次批量插入时查询）
+        self.max_allowed_packet = None
+        # 从库（读写分离时为 ReplicaSet）
+        self.replicas = None
+
+        # 空闲连接（后进先出，尽量复用热连接）
+        self._idle = collections.deque()
+        # 连接信息：id(conn) => [创建时间, 最后归还时间, 当前数据库]
+        self._info = dict()
+        # 连接总数（含使用中）
+        self._size = 0
+        # 使用中的连接数
+        self._in_use = 0
+        # 等待中的线程数
+        self._waiting = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        # 统计信息
+        self._stats = {
+            'acquired': 0,
+            'created': 0,
+            'closed': 0,
+            'timeouts': 0,
+            'pings': 0,
+            'reconnects': 0,
+            'retries': 0,
+            'wait_time': 0.0,
+            'max_wait_time': 0.0,
+        }
+
+        # 预先创建最小连接数
+        for _ in range(min_size):
+            self._size += 1
+            conn = self._connect()
+            self._info[id(conn)][1] = time.monotonic()
+            self._idle.append(conn)
+
+    def _connect(self):
+        ''' 新建连接 '''
+
+        conn = pymysql.connect(**self.options)
+        self._info[id(conn)] = [time.monotonic(), time.monotonic(), self.options.get('database', self.options.get('db'))]
+        self._stats['created'] += 1
+        return conn
+
+    def _count(self, key: str, val=1):
+        ''' 累加统计信息 '''
+
+        with self._cond:
+            self._stats[key] += val
+
+    def _discard(self, conn):
+        ''' 关闭并丢弃连接（不在锁内调用） '''
+
+        self._info.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _expired(self, conn, now: float):
+        ''' 连接是否超过最长存活时间 '''
+
+        info = self._info.get(id(conn))
+        return info is None or (self.max_lifetime > 0 and now - info[0] > self.max_lifetime)
+
+    def _reap(self, now: float):
+        ''' 回收超时的空闲连接（在锁内调用），返回需要关闭的连接 '''
+
+        discards = []
+        if self.max_idle <= 0:
+            return discards
+
+        # 最早归还的连接在队列头部
+        while self._idle and self._size > self.min_size:
+            info = self._info.get(id(self._idle[0]))
+            if info is not None and now - info[1] <= self.max_idle:
+                break
+            discards.append(self._idle.popleft())
+            self._size -= 1
+            self._stats['closed'] += 1
+
+        return discards
+
+    def acquire(self, db_name=None):
+        ''' 借出连接
+
+        :param db_name: 使用的数据库，默认为连接池的默认数据库
+        :return pymysql.connections.Connection
+        '''
+
+        start = time.monotonic()
+        deadline = start + self.acquire_timeout
+        conn = None
+        discards = []
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise exceptions.RuntimeError((400, '连接池已关闭'))
+
+                now = time.monotonic()
+                discards.extend(self._reap(now))
+
+                if self._idle:
+                    conn = self._idle.pop()
+                    if self._expired(conn, now):
+                        discards.append(conn)
+                        self._size -= 1
+                        self._stats['closed'] += 1
+                        conn = None
+                        continue
+                    break
+
+                if self._size < self.max_size:
+                    # 先占位，在锁外建立连接
+                    self._size += 1
+                    break
+
+                remaining = deadline - now
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise exceptions.RuntimeError((408, '获取数据库连接超时（连接池已满）'))
+
+                self._waiting += 1
+                self._cond.wait(remaining)
+                self._waiting -= 1
+
+            self._in_use += 1
+            wait_time = time.monotonic() - start
+            self._stats['acquired'] += 1
+            self._stats['wait_time'] += wait_time
+            self._stats['max_wait_time'] = max(self._stats['max_wait_time'], wait_time)
+
+        for x in discards:
+            self._discard(x)
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            else:
+                self._check(conn, time.monotonic())
+            self.use_db(conn, db_name)
+        except Exception:
+            if conn is not None:
+                self._discard(conn)
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        return conn
+
+    def _check(self, conn, now: float):
+        ''' 空闲超过 ping_interval 的连接，借出前检查是否可用（断线重连） '''
+
+        info = self._info.get(id(conn))
+        if info is not None and now - info[1] < self.ping_interval:
+            return
+
+        self._count('pings')
+        self._ping(conn)
+
+    def _ping(self, conn):
+        ''' ping 连接，断线则重连 '''
+
+        thread_id = conn.thread_id() if conn.open else None
+        conn.ping(reconnect=True)
+        # 重连后会回到连接参数里的数据库
+        if conn.thread_id() != thread_id:
+            self._count('reconnects')
+            self._info[id(conn)][2] = self.options.get('database', self.options.get('db'))
+
+    def reconnect(self, conn, db_name=None):
+        ''' 执行中发现连接断开时重连（用于重试查询）
+
+        :param conn: 连接池借出的连接
+        :param db_name: 使用的数据库，默认为连接池的默认数据库
+        '''
+
+        self._count('retries')
+        self._ping(conn)
+        self.use_db(conn, db_name)
+
+    def use_db(self, conn, db_name=None):
+        ''' 切换连接使用的数据库（仅在与当前数据库不同时切换）
+
+        :param conn: 连接池借出的连接
+        :param db_name: 数据库名称，默认为连接池的默认数据库
+        '''
+
+        db_name = db_name or self.database
+        info = self._info.get(id(conn))
+        if db_name and info is not None and info[2] != db_name:
+            conn.select_db(db_name)
+            info[2] = db_name
+
+    def release(self, conn):
+        ''' 归还连接 '''
+
+        discard = False
+
+        # 未结束的事务一律回滚，避免影响下一个使用者
+        if conn.open and conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            now = time.monotonic()
+            if discard or self._closed or not conn.open or self._expired(conn, now):
+                discard = True
+                self._size -= 1
+                self._stats['closed'] += 1
+            else:
+                self._info[id(conn)][1] = now
+                self._idle.append(conn)
+            self._cond.notify()
+
+        if discard:
+            self._discard(conn)
+
+    def owns(self, conn):
+        ''' 是否为本连接池的连接 '''
+
+        return id(conn) in self._info
+
+    def replica_lag(self):
+        ''' 从库延迟（秒），复制中断时返回 None，不是从库时返回 0 '''
+
+        conn = self.acquire()
+        try:
+            cursor = conn.cursor(pymysql.cursors.DictCursor)
+            try:
+                cursor.execute('SHOW REPLICA STATUS')
+            except pymysql.err.ProgrammingError:
+                # MySQL < 8.0.22
+                cursor.execute('SHOW SLAVE STATUS')
+            status = cursor.fetchone()
+            cursor.close()
+        finally:
+            self.release(conn)
+
+        if not status:
+            return 0
+
+        lag = status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+        return None if lag is None else int(lag)
+
+    def stats(self):
+        ''' 连接池统计信息 '''
+
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+            })
+            stats['avg_wait_time'] = stats['wait_time'] / stats['acquired'] if stats['acquired'] else 0.0
+            return stats
+
+    def close(self):
+        ''' 关闭连接池（使用中的连接在归还时关闭） '''
+
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._stats['closed'] += len(idle)
+            self._cond.notify_all()
+
+        for conn in idle:
+            self._discard(conn)
+
+        if self.replicas is not None:
+            self.replicas.close()
+
+
+class ReplicaSet(object):
+    ''' 从库集合（读写分离）：查询按负载均衡分发到从库，延迟超过阈值的从库暂不使用 '''
+
+    def __init__(self, pools: list, weights: list, balance='least', max_lag=None, lag_interval=5, hedge=None):
+        '''
+        :param pools: 从库的连接池
+        :param weights: 从库的权重
+        :param balance: 负载均衡策略，least：未完成请求数最少（按权重），weighted：按权重随机
+        :param max_lag: 最大延迟（秒），超过则暂不使用该从库，None：不检测
+        :param lag_interval: 检测延迟的间隔（秒）
+        :param hedge: 对冲读的延迟百分位，例如 95：查询耗时超过最近查询耗时的 P95 时，再发送到另一个从库，None：不开启
+        '''
+
+        if balance not in ['least', 'weighted']:
+            raise exceptions.RuntimeError((400, 'balance 须为 least 或 weighted'))
+
+        if any(x <= 0 for x in weights):
+            raise exceptions.RuntimeError((400, '从库的权重须大于0'))
+
+        if hedge is not None and not 0 < hedge < 100:
+            raise exceptions.RuntimeError((400, 'hedge 须大于0且小于100'))
+
+        self.pools = pools
+        self.weights = weights
+        self.balance = balance
+        self.max_lag = max_lag
+        self.lag_interval = lag_interval
+        # 各从库的延迟（秒），复制中断、检测失败或尚未检测时为 None（不可用，查询使用主库）
+        self.lags = [0 if max_lag is None else None] * len(pools)
+        # 上次检测延迟的时间
+        self.checked_at = None
+        # 各从库被选中的次数（未完成请求数相同时按权重轮流使用）
+        self._chosen = [0] * len(pools)
+        self._chosen_lock = threading.Lock()
+        # 检测延迟的锁（同一时间只有一个线程检测）
+        self._lock = threading.Lock()
+
+        self.hedge = hedge
+        # 最近的查询耗时（秒），用于计算对冲延迟
+        self.latencies = collections.deque(maxlen=1000)
+        # 记录的查询耗时总数（deque 写满后长度不再变化）
+        self._recorded = 0
+        # 对冲延迟（秒），查询耗时样本不足时为 None（不对冲）
+        self.hedge_delay = None
+        # 各从库收到的对冲查询数、对冲查询先返回的次数
+        self.hedges = [0] * len(pools)
+        self.hedge_wins = [0] * len(pools)
+        self._executor = None
+        self._hedge_lock = threading.Lock()
+
+    def choose(self, exclude=None):
+        ''' 选择从库，没有可用的从库时返回 None
+
+        :param exclude: 排除的从库
+        :return ConnectionPool 或 None
+        '''
+
+        # 延迟在后台检测，本次查询使用上次的结果
+        if self.max_lag is not None and (self.checked_at is None or time.monotonic() - self.checked_at >= self.lag_interval):
+            self.refresh_lag()
+
+        candidates = [i for i in range(len(self.pools)) if self.available(i) and self.pools[i] is not exclude]
+        if len(candidates) == 0:
+            return None
+
+        if self.balance == 'weighted':
+            index = random.choices(candidates, [self.weights[i] for i in candidates])[0]
+        else:
+            with self._chosen_lock:
+                index = min(candidates, key=lambda i: (self.pools[i]._in_use / self.weights[i], self._chosen[i] / self.weights[i]))
+                self._chosen[index] += 1
+
+        return self.pools[index]
+
+    def available(self, index: int):
+        ''' 从库是否可用（延迟未超过阈值） '''
+
+        if self.max_lag is None:
+            return True
+
+        lag = self.lags[index]
+        return lag is not None and lag <= self.max_lag
+
+    def refresh_lag(self):
+        ''' 在后台线程检测各从库的延迟（同一时间只有一个线程检测），不等待检测结果 '''
+
+        if not self._lock.acquire(blocking=False):
+            return
+
+        try:
+            threading.Thread(target=self._check_lag, name='chain_pymysql_lag', daemon=True).start()
+        except Exception:
+            self._lock.release()
+            raise
+
+    def check_lag(self):
+        ''' 检测各从库的延迟（同一时间只有一个线程检测，其他线程使用上次的结果） '''
+
+        if not self._lock.acquire(blocking=False):
+            return
+
+        self._check_lag()
+
+    def _check_lag(self):
+        ''' 检测各从库的延迟，完成后释放检测延迟的锁（调用方已获得锁） '''
+
+        try:
+            for i, pool in enumerate(self.pools):
+                try:
+                    self.lags[i] = pool.replica_lag()
+                except Exception:
+                    self.lags[i] = None
+            self.checked_at = time.monotonic()
+        finally:
+            self._lock.release()
+
+    def execute_hedged(self, pool, sql: str, args=None, db_name=None):
+        ''' 对冲读：查询超过对冲延迟仍未返回时，同一查询再发送到另一个从库，
+        先返回的结果胜出，未返回的查询用 KILL QUERY 取消
+
+        :param pool: 首选的从库
+        :param sql
+        :param args: sql 参数
+        :param db_name: 使用的数据库，默认为连接池的默认数据库
+        :return (cursor, sql)
+        '''
+
+        # 执行中的查询：从库下标 => 连接的 thread_id；已取消的查询：从库下标
+        state = {'lock': threading.Lock(), 'running': dict(), 'killed': set()}
+        first = self.pools.index(pool)
+
+        # 查询耗时样本不足时不对冲
+        if self.hedge_delay is None:
+            return self._attempt(first, sql, args, db_name, state)
+
+        executor = self._get_executor()
+        futures = {executor.submit(self._attempt, first, sql, args, db_name, state): first}
+        done, _ = concurrent.futures.wait(futures, timeout=self.hedge_delay)
+
+        if len(done) == 0:
+            second = self.choose(exclude=pool)
+            if second is not None:
+                index = self.pools.index(second)
+                with self._hedge_lock:
+                    self.hedges[index] += 1
+                futures[executor.submit(self._attempt, index, sql, args, db_name, state)] = index
+
+        # 先成功返回的结果胜出，都失败时抛出首选从库的异常
+        pending = set(futures)
+        while len(pending) > 0:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    continue
+                index = futures[future]
+                if index != first:
+                    with self._hedge_lock:
+                        self.hedge_wins[index] += 1
+                for x in pending:
+                    executor.submit(self._kill, futures[x], state)
+                return future.result()
+
+        return [x for x in futures if futures[x] == first][0].result()
+
+    def _attempt(self, index: int, sql: str, args, db_name, state: dict):
+        ''' 在一个从库上执行查询（结果已缓存在游标中，执行完毕即归还连接）；
+        连接断开时重连并重试一次（同 imysql._execute_read）
+        '''
+
+        pool = self.pools[index]
+        conn = pool.acquire(db_name)
+        try:
+            cursor = conn.cursor()
+            sql = cursor.mogrify(sql, args)
+            with state['lock']:
+                state['running'][index] = conn.thread_id()
+            start = time.monotonic()
+            try:
+                cursor.execute(sql)
+            except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+                # 已被取消的查询不重试
+                with state['lock']:
+                    killed = index in state['killed']
+                if not is_connection_lost(e) or killed:
+                    raise e
+
+                pool.reconnect(conn, db_name)
+                with state['lock']:
+                    state['running'][index] = conn.thread_id()
+                cursor = conn.cursor()
+                cursor.execute(sql)
+            self._record(time.monotonic() - start)
+            return cursor, sql
+        finally:
+            with state['lock']:
+                state['running'].pop(index, None)
+                killed = index in state['killed']
+            # 被 KILL 的连接可能残留中断标记，关闭后不再复用
+            if killed:
+                conn.close()
+            pool.release(conn)
+
+    def _kill(self, index: int, state: dict):
+        ''' 取消未返回的查询（KILL QUERY），查询已结束时不执行
+
+        使用连接池外的临时连接（超时 KILL_TIMEOUT 秒），不占用、不等待慢从库的连接池
+        '''
+
+        with state['lock']:
+            if index not in state['running']:
+                return
+
+        pool = self.pools[index]
+        try:
+            conn = pymysql.connect(**dict(pool.options, connect_timeout=KILL_TIMEOUT, read_timeout=KILL_TIMEOUT, write_timeout=KILL_TIMEOUT))
+        except Exception:
+            return
+
+        try:
+            # 持有锁时查询所在的连接不会归还连接池（不会误杀其他查询）
+            with state['lock']:
+                thread_id = state['running'].get(index)
+                if thread_id is None:
+                    return
+                state['killed'].add(index)
+                cursor = conn.cursor()
+                cursor.execute('KILL QUERY %d' % thread_id)
+                cursor.close()
+        except Exception:
+            pass
+        finally:
+            conn.close()
+
+    def _record(self, latency: float):
+        ''' 记录查询耗时，每 50 次重新计算对冲延迟（百分位） '''
+
+        if self.hedge is None:
+            return
+
+        with self._hedge_lock:
+            self.latencies.append(latency)
+            self._recorded += 1
+            if self._recorded % 50 == 0 or (self.hedge_delay is None and len(self.latencies) >= 20):
+                latencies = sorted(self.latencies)
+                self.hedge_delay = latencies[min(int(len(latencies) * self.hedge / 100), len(latencies) - 1)]
+
+    def _get_executor(self):
+        ''' 对冲读的线程池（每个查询最多占用一个连接，线程数为所有从库的最大连接数之和） '''
+
+        if self._executor is None:
+            with self._hedge_lock:
+                if self._executor is None:
+                    workers = sum(x.max_size for x in self.pools) + len(self.pools)
+                    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        return self._executor
+
+    def stats(self):
+        ''' 各从库的统计信息（连接池统计信息及 weight、lag、available、hedges、hedge_wins） '''
+
+        results = []
+        for i, pool in enumerate(self.pools):
+            stats = pool.stats()
+            stats.update({
+                'weight': self.weights[i],
+                'lag': self.lags[i],
+                'available': self.available(i),
+                'hedges': self.hedges[i],
+                'hedge_wins': self.hedge_wins[i],
+            })
+            results.append(stats)
+        return results
+
+    def close(self):
+        ''' 关闭所有从库的连接池 '''
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+        for pool in self.pools:
+            pool.close()
@@ -0,0 +1,432 @@
+# chain-pymysql: Easy to use pymysql.
+
+# @link https://github.com/Tiacx/chain-pymysql
+# @copyright Copyright (c) 2022 Tiac
+# @license MIT
+# @author Tiac
+# @since 1.1
+
+import os
+import mmap
+import time
+import zlib
+import struct
+import decimal
+import hashlib
+import datetime
+import threading
+import contextlib
+from . import exceptions
+from .lru import LRUCache
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# 文件头：魔数、数据区大小、槽位数、表版本计数器数、写入位置（累计写入字节数）、清空次数
+HEADER = struct.Struct('<8sQIIQQ')
+MAGIC = b'CPMYSHM1'
+# 槽位：键的摘要、记录的写入位置、记录长度、过期时间（0：不过期）、清空次数
+SLOT = struct.Struct('<16sQIdQ')
+# 表版本计数器
+COUNTER = struct.Struct('<Q')
+# 记录头：表数量；每个表：计数器下标、版本
+RECORD_HEADER = struct.Struct('<H')
+RECORD_TABLE = struct.Struct('<IQ')
+
+# 值的类型标记（不使用 pickle，共享文件中的数据不能执行代码）
+(TAG_NONE, TAG_INT, TAG_FLOAT, TAG_STR, TAG_BYTES, TAG_TRUE, TAG_FALSE, TAG_BIGINT,
+ TAG_DECIMAL, TAG_DATETIME, TAG_DATE, TAG_TIME, TAG_TIMEDELTA) = range(13)
+# 以字符串保存的类型：类型 => 标记
+STR_TAGS = {
+    decimal.Decimal: TAG_DECIMAL,
+    datetime.datetime: TAG_DATETIME,
+    datetime.date: TAG_DATE,
+    datetime.time: TAG_TIME,
+}
+INT64 = struct.Struct('<q')
+# timedelta：天、秒、微秒
+TIMEDELTA = struct.Struct('<qII')
+FLOAT64 = struct.Struct('<d')
+UINT32 = struct.Struct('<I')
+UINT16 = struct.Struct('<H')
+
+
+def encode_result(rows) -> bytes:
+    ''' 查询结果编码为紧凑的二进制格式：列名只保存一次，值带类型标记
+
+    :param rows: list of dict（各行的列相同）
+    :return bytes，有不支持的类型时抛出 TypeError
+    '''
+
+    columns = list(rows[0].keys()) if len(rows) > 0 else []
+    parts = [UINT32.pack(len(columns))]
+    for column in columns:
+        name = column.encode('utf-8')
+        parts.append(UINT16.pack(len(name)))
+        parts.append(name)
+
+    parts.append(UINT32.pack(len(rows)))
+    for row in rows:
+        for column in columns:
+            value = row.get(column)
+            if value is None:
+                parts.append(b'\x00')
+            elif value is True:
+                parts.append(b'\x05')
+            elif value is False:
+                parts.append(b'\x06')
+            elif type(value) is int:
+                if -2 ** 63 <= value < 2 ** 63:
+                    parts.append(b'\x01' + INT64.pack(value))
+                else:
+                    data = str(value).encode('utf-8')
+                    parts.append(bytes([TAG_BIGINT]) + UINT32.pack(len(data)))
+                    parts.append(data)
+            elif type(value) is float:
+                parts.append(b'\x02' + FLOAT64.pack(value))
+            elif type(value) is str:
+                data = value.encode('utf-8')
+                parts.append(b'\x03' + UINT32.pack(len(data)))
+                parts.append(data)
+            elif type(value) is bytes or type(value) is bytearray:
+                parts.append(b'\x04' + UINT32.pack(len(value)))
+                parts.append(bytes(value))
+            elif type(value) is datetime.timedelta:
+                parts.append(bytes([TAG_TIMEDELTA]) + TIMEDELTA.pack(value.days, value.seconds, value.microseconds))
+            elif type(value) in STR_TAGS:
+                data = str(value).encode('utf-8') if type(value) is decimal.Decimal else value.isoformat().encode('utf-8')
+                parts.append(bytes([STR_TAGS[type(value)]]) + UINT32.pack(len(data)))
+                parts.append(data)
+            else:
+                raise TypeError(f'共享缓存不支持的类型：{type(value).__name__}')
+
+    return b''.join(parts)
+
+
+def decode_result(buffer, offset=0):
+    ''' 解码 encode_result 的结果（从 memoryview 读取，每次解码出新的 list 及 dict）
+
+    :param buffer: bytes 或 memoryview
+    :param offset: 起始位置
+    :return list of dict
+    '''
+
+    ncols = UINT32.unpack_from(buffer, offset)[0]
+    offset += 4
+    columns = []
+    for _ in range(ncols):
+        size = UINT16.unpack_from(buffer, offset)[0]
+        offset += 2
+        columns.append(bytes(buffer[offset:offset + size]).decode('utf-8'))
+        offset += size
+
+    nrows = UINT32.unpack_from(buffer, offset)[0]
+    offset += 4
+    rows = []
+    for _ in range(nrows):
+        row = dict()
+        for column in columns:
+            tag = buffer[offset]
+            offset += 1
+            if tag == TAG_NONE:
+                value = None
+            elif tag == TAG_INT:
+                value = INT64.unpack_from(buffer, offset)[0]
+                offset += 8
+            elif tag == TAG_FLOAT:
+                value = FLOAT64.unpack_from(buffer, offset)[0]
+                offset += 8
+            elif tag == TAG_TRUE:
+                value = True
+            elif tag == TAG_FALSE:
+                value = False
+            elif tag == TAG_TIMEDELTA:
+                days, seconds, microseconds = TIMEDELTA.unpack_from(buffer, offset)
+                value = datetime.timedelta(days=days, seconds=seconds, microseconds=microseconds)
+                offset += TIMEDELTA.size
+            else:
+                size = UINT32.unpack_from(buffer, offset)[0]
+                offset += 4
+                data = bytes(buffer[offset:offset + size])
+                offset += size
+                if tag == TAG_BYTES:
+                    value = data
+                elif tag == TAG_STR:
+                    value = data.decode('utf-8')
+                elif tag == TAG_BIGINT:
+                    value = int(data)
+                elif tag == TAG_DECIMAL:
+                    value = decimal.Decimal(data.decode('utf-8'))
+                elif tag == TAG_DATETIME:
+                    value = datetime.datetime.fromisoformat(data.decode('utf-8'))
+                elif tag == TAG_DATE:
+                    value = datetime.date.fromisoformat(data.decode('utf-8'))
+                elif tag == TAG_TIME:
+                    value = datetime.time.fromisoformat(data.decode('utf-8'))
+                else:
+                    raise ValueError(f'未知的类型标记：{tag}')
+            row[column] = value
+        rows.append(row)
+
+    return rows
+
+
+class SharedResultCache(object):
+    ''' 跨进程共享的查询结果缓存（mmap 共享内存文件，同一主机的所有进程共用）
+
+    共享的是已编码的结果（各进程不用分别查询数据库）；每个进程保留最近命中的解码结果（按记录的写入位置及清空次数区分版本），
+    同一记录再次命中时不再解码，只校验表版本并复制行（同进程内缓存）。
+    文件由文件头、表版本计数器、槽位、数据区组成：
+    数据区为环形缓冲区，写满后覆盖最早的记录（按大小淘汰）；槽位按键的摘要直接映射，冲突时覆盖；
+    写入表时增加表的版本计数器，版本不一致的记录视为失效
+    '''
+
+    def __init__(self, path: str, size=64 * 1024 * 1024, slots=65536, counters=4096, decoded_size=1024):
+        '''
+        :param path: 共享内存文件，须为当前用户所有且其他用户不可读写，例如：/dev/shm/chain_pymysql.1000.cache
+        :param size: 数据区大小（字节）
+        :param slots: 槽位数（最大缓存数量）
+        :param counters: 表版本计数器数（表名按 crc32 映射）
+        :param decoded_size: 每个进程保留的解码结果数量，0：每次命中都解码
+        '''
+
+        if fcntl is None:
+            raise exceptions.RuntimeError((400, '共享缓存需要 fcntl（仅支持 Linux、macOS 等）'))
+
+        if size < 4096 or slots < 1 or counters < 1:
+            raise exceptions.RuntimeError((400, '共享缓存须满足 size >= 4096、slots >= 1、counters >= 1'))
+
+        self.path = path
+        self.size = size
+        self.slots = slots
+        self.counters = counters
+        # 各区域的起始位置
+        self.counter_offset = HEADER.size
+        self.slot_offset = self.counter_offset + COUNTER.size * counters
+        self.data_offset = self.slot_offset + SLOT.size * slots
+        self.total_size = self.data_offset + size
+
+        # 进程内的锁（flock 不能互斥同一进程的线程）
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._stats = {'hits': 0, 'misses': 0, 'expirations': 0, 'decodes': 0}
+        # 进程内已解码的结果：键的摘要 => (写入位置, 清空次数, rows)
+        self._decoded = LRUCache(decoded_size)
+
+        self._open()
+        with self._flock(fcntl.LOCK_EX):
+            magic, data_size, nslots, ncounters, _, _ = HEADER.unpack_from(self.mm, 0)
+            if (magic, data_size, nslots, ncounters) != (MAGIC, size, slots, counters):
+                self.mm[0:self.data_offset] = bytes(self.data_offset)
+                HEADER.pack_into(self.mm, 0, MAGIC, size, slots, counters, 0, 0)
+
+    def _open(self):
+        ''' 打开（fork 后重新打开）共享内存文件，每个进程使用自己的文件描述符加锁 '''
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+        try:
+            # 其他用户创建或可写的文件可能被篡改
+            stat = os.fstat(fd)
+            if stat.st_uid != os.getuid() or stat.st_mode & 0o077 != 0:
+                raise exceptions.RuntimeError((403, f'共享缓存文件须为当前用户所有且其他用户不可读写：{self.path}'))
+
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size != self.total_size:
+                os.ftruncate(fd, self.total_size)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            mm = mmap.mmap(fd, self.total_size)
+        except Exception:
+            os.close(fd)
+            raise
+
+        # fork 后关闭从父进程继承的文件描述符及映射
+        if self._fd is not None:
+            try:
+                self.mm.close()
+                os.close(self._fd)
+            except (OSError, BufferError):
+                pass
+
+        self._fd = fd
+        self.mm = mm
+        self._pid = os.getpid()
+
+    @contextlib.contextmanager
+    def _flock(self, operation):
+        ''' 加锁：进程内用线程锁，进程间用 flock（LOCK_SH 读、LOCK_EX 写） '''
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            fcntl.flock(self._fd, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _digest(self, key):
+        ''' 缓存键的摘要 '''
+
+        return hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).digest()
+
+    def _counter(self, table: str):
+        ''' 表的版本计数器下标 '''
+
+        return zlib.crc32(table.encode('utf-8')) % self.counters
+
+    def _read_counter(self, index: int):
+        return COUNTER.unpack_from(self.mm, self.counter_offset + COUNTER.size * index)[0]
+
+    def version(self, tables: frozenset):
+        ''' 表的版本（查询前获取，缓存时比较） '''
+
+        indexes = sorted(set(self._counter(x) for x in tables))
+        with self._flock(fcntl.LOCK_SH):
+            return tuple((i, self._read_counter(i)) for i in indexes)
+
+    def get(self, key, default=None):
+        ''' 获取缓存：键不存在、过期、已被覆盖、已清空或表版本变化时返回 default '''
+
+        digest = self._digest(key)
+        slot = self.slot_offset + SLOT.size * (int.from_bytes(digest[0:8], 'little') % self.slots)
+
+        with self._flock(fcntl.LOCK_SH):
+            _, _, _, _, write_pos, epoch = HEADER.unpack_from(self.mm, 0)
+            slot_digest, pos, length, expires_at, slot_epoch = SLOT.unpack_from(self.mm, slot)
+
+            if slot_digest != digest or length == 0 or slot_epoch != epoch or write_pos - pos > self.size:
+                self._stats['misses'] += 1
+                return default
+
+            if expires_at > 0 and time.time() >= expires_at:
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return default
+
+            view = memoryview(self.mm)
+            try:
+                offset = self.data_offset + pos % self.size
+                count = RECORD_HEADER.unpack_from(view, offset)[0]
+                offset += RECORD_HEADER.size
+                for _ in range(count):
+                    index, table_version = RECORD_TABLE.unpack_from(view, offset)
+                    offset += RECORD_TABLE.size
+                    if self._read_counter(index) != table_version:
+                        self._stats['misses'] += 1
+                        return default
+
+                decoded = self._decoded.get(digest)
+                if decoded is not None and decoded[0:2] == (pos, epoch):
+                    rows = decoded[2]
+                else:
+                    rows = tuple(decode_result(view, offset))
+                    self._decoded.set(digest, (pos, epoch, rows))
+                    self._stats['decodes'] += 1
+            except (ValueError, IndexError, struct.error, UnicodeDecodeError, decimal.InvalidOperation):
+                # 数据损坏
+                self._stats['misses'] += 1
+                return default
+            finally:
+                view.release()
+
+            self._stats['hits'] += 1
+
+        # 每次返回新的 list 及 dict，修改不影响缓存
+        return [dict(x) for x in rows]
+
+    def set(self, key, value, ttl=None, tables=frozenset(), version=None):
+        ''' 设置缓存
+
+        :param key: 缓存键
+        :param value: 查询结果（list of dict）
+        :param ttl: 过期时间（秒），None：不过期
+        :param tables: 查询的表
+        :param version: 查询前的 version(tables)，查询期间表被写入时不缓存
+        '''
+
+        digest = self._digest(key)
+        slot = self.slot_offset + SLOT.size * (int.from_bytes(digest[0:8], 'little') % self.slots)
+        try:
+            payload = encode_result(value)
+        except TypeError:
+            # 有不支持的类型时不缓存
+            return
+
+        with self._flock(fcntl.LOCK_EX):
+            if version is None:
+                version = tuple((i, self._read_counter(i)) for i in sorted(set(self._counter(x) for x in tables)))
+            elif any(self._read_counter(i) != v for i, v in version):
+                return
+
+            record = [RECORD_HEADER.pack(len(version))]
+            record.extend(RECORD_TABLE.pack(i, v) for i, v in version)
+            record.append(payload)
+            record = b''.join(record)
+
+            # 超过数据区一半的结果不缓存
+            if len(record) > self.size // 2:
+                return
+
+            magic, data_size, nslots, ncounters, write_pos, epoch = HEADER.unpack_from(self.mm, 0)
+
+            # 记录不跨越数据区末尾
+            offset = write_pos % self.size
+            if offset + len(record) > self.size:
+                write_pos += self.size - offset
+                offset = 0
+
+            self.mm[self.data_offset + offset:self.data_offset + offset + len(record)] = record
+            expires_at = 0.0 if ttl is None else time.time() + ttl
+            SLOT.pack_into(self.mm, slot, digest, write_pos, len(record), expires_at, epoch)
+            HEADER.pack_into(self.mm, 0, magic, data_size, nslots, ncounters, write_pos + len(record), epoch)
+
+    def invalidate(self, tables):
+        ''' 使表的缓存失效（增加表的版本计数器，所有进程可见）
+
+        :param tables: 表名集合
+        '''
+
+        indexes = set(self._counter(x) for x in tables)
+        if len(indexes) == 0:
+            return
+
+        with self._flock(fcntl.LOCK_EX):
+            for index in indexes:
+                offset = self.counter_offset + COUNTER.size * index
+                COUNTER.pack_into(self.mm, offset, COUNTER.unpack_from(self.mm, offset)[0] + 1)
+
+    def clear(self):
+        ''' 清空缓存（增加清空次数，所有进程可见） '''
+
+        with self._flock(fcntl.LOCK_EX):
+            magic, data_size, nslots, ncounters, write_pos, epoch = HEADER.unpack_from(self.mm, 0)
+            HEADER.pack_into(self.mm, 0, magic, data_size, nslots, ncounters, write_pos, epoch + 1)
+        self._decoded.clear()
+
+    def stats(self):
+        ''' 缓存统计信息（hits、misses、expirations、decodes 为当前进程的统计，decodes：解码次数）
+
+        :return dict，另有 used：数据区已使用的字节数，maxsize：数据区大小，slots：槽位数
+        '''
+
+        with self._flock(fcntl.LOCK_SH):
+            write_pos = HEADER.unpack_from(self.mm, 0)[4]
+            stats = dict(self._stats)
+
+        stats.update({'used': min(write_pos, self.size), 'maxsize': self.size, 'slots': self.slots})
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / total if total else 0.0
+        return stats
+
+    def close(self):
+        ''' 关闭共享内存文件（不删除文件） '''
+
+        with self._lock:
+            if self._fd is not None:
+                self.mm.close()
+                os.close(self._fd)
+                self._fd = None
@@ -0,0 +1,134 @@
+# chain-pymysql: Easy to use pymysql.
+
+# @link https://github.com/Tiacx/chain-pymysql
+# @copyright Copyright (c) 2022 Tiac
+# @license MIT
+# @author Tiac
+# @since 1.1
+
+import re
+
+
+# 过滤规则（只编译一次）
+FILTER_RULE = re.compile("\\<.+javascript:window\\[.{1}\\\\x|<.*=(&#\\d+?;?)+?>|<.*data=data:text\\/html.*>|\\b(alert\\(|confirm\\(|expression\\(|prompt\\(|benchmark\s*?\\(\d+?|sleep\s*?\\([\d\.]+?\\)|load_file\s*?\\()|<[^>]*?\\b(onerror|onmousemove|onload|onclick|onmouseover)\\b|\\b(and|or)\\b\\s*?([\\(\\)'\"\\d]+?=[\\(\\)'\"\\d]+?|[\\(\\)'\"a-zA-Z]+?=[\\(\\)'\"a-zA-Z]+?|>|<|\s+?[\\w]+?\\s+?\\bin\\b\\s*?\(|\\blike\\b\\s+?[\"'])|\\/\\*.+?\\*\\/|<\\s*script\\b|\\bEXEC\\b|UNION.+?SELECT(\\(.+\\)|\\s+?.+?)|UPDATE(\\(.+\\)|\\s+?.+?)SET|INSERT\\s+INTO.+?VALUES|(SELECT|DELETE)(\\(.+\\)|\\s+?|\\s+?.+?\\s+?)FROM(\\(.+\\)|\\s+?.+?)|(CREATE|ALTER|DROP|TRUNCATE)\\s+(TABLE|DATABASE)|(EXTRACTVALUE|UPDATEXML)(\\(.+\\)|\\s+?.+?)", re.I)
+
+# 过滤规则中每一条都至少包含以下字符或关键字之一，不包含的字符串无需用正则检查
+TRIGGER_CHARS = frozenset('<(/=>\'"')
+TRIGGER_WORDS = ('exec', 'union', 'update', 'insert', 'select', 'delete', 'create', 'alter', 'drop', 'truncate', 'extractvalue', 'updatexml')
+# 忽略大小写匹配时与 ASCII 字母等价的特殊字符（lower 后不是 ASCII 字母）
+SPECIAL_CHARS = frozenset('\u0130\u0131\u017f\u212a')
+
+
+def is_suspicious(s: str):
+    ''' 是否可能命中过滤规则（快速预检） '''
+
+    if not TRIGGER_CHARS.isdisjoint(s):
+        return True
+
+    if not s.isascii() and not SPECIAL_CHARS.isdisjoint(s):
+        return True
+
+    s = s.lower()
+    for word in TRIGGER_WORDS:
+        if word in s:
+            return True
+
+    return False
+
+
+class Validator(object):
+    ''' 输入验证
+
+    只检查字符串（字典的键及值、列表的元素），遇到第一个非法值即返回；数字、None 等其他类型直接跳过
+    '''
+
+    def __init__(self, skip=None, schema=None, rules=None):
+        '''
+        :param skip: 不检查的字段，例如富文本字段：['content']
+        :param schema: 字段白名单：字段 => 正则表达式、类型或函数，符合的值不再用过滤规则检查，不符合的值视为非法
+        :param rules: 额外的过滤规则（正则表达式）
+        '''
+
+        self.skip = frozenset(skip or ())
+        self.schema = dict()
+        for column, rule in (schema or dict()).items():
+            if type(rule) is str:
+                rule = re.compile(rule)
+            self.schema[column] = rule
+        self.rules = [re.compile(x, re.I) if type(x) is str else x for x in (rules or ())]
+
+    def check(self, data: 'str|dict|list'):
+        ''' 检查数据是否合法
+
+        :param data: 需要验证的内容
+        :return bool
+        '''
+
+        return self.find(data) is None
+
+    def find(self, data: 'str|dict|list'):
+        ''' 查找第一个非法值
+
+        :param data: 需要验证的内容
+        :return (字段, 值)，全部合法时返回 None
+        '''
+
+        # 已检查过的字段名（批量插入时每行的字段名相同）
+        checked_keys = set()
+        # 深度优先遍历，栈中保存迭代器，不复制数据
+        stack = [iter([(None, data)])]
+
+        while stack:
+            for column, value in stack[-1]:
+                if type(value) is str:
+                    if self.match(value) is False:
+                        return column, value
+                elif type(value) is dict:
+                    for k, v in value.items():
+                        if k not in checked_keys:
+                            if type(k) is str and self.match(k) is False:
+                                return None, k
+                            checked_keys.add(k)
+                        if k in self.schema and self.match_schema(k, v) is False:
+                            return k, v
+                    stack.append((k, v) for k, v in value.items() if k not in self.skip and k not in self.schema)
+                    break
+                elif type(value) in (list, tuple, set, frozenset):
+                    stack.append((column, x) for x in value)
+                    break
+            else:
+                stack.pop()
+
+        return None
+
+    def match(self, value: str):
+        ''' 检查单个字符串 '''
+
+        if value == '':
+            return True
+
+        if is_suspicious(value) and FILTER_RULE.search(value) is not None:
+            return False
+
+        for rule in self.rules:
+            if rule.search(value) is not None:
+                return False
+
+        return True
+
+    def match_schema(self, column, value):
+        ''' 检查字段白名单 '''
+
+        rule = self.schema[column]
+
+        if value is None:
+            return True
+        if isinstance(rule, type):
+            return isinstance(value, rule)
+        if isinstance(rule, re.Pattern):
+            return type(value) is str and rule.fullmatch(value) is not None
+        return bool(rule(value))
+
+
+# 默认的验证器
+default = Validator()
@@ -18,6 +18,7 @@ setup(
     author='Taic',
     packages=['chain_pymysql'],
     install_requires=['pymysql'],
+    extras_require={'async': ['aiomysql']},
     classifiers=[
         # Chose either '3 - Alpha', '4 - Beta' or '5 - Production/Stable' as the current state of your package
         'Development Status :: 5 - Production/Stable',
@@ -1,5 +1,44 @@
 import unittest
-from chain_pymysql import imysql, transaction
+from chain_pymysql import imysql, transaction, dqlparse
+
+
+class LegacyDqlParse(dqlparse.DqlParse):
+    ''' 旧版（pyparsing）解析器，用于对比新解析器的结果 '''
+
+    def parse(self, dql: str):
+        from pyparsing import pyparsing_unicode as ppu
+        from pyparsing import Word, alphas, alphanums, printables, Group, ZeroOrMore, OneOrMore, CaselessKeyword
+
+        dql = dql.replace("`", '')
+        word = Word(alphanums + '_')
+        table = ZeroOrMore(word + '.') + word
+        table_alias = word
+        normal_field = ZeroOrMore(table_alias + '.') + word
+        field_alias = CaselessKeyword('AS') + Word(ppu.Chinese.alphanums + '"' + "'" + '_' + '(' + ')' + '（' + '）')
+        function_field = ZeroOrMore(word) + '(' + Word(printables + '\n' + ' ' + ppu.Chinese.alphanums, excludeChars=')') + ')'
+        function_field.set_parse_action(''.join)
+        string_field = Word(printables, exclude_chars=',')
+        field = normal_field ^ function_field ^ string_field
+        from_label = CaselessKeyword('FROM')
+        join_label = Word(alphas) + CaselessKeyword('JOIN')
+        on_condition = OneOrMore(ZeroOrMore('AND') + Group(field + '=' + field))
+        join_expr = join_label + table + table_alias + CaselessKeyword('ON') + on_condition
+        where_label = CaselessKeyword('WHERE')
+        where_condition = field + Word(alphas + '>' + '<' + '=', exclude_chars='B') + Word(ppu.Chinese.alphanums + printables + ' ', exclude_chars='AO')
+        where_condition.set_parse_action(lambda x: [i.strip() for i in x])
+
+        parser = (
+            CaselessKeyword('SELECT')
+            + Group(OneOrMore(Group(field + ZeroOrMore(field_alias)) + ZeroOrMore(','), stop_on=from_label)).set_results_name('columns')
+            + from_label
+            + Group(table + table_alias).set_results_name('table')
+            + Group(OneOrMore(Group(join_expr), stop_on=where_label)).set_results_name('joins')
+            + where_label
+            + Group(OneOrMore(ZeroOrMore('AND') + Group(where_condition))).set_results_name('conditions')
+            + ZeroOrMore(Word(printables + ' ')).set_results_name('other')
+        )
+
+        return parser.parse_string(dql).as_dict()
 
 
 class TestCase(unittest.TestCase):
@@ -322,7 +361,7 @@ class TestCase(unittest.TestCase):
         sql2 = imysql.get_last_sql()
         self.assertEqual(sql2, sql1)
 
-        # 注：多线程高并发情况下，方法二可能不太准确
+        # 注：方法二获取的是当前线程（或协程）最后一次执行的信息
 
     def test_2_4(self):
         ''' 获取插入的ID '''
@@ -333,7 +372,7 @@ class TestCase(unittest.TestCase):
         id2 = imysql.get_insert_id()
         self.assertEqual(id1, id2)
 
-        # 注：多线程高并发情况下，方法二可能不太准确
+        # 注：方法二获取的是当前线程（或协程）最后一次执行的信息
 
     def tset_2_5(self):
         ''' 获取影响的行数 '''
@@ -348,7 +387,7 @@ class TestCase(unittest.TestCase):
         self.assertEqual(result, effected_rows)
 
         # 注1：insert_many、update_one、update_many、delete等函数返回的都是影响行数
-        # 注2：多线程高并发情况下，方法二可能不太准确
+        # 注2：方法二获取的是当前线程（或协程）最后一次执行的信息
 
     def test_2_6(self):
         ''' 多连接及切换连接 '''
@@ -605,6 +644,597 @@ class TestCase(unittest.TestCase):
         for t in ths:
             t.join()
 
+    def test_3_4(self):
+        ''' 连接池 '''
+
+        from threading import Thread
+
+        def get_count():
+            imysql.table('table1').count()
+
+        ths = []
+        for i in range(20):
+            t = Thread(target=get_count)
+            ths.append(t)
+            t.start()
+
+        for t in ths:
+            t.join()
+
+        # 查询完毕后连接都已归还连接池
+        stats = imysql.get_pool_stats()
+        self.assertEqual(stats.get('in_use'), 0)
+        self.assertTrue(0 < stats.get('size') <= stats.get('max_size'))
+
+        # 事务中固定使用同一个连接
+        with transaction.atomic() as atomic:
+            imysql.table('table1').insert_one({'name': '连接池'})
+            self.assertEqual(imysql.get_pool_stats().get('in_use'), 1)
+            atomic.rollback()
+
+        self.assertEqual(imysql.table('table1').where({'name': '连接池'}).count(), 0)
+
+    def test_3_5(self):
+        ''' 线程间互不影响 '''
+
+        from threading import Thread
+
+        sql = imysql.table('table1').select('id').where('id=3').get_raw_sql()
+        imysql.execute(sql, fetch=True)
+
+        results = dict()
+
+        def run(_id: int):
+            imysql.table('table1').select('name').where({'id': _id}).scalar()
+            results[_id] = imysql.get_last_sql()
+
+        ths = []
+        for i in range(10):
+            t = Thread(target=run, args=(i,))
+            ths.append(t)
+            t.start()
+
+        for t in ths:
+            t.join()
+
+        # 每个线程获取的都是自己最后执行的SQL
+        for _id, last_sql in results.items():
+            self.assertTrue(last_sql.endswith(f'`id` = {_id} LIMIT 1'))
+
+        self.assertEqual(imysql.get_last_sql(), sql)
+
+    def test_3_6(self):
+        ''' 断线重连 '''
+
+        # 最近归还的连接会被优先借出
+        conn_id = imysql.execute('SELECT CONNECTION_ID() AS id', fetch=True)[0].get('id')
+        reconnects = imysql.get_pool_stats().get('reconnects')
+
+        # 用其他连接断开该连接
+        imysql.switch('other').execute(f'KILL {conn_id}')
+
+        # 只读查询自动重连并重试
+        count = imysql.table('table1').count()
+        self.assertTrue(count > 0)
+        self.assertEqual(imysql.get_pool_stats().get('reconnects'), reconnects + 1)
+
+    def test_3_7(self):
+        ''' 异步查询 '''
+
+        import asyncio
+        from chain_pymysql.aio import aimysql, transaction as atransaction
+
+        async def run():
+            await aimysql.connect({
+                'host': '127.0.0.1',
+                'user': 'root',
+                'password': 'root',
+                'database': 'test'
+            }, max_size=5)
+
+            counts = await asyncio.gather(*[aimysql.table('table1').count() for _ in range(10)])
+            self.assertEqual(len(set(counts)), 1)
+            self.assertEqual(counts[0], imysql.table('table1').count())
+
+            name = await aimysql.table('table1').select('name').where({'id': 1}).scalar()
+            self.assertEqual(name, imysql.table('table1').select('name').where({'id': 1}).scalar())
+
+            # 异常时回滚
+            try:
+                async with atransaction.atomic():
+                    await aimysql.table('table1').insert_one({'name': '异步'})
+                    raise ValueError
+            except ValueError:
+                pass
+
+            self.assertEqual(await aimysql.table('table1').where({'name': '异步'}).count(), 0)
+            await aimysql.close()
+
+        asyncio.run(run())
+
+    def test_3_8(self):
+        ''' 流式读取 '''
+
+        total = imysql.table('table1').count()
+
+        rows = [item for item in imysql.table('table1').all(stream=True)]
+        self.assertEqual(len(rows), total)
+
+        chunks = [chunk for chunk in imysql.table('table1').iter_chunks(2)]
+        self.assertEqual(sum(len(x) for x in chunks), total)
+        self.assertTrue(all(len(x) <= 2 for x in chunks))
+
+        # 读取完毕后连接已归还
+        self.assertEqual(imysql.get_pool_stats().get('in_use'), 0)
+
+        # 中途退出
+        for item in imysql.execute('SELECT * FROM table1', stream=True):
+            break
+        self.assertEqual(imysql.table('table1').count(), total)
+
+        # 事务中读取完毕前不能执行其他查询
+        import chain_pymysql.exceptions
+
+        with transaction.atomic():
+            results = imysql.table('table1').all(stream=True)
+            with self.assertRaises(chain_pymysql.exceptions.RuntimeError):
+                imysql.table('table1').count()
+            results.close()
+            self.assertEqual(imysql.table('table1').count(), total)
+
+    def test_3_9(self):
+        ''' 游标分页 '''
+
+        ids = imysql.table('table1').select('id').order_by('id').column()
+
+        chunks = [chunk for chunk in imysql.table('table1').select('id,name').chunk_by('id', size=2)]
+        self.assertEqual([x.get('id') for chunk in chunks for x in chunk], ids)
+        self.assertTrue(all(len(x) <= 2 for x in chunks))
+
+        rows = [item for item in imysql.table('table1').scan(['name', 'id'], batch_size=2)]
+        self.assertEqual(len(rows), len(ids))
+
+        results = []
+        token = None
+        while True:
+            page = imysql.table('table1').paginate('id', size=3, token=token)
+            results.extend(x.get('id') for x in page['items'])
+            token = page['next_token']
+            if token is None:
+                break
+
+        self.assertEqual(results, ids)
+
+    def test_4_0(self):
+        ''' 参数化查询 '''
+
+        sql, args = imysql.table('table1').where({'name': "O'Brien", 'id': ['in', (3, 4)]}).compile()
+        self.assertEqual(sql, 'SELECT * FROM `table1` WHERE `name` = %s AND `id` IN (%s,%s)')
+        self.assertEqual(args, ["O'Brien", 3, 4])
+
+        # 值中的引号及百分号
+        _id = imysql.table('table1').insert_one({'name': '张三'})
+        imysql.table('table1').update_one({'id': _id}, {'name': "O'Brien 100%"})
+        name = imysql.table('table1').select('name').where({'id': _id}).scalar()
+        self.assertEqual(name, "O'Brien 100%")
+        self.assertEqual(imysql.table('table1').where({'name': "O'Brien 100%"}).count(), 1)
+        imysql.table('table1').delete({'id': _id})
+
+    def test_4_1(self):
+        ''' 编译缓存 '''
+
+        imysql.table('table1').where({'id': 3}).order_by('id').limit(1).all(fetch=True)
+        stats = imysql.get_query_cache_stats()
+
+        # 结构相同、值不同的查询命中缓存
+        for _id in range(4, 10):
+            sql, args = imysql.table('table1').where({'id': _id}).order_by('id').limit(1).compile()
+            self.assertEqual(args, [_id, 1])
+
+        self.assertEqual(imysql.get_query_cache_stats().get('hits'), stats.get('hits') + 6)
+        self.assertEqual(imysql.get_query_cache_stats().get('misses'), stats.get('misses'))
+
+    def test_4_2(self):
+        ''' 数据验证 '''
+
+        import chain_pymysql.exceptions
+        from chain_pymysql import Validator
+
+        with self.assertRaises(chain_pymysql.exceptions.RuntimeError):
+            imysql.table('table1').insert_one({'name': 'x UNION SELECT 1 FROM table2'})
+
+        self.assertTrue(imysql.check_validity([{'id': 1, 'name': '张三'}, {'id': 2, 'name': None}]))
+        self.assertFalse(imysql.check_validity([{'id': 1, 'name': '张三'}, {'id': 2, 'name': 'sleep(3)'}]))
+
+        # 跳过某些字段
+        validator = Validator(skip=['name'])
+        _id = imysql.table('table1').insert_one({'name': '<script>'}, verify=validator)
+        self.assertEqual(imysql.table('table1').select('name').where({'id': _id}).scalar(), '<script>')
+        imysql.table('table1').delete({'id': _id})
+
+        # 字段白名单
+        validator = Validator(schema={'name': r'[a-z]+', 'id': int})
+        self.assertTrue(validator.check({'id': 1, 'name': 'abc'}))
+        self.assertEqual(validator.find({'id': '1', 'name': 'abc'}), ('id', '1'))
+        self.assertEqual(validator.find({'id': 1, 'name': 'a b'}), ('name', 'a b'))
+
+    def test_4_3(self):
+        ''' 批量插入（生成器） '''
+
+        count = imysql.table('table2').count()
+
+        def rows():
+            for i in range(100, 125):
+                yield {'id': i, 'age': i % 7}
+
+        progress = []
+        effected_rows = imysql.table('table2').insert_many(rows(), batch_size=10, commit_every=2, progress=progress.append)
+        self.assertEqual(effected_rows, 25)
+        self.assertEqual(progress, [10, 20, 25])
+        self.assertEqual(imysql.table('table2').count(), count + 25)
+
+        imysql.table('table2').delete({'id': ['>=', 100]})
+
+    def test_4_4(self):
+        ''' 批量导入（LOAD DATA LOCAL INFILE） '''
+
+        # 添加一个开启 local_infile 的连接
+        imysql.connect({
+            'host': '127.0.0.1',
+            'user': 'root',
+            'password': 'root',
+            'database': 'test',
+            'local_infile': True
+        }, name='loader')
+
+        def rows():
+            for i in range(200, 210):
+                yield {'id': i, 'name': None if i % 2 else 'a\tb\\c'}
+
+        result = imysql.switch('loader').table('table1').bulk_load(rows())
+        self.assertEqual(result.get('rows'), 10)
+        self.assertEqual(imysql.table('table1').where({'id': 200}).one().get('name'), 'a\tb\\c')
+        self.assertIsNone(imysql.table('table1').where({'id': 201}).one().get('name'))
+
+        # 主键重复时替换
+        result = imysql.switch('loader').table('table1').bulk_load([(200, '张三')], columns=['id', 'name'], duplicate='replace')
+        self.assertEqual(result.get('deleted'), 1)
+        self.assertEqual(imysql.table('table1').select('name').where({'id': 200}).scalar(), '张三')
+
+        imysql.table('table1').delete({'id': ['>=', 200]})
+        imysql.close('loader')
+
+    def test_4_5(self):
+        ''' 批量插入或更新 '''
+
+        result = imysql.table('table2').upsert_many([{'id': 300, 'age': 1}, {'id': 301, 'age': 1}])
+        self.assertEqual(result, {'inserted': 2, 'updated': 0, 'unchanged': 0})
+
+        # 重复时累加 age
+        result = imysql.table('table2').upsert_many([
+            {'id': 300, 'age': 2},
+            {'id': 302, 'age': 5},
+        ], increment_fields=['age'])
+        self.assertEqual(result, {'inserted': 1, 'updated': 1, 'unchanged': 0})
+        self.assertEqual(imysql.table('table2').select('age').where({'id': 300}).scalar(), 3)
+
+        # 值未改变
+        result = imysql.table('table2').upsert_many({'id': 301, 'age': 1})
+        self.assertEqual(result, {'inserted': 0, 'updated': 0, 'unchanged': 1})
+
+        imysql.table('table2').delete({'id': ['>=', 300]})
+
+    def test_4_6(self):
+        ''' 按键批量更新 '''
+
+        imysql.table('table2').insert_many([{'id': i, 'age': 1} for i in range(400, 410)])
+
+        effected_rows = imysql.table('table2').update_batch([{'id': i, 'age': i - 400} for i in range(400, 410)], batch_size=3)
+        # id=401 的值未改变
+        self.assertEqual(effected_rows, 9)
+        self.assertEqual(imysql.table('table2').select('age').where({'id': 409}).scalar(), 9)
+
+        # 同一批中键重复时，后面的值覆盖前面的值
+        imysql.table('table2').update_batch([{'id': 400, 'age': 5}, {'id': 400, 'age': 6}])
+        self.assertEqual(imysql.table('table2').select('age').where({'id': 400}).scalar(), 6)
+
+        imysql.table('table2').delete({'id': ['>=', 400]})
+
+    def test_4_7(self):
+        ''' 分批删除及更新 '''
+
+        imysql.table('table2').insert_many([{'id': i, 'age': i % 2} for i in range(500, 530)])
+
+        progress = []
+        effected_rows = imysql.table('table2').backfill({'id': ['>=', 500], 'age': 1}, {'age': 3}, batch_size=4, progress=progress.append)
+        self.assertEqual(effected_rows, 15)
+        self.assertEqual(progress[-1], 15)
+        self.assertEqual(imysql.table('table2').where({'id': ['>=', 500], 'age': 3}).count(), 15)
+
+        effected_rows = imysql.table('table2').purge({'id': ['>=', 500], 'age': 3}, batch_size=4, sleep_ms=1, max_lag=10, lag_source=lambda: 0)
+        self.assertEqual(effected_rows, 15)
+
+        # 按键列表删除
+        effected_rows = imysql.table('table2').purge(keys=range(500, 530), batch_size=7)
+        self.assertEqual(effected_rows, 15)
+        self.assertEqual(imysql.table('table2').where({'id': ['>=', 500]}).count(), 0)
+
+    def test_4_8(self):
+        ''' 跨库（连接）查询：并发及预先查询 '''
+
+        sql = 'SELECT t1.id, t2.name FROM default.test.table1 t1 LEFT JOIN other.test2.table1 t2 ON t1.id = t2.id WHERE t1.id >= 1'
+
+        rows = []
+        for chunk in imysql.execute_cross(sql, chunk_size=1, workers=2, prefetch=2):
+            rows.extend(chunk)
+
+        self.assertEqual(len(rows), imysql.table('table1').where('id >= 1').count())
+        self.assertTrue(all(list(x.keys()) == ['id', 'name'] for x in rows))
+
+        # 提前结束时关闭流式读取及线程池
+        results = imysql.execute_cross(sql, chunk_size=1)
+        self.assertEqual(len(next(results)), 1)
+        results.close()
+        self.assertEqual(imysql.get_pool_stats('default').get('in_use'), 0)
+
+    def test_4_9(self):
+        ''' 跨库（连接）查询：一对多 '''
+
+        # other 库中有两个张三
+        insert_id = imysql.switch('other').table('table1').insert_one({'name': '张三'})
+
+        sql = 'SELECT t1.id, t2.name FROM default.test.table1 t1 INNER JOIN other.test2.table1 t2 ON t1.name = t2.name WHERE t1.id = 3'
+        rows = list(imysql.execute_cross(sql, flat=True))
+        self.assertEqual(len(rows), imysql.switch('other').table('table1').where({'name': '张三'}).count())
+        self.assertTrue(all(x.get('id') == 3 for x in rows))
+
+        imysql.switch('other').table('table1').delete({'id': insert_id})
+
+    def test_5_0(self):
+        ''' 跨库（连接）查询：执行计划缓存 '''
+
+        sql = 'SELECT t1.id, t2.name FROM default.test.table1 t1 LEFT JOIN other.test2.table1 t2 ON t1.id = t2.id WHERE t1.id = %s LIMIT %s'
+
+        list(imysql.execute_cross(sql % (1, 1), flat=True))
+        stats = imysql.get_plan_cache_stats()
+
+        # 只有字面量不同，复用执行计划
+        rows = list(imysql.execute_cross(sql % (2, 1), flat=True))
+        self.assertEqual([x.get('id') for x in rows], [2])
+        self.assertEqual(imysql.get_plan_cache_stats().get('hits'), stats.get('hits') + 1)
+        self.assertEqual(imysql.get_plan_cache_stats().get('size'), stats.get('size'))
+
+    def test_5_1(self):
+        ''' 跨库（连接）查询：新旧解析器结果一致 '''
+
+        try:
+            import pyparsing  # noqa: F401
+        except ImportError:
+            self.skipTest('未安装 pyparsing')
+
+        sql_list = [
+            '''
+            SELECT
+                t1.`order_code`,
+                t2.`out_code`
+            FROM
+                prod1.`prod_order`.`dd_order` t1
+            LEFT JOIN prod2.`prod_logistics`.`wl_storageout` t2 ON t1.`order_code` = t2.`order_code`
+            WHERE
+                t1.`create_time` >= '2022-10-01 00:00:00'
+            AND t1.`create_time` <= '2022-10-31 23:59:59'
+            ORDER BY
+                t1.`create_time` ASC
+            ''',
+            'SELECT t1.id, t2.name FROM default.test.table1 t1 LEFT JOIN other.test2.table1 t2 ON t1.id = t2.id WHERE t1.id >= 1',
+            'SELECT t1.id, t2.name FROM default.test.table1 t1 INNER JOIN other.test2.table1 t2 ON t1.name = t2.name WHERE t1.id = 3 LIMIT 10',
+            "SELECT t1.id, t2.name AS '名称', t3.title FROM a.db.t1 t1 RIGHT JOIN b.db.t2 t2 ON t1.uid = t2.id AND t1.k = t2.k "
+            "LEFT JOIN c.db.t3 t3 ON t2.id = t3.uid WHERE t1.id IN (1, 2, 3) AND t1.name LIKE '%张%' AND t1.status = 1",
+        ]
+
+        def normalize(plan):
+            sql_list, bridging, columns_alias = plan
+            return {name: ' '.join(sql.split()) for name, sql in sql_list.items()}, bridging, columns_alias
+
+        for sql in sql_list:
+            sql, _ = dqlparse.DqlParse().normalize(sql)
+            self.assertEqual(normalize(dqlparse.DqlParse().plan(sql)), normalize(LegacyDqlParse().plan(sql)))
+
+    def test_5_2(self):
+        ''' 跨库（连接）查询：执行计划 '''
+
+        sql = 'SELECT t1.id, t2.name FROM default.test.table1 t1 INNER JOIN other.test2.table1 t2 ON t1.id = t2.id WHERE t1.id >= 1'
+
+        steps = imysql.explain_cross(sql)
+        self.assertEqual(len(steps), 2)
+        self.assertEqual([x.get('type') for x in steps], ['driving', 'lookup'])
+        self.assertEqual(sorted(x.get('name') for x in steps), ['default', 'other'])
+        self.assertTrue(all(type(x.get('rows')) is int for x in steps))
+
+        # 更换主查询不改变结果
+        rows = sorted((x.get('id'), x.get('name')) for x in imysql.execute_cross(sql, flat=True))
+        self.assertEqual(rows, sorted((x.get('id'), x.get('name')) for x in imysql.execute_cross(sql, flat=True, reorder=False)))
+
+        # 有分页时不更换主查询
+        self.assertEqual(imysql.explain_cross(sql + ' LIMIT 10')[0].get('name'), 'default')
+
+    def test_5_3(self):
+        ''' 跨库（连接）查询：关联后排序、分组、分页 '''
+
+        sql = 'SELECT t1.id, t2.name FROM default.test.table1 t1 LEFT JOIN other.test2.table1 t2 ON t1.id = t2.id WHERE t1.id >= 1'
+        rows = list(imysql.execute_cross(sql, flat=True))
+
+        # 按关联表的字段排序、分页
+        expected = sorted(rows, key=lambda x: (x.get('name') is not None, x.get('name') or '', -x.get('id')))[1:3]
+        result = list(imysql.execute_cross(sql + ' ORDER BY t2.name ASC, t1.id DESC LIMIT 1, 2', flat=True))
+        self.assertEqual(result, expected)
+
+        # 分组统计
+        sql = 'SELECT t2.name, COUNT(*) AS cnt, MAX(t1.id) AS max_id FROM default.test.table1 t1 INNER JOIN other.test2.table1 t2 ON t1.id = t2.id WHERE t1.id >= 1 GROUP BY t2.name'
+        result = {x.get('name'): (x.get('cnt'), x.get('max_id')) for x in imysql.execute_cross(sql, flat=True)}
+        expected = dict()
+        for item in rows:
+            if item.get('name') is None:
+                continue
+            cnt, max_id = expected.get(item.get('name'), (0, 0))
+            expected[item.get('name')] = (cnt + 1, max(max_id, item.get('id')))
+        self.assertEqual(result, expected)
+
+    def test_5_4(self):
+        ''' 分片查询：并发查询各连接，归并排序、分页，合并统计结果 '''
+
+        rows = imysql.table('table1').all(fetch=True) + imysql.switch('other').table('table1').all(fetch=True)
+        shards = lambda **kwargs: imysql.shards(['default', 'other'], **kwargs).table('table1')
+
+        # 排序及分页下推到各分片，归并后统一分页
+        expected = sorted(rows, key=lambda x: -x.get('id'))[1:4]
+        self.assertEqual(shards().order_by('id', False).skip(1).limit(3).all(fetch=True), expected)
+        self.assertEqual(list(shards().order_by('id', False).skip(1).limit(3).all(stream=True)), expected)
+
+        # 合并统计结果
+        self.assertEqual(shards().count(), len(rows))
+        self.assertEqual(shards().max('id'), max(x.get('id') for x in rows))
+        self.assertEqual(shards().select('COUNT(*) AS ct').scalar(), len(rows))
+
+        # 按分片键路由到一个分片
+        result = shards(key='name', router=lambda x: 'other').where({'name': '张三'}).all(fetch=True)
+        expected = imysql.switch('other').table('table1').where({'name': '张三'}).all(fetch=True)
+        self.assertEqual(result, expected)
+
+        # 整数、整数字符串及整数值的 Decimal 路由到同一分片（7 % 2 与 crc32('7') % 2 不同）
+        from decimal import Decimal
+        sharding = imysql.shards(['default', 'other'], key='id')
+        self.assertEqual(sharding.get_shard(7), sharding.get_shard('7'))
+        self.assertEqual(sharding.get_shard(7), sharding.get_shard(Decimal('7')))
+        self.assertEqual(sharding.get_shard(10086), sharding.get_shard('10086'))
+
+    def test_5_5(self):
+        ''' 读写分离：查询使用从库，写入及 sticky 作用域中写入后的查询使用主库 '''
+
+        # 同一个库作为从库（不是从库时延迟为 0）
+        imysql.connect({
+            'host': '127.0.0.1',
+            'user': 'root',
+            'password': 'root',
+            'database': 'test'
+        }, name='rw', replicas=[{'weight': 1}, {'weight': 2}])
+
+        replicas = lambda: sum(x.get('acquired') for x in imysql.get_pool_stats('rw').get('replicas'))
+        primary = lambda: imysql.get_pool_stats('rw').get('acquired')
+
+        rw = imysql.switch('rw')
+        acquired = (primary(), replicas())
+        count = rw.table('table1').count()
+        self.assertEqual((primary(), replicas()), (acquired[0], acquired[1] + 1))
+        self.assertEqual(count, imysql.table('table1').count())
+
+        # 写入使用主库
+        acquired = (primary(), replicas())
+        rw.table('table1').insert_one({'name': '读写分离'})
+        self.assertEqual(replicas(), acquired[1])
+        self.assertTrue(primary() > acquired[0])
+
+        # 写入后的查询使用主库
+        with imysql.sticky('rw'):
+            rw.table('table1').delete({'name': '读写分离'})
+            acquired = replicas()
+            self.assertEqual(rw.table('table1').where({'name': '读写分离'}).count(), 0)
+            self.assertEqual(replicas(), acquired)
+
+        imysql.close('rw')
+
+    def test_5_6(self):
+        ''' 对冲读：慢查询再发送到另一个从库，先返回的结果胜出 '''
+
+        imysql.connect({
+            'host': '127.0.0.1',
+            'user': 'root',
+            'password': 'root',
+            'database': 'test'
+        }, name='hedge', replicas=[{}, {}], hedge=90)
+
+        hedge = imysql.switch('hedge')
+        for _ in range(30):
+            self.assertEqual(hedge.execute('SELECT 1 AS v', fetch=True), [{'v': 1}])
+
+        # 两个从库都执行 SLEEP，先返回的结果胜出，另一个被取消
+        result = hedge.execute('SELECT SLEEP(0.5) AS s, 2 AS v', fetch=True)
+        self.assertEqual(result[0].get('v'), 2)
+
+        stats = imysql.get_pool_stats('hedge').get('replicas')
+        self.assertEqual(sum(x.get('hedges') for x in stats), 1)
+        self.assertTrue(sum(x.get('hedge_wins') for x in stats) <= 1)
+        imysql.close('hedge')
+
+    def test_5_7(self):
+        ''' 查询结果缓存：命中缓存，写入表时失效 '''
+
+        imysql.clear_result_cache()
+        query = lambda: imysql.table('table1').select('name').where({'id': 3}).cache(ttl=60)
+
+        name = query().scalar()
+        stats = imysql.get_result_cache_stats()
+        self.assertEqual(query().scalar(), name)
+        self.assertEqual(imysql.get_result_cache_stats().get('hits'), stats.get('hits') + 1)
+
+        # 写入后缓存失效
+        imysql.table('table1').update_one({'id': 3}, {'name': '缓存'})
+        self.assertEqual(query().scalar(), '缓存')
+        imysql.execute('UPDATE table1 SET name=%s WHERE id=3', (name,))
+        self.assertEqual(query().scalar(), name)
+        self.assertTrue(imysql.get_result_cache_stats().get('invalidations') >= 2)
+
+    def test_5_8(self):
+        ''' 跨进程共享缓存：命中缓存，写入表时失效 '''
+
+        imysql.use_shared_cache('/tmp/chain_pymysql_test.cache', size=1024 * 1024, slots=1024)
+        imysql.clear_result_cache()
+        query = lambda: imysql.table('table1').where({'id': ['in', (3, 4)]}).cache(ttl=60, shared=True)
+
+        result = query().index('id')
+        self.assertEqual(query().index('id'), result)
+        self.assertEqual(imysql.get_result_cache_stats(shared=True).get('hits'), 1)
+
+        # 写入后缓存失效
+        imysql.table('table1').update_one({'id': 3}, {'name': '共享'})
+        self.assertEqual(query().index('id', 'name').get(3), '共享')
+        imysql.table('table1').update_one({'id': 3}, {'name': result.get(3).get('name')})
+        self.assertEqual(query().index('id'), result)
+
+    def test_5_9(self):
+        ''' 编译查询：多字段分别指定升降序（不需要连接数据库） '''
+
+        sql, args = imysql.table('t').order_by(['id', 'name'], [True, False]).compile()
+        self.assertTrue(sql.endswith('ORDER BY id ASC, name DESC'))
+
+        sql, args = imysql.table('t').order_by(('id', 'name'), False).compile()
+        self.assertTrue(sql.endswith('ORDER BY id DESC, name DESC'))
+
+    def test_5_10(self):
+        ''' 条件的值作为参数绑定（不验证），不使用引号的值及字符串条件仍会验证 '''
+
+        import chain_pymysql.exceptions
+
+        value = "3' OR 1=1; DROP TABLE table1 -- %s"
+
+        sql, args = imysql.table('table1').where({'name': value}).compile()
+        self.assertEqual(sql, 'SELECT * FROM `table1` WHERE `name` = %s')
+        self.assertEqual(args, [value])
+
+        id = imysql.table('table1').insert_one({'name': value}, verify=False)
+        one = imysql.table('table1').where({'name': value}).one()
+        self.assertEqual(one.get('id'), id)
+        self.assertEqual(one.get('name'), value)
+        imysql.table('table1').delete({'id': id})
+
+        with self.assertRaises(chain_pymysql.exceptions.RuntimeError) as context:
+            imysql.table('table1').where({'id': ['=', '1 OR 1=1', False]}).compile()
+        self.assertEqual(context.exception.get_code(), 403)
+
+        with self.assertRaises(chain_pymysql.exceptions.RuntimeError) as context:
+            imysql.table('table1').where('id = 1 OR 1=1').compile()
+        self.assertEqual(context.exception.get_code(), 403)
+
     def test_9_9(self):
         ''' 关闭数据连接 '''
 